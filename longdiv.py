@@ -9,31 +9,354 @@
 # in case the result is periodic, it will display the period
 # (which is basically why I wrote it)
 
-import os
+import argparse
+import collections
+import itertools
+import multiprocessing
+import random
 import sys
 
-def usage():
-    print("Usage: %s <numerator> <denominator>" % os.path.basename(sys.argv[0]))
 
+# the structure of the expansion can also be computed without dividing:
+# with the fraction reduced to num/denom and denom = 2^a * 5^b * m (m coprime
+# to 10), the digits start repeating after max(a, b) digits (pre-period) and
+# the period is the smallest k with 10^k = 1 (mod m), i.e. the multiplicative
+# order of 10 modulo m. That order divides the Carmichael function of m,
+# which follows from the prime factors of m, so only m needs to be factored.
 
-def main():
-    if len(sys.argv) != 3:
-        usage()
+def gcd(a,b):
+    # greatest common divisor, using the euclidean algorithm
+    while b:
+        a, b = b, a%b
+    return a
+
+
+def lcm(a,b):
+    return a / gcd(a,b) * b
+
+
+def _getSmallPrimes(limit):
+    # sieve of eratosthenes
+    sieve = [True] * limit
+    sieve[0] = sieve[1] = False
+    for n in xrange(2, int(limit ** 0.5) + 1):
+        if sieve[n]:
+            sieve[n*n::n] = [False] * len(sieve[n*n::n])
+    return [n for n in xrange(limit) if sieve[n]]
+
+SMALLPRIMES = _getSmallPrimes(1000)
+
+# Miller-Rabin with these bases is exact for n < 3.3 * 10^24, above it is a
+# (very reliable) probabilistic test
+MILLERRABIN_BASES = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41)
+
+
+def isPrime(n):
+    if n < 2:
+        return False
+    for p in SMALLPRIMES:
+        if n % p == 0:
+            return n == p
+
+    # n-1 = d * 2^s with d odd
+    d, s = n-1, 0
+    while d % 2 == 0:
+        d /= 2
+        s += 1
+
+    for a in MILLERRABIN_BASES:
+        x = pow(a, d, n)
+        if x == 1 or x == n-1:
+            continue
+        for r in xrange(s-1):
+            x = x*x % n
+            if x == n-1:
+                break
+        else:
+            # a witnesses that n is composite
+            return False
+    return True
+
+
+def _findFactor(n):
+    # Pollard's rho with Brent's cycle detection, the gcd is taken over a
+    # product of many differences instead of every single one.
+    # n must be odd and composite, returns a nontrivial factor
+    rand = random.Random(n)
+    while True:
+        y, c, m = rand.randrange(1, n), rand.randrange(1, n), 128
+        g = r = q = 1
+        while g == 1:
+            x = y
+            for i in xrange(r):
+                y = (y*y + c) % n
+            k = 0
+            while k < r and g == 1:
+                ys = y
+                for i in xrange(min(m, r-k)):
+                    y = (y*y + c) % n
+                    q = q * abs(x-y) % n
+                g = gcd(q, n)
+                k += m
+            r *= 2
+        if g == n:
+            # the product hit 0, redo the last batch one step at a time
+            g = 1
+            while g == 1:
+                ys = (ys*ys + c) % n
+                g = gcd(abs(x-ys), n)
+        if g != n:
+            return g
+        # unlucky polynomial, try another one
+
+
+def factorize(n):
+    # returns a dict of prime -> exponent
+    factors = {}
+    for p in SMALLPRIMES:
+        if p*p > n:
+            break
+        while n % p == 0:
+            factors[p] = factors.get(p, 0) + 1
+            n /= p
+
+    pending = [n] if n > 1 else []
+    while pending:
+        n = pending.pop()
+        if isPrime(n):
+            factors[n] = factors.get(n, 0) + 1
+        else:
+            f = _findFactor(n)
+            pending.extend((f, n / f))
+    return factors
+
+
+def getMultiplicativeOrder(a, m, factors = None):
+    # smallest k > 0 with a^k = 1 (mod m), a and m must be coprime
+    # factors -- factorize(m) if already known
+    if m == 1:
         return 1
+    if factors is None:
+        factors = factorize(m)
+
+    # Carmichael function of m, a multiple of the order, and the primes
+    # dividing it (those of p-1 and p itself for prime powers)
+    order = 1
+    orderprimes = set()
+    for p, k in factors.iteritems():
+        if p == 2:
+            l = 2 ** max(0, k-2) if k >= 3 else k
+        else:
+            l = (p-1) * p ** (k-1)
+        order = lcm(order, l)
+        orderprimes.update(factorize(p-1))
+        if k > 1:
+            orderprimes.add(p)
+
+    # strip the primes that are not needed
+    for q in orderprimes:
+        while order % q == 0 and pow(a, order / q, m) == 1:
+            order /= q
+    return order
+
+
+def getPeriod(num, denom):
+    # returns (pre-period, period) of the decimal expansion of num/denom,
+    # period is 0 if the expansion terminates
+    denom = abs(denom / gcd(num, denom))
+    preperiod = 0
+    for p in (2, 5):
+        k = 0
+        while denom % p == 0:
+            denom /= p
+            k += 1
+        preperiod = max(preperiod, k)
+    if denom == 1:
+        return preperiod, 0
+    return preperiod, getMultiplicativeOrder(10, denom)
+
+
+# digits produced per big integer division in streaming mode
+STREAM_BLOCKDIGITS = 4096
+
+
+def iterDigitBlocks(rem, denom, count, blockdigits = STREAM_BLOCKDIGITS):
+    # yields the first count digits after the decimal point of rem/denom
+    # (0 <= rem < denom) as strings of up to blockdigits digits, each block is
+    # one division of rem * 10^blockdigits instead of one step per digit
+    scale = 10 ** blockdigits
+    while count > 0:
+        if count < blockdigits:
+            blockdigits = count
+            scale = 10 ** blockdigits
+        digits, rem = divmod(rem * scale, denom)
+        yield str(digits).zfill(blockdigits)
+        count -= blockdigits
+
+
+def streamDivision(num, denom, fh, blockdigits = STREAM_BLOCKDIGITS):
+    # writes num/denom up to the end of the first period to fh, the memory
+    # needed does not depend on the period since the number of digits is
+    # known beforehand (getPeriod) and no remainders have to be kept
+    # returns (pre-period, period)
+    sign = '-' if num and (num < 0) != (denom < 0) else ''
+    num, denom = abs(num), abs(denom)
+    preperiod, period = getPeriod(num, denom)
+    intpart, rem = divmod(num, denom)
+    fh.write(sign + str(intpart))
+    if preperiod + period:
+        fh.write('.')
+    for block in iterDigitBlocks(rem, denom, preperiod + period, blockdigits):
+        fh.write(block)
+    fh.write('\n')
+    return preperiod, period
+
+
+# batch mode: number of denominators whose period structure is kept per
+# worker process, fractions handed to a worker at once and fractions read
+# ahead per worker (the pool would otherwise read the whole input at once)
+BATCH_CACHESIZE = 10000
+BATCH_CHUNKSIZE = 256
+BATCH_READAHEAD = 64
+
+_periodcache = collections.OrderedDict()
+
+
+def getCachedPeriod(denom):
+    # getPeriod for a reduced fraction with denominator denom > 0, the
+    # results of the last BATCH_CACHESIZE denominators are kept
+    try:
+        ret = _periodcache.pop(denom)
+    except KeyError:
+        ret = getPeriod(1, denom)
+        if len(_periodcache) >= BATCH_CACHESIZE:
+            _periodcache.popitem(last = False)
+    _periodcache[denom] = ret
+    return ret
+
+
+def formatPeriod(num, denom, preperiod, period):
+    if period:
+        return "%d/%d: %d digit%s before the period, period of %d digit%s" % (num, denom, preperiod, ['','s'][preperiod != 1],
+                                                                           period, ['','s'][period != 1])
+    return "%d/%d: terminates after %d digit%s" % (num, denom, preperiod, ['','s'][preperiod != 1])
+
+
+def _evaluateLine(item):
+    # runs in the worker processes, item is (line number, line) with a
+    # fraction written as "num denom" or "num/denom"
+    # returns (True, output line), (False, error message) or None for empty
+    # lines and comments
+    lineno, line = item
+    line = line.split('#', 1)[0].strip()
+    if not line:
+        return None
     try:
-        num, denom = map(int,sys.argv[1:3])
+        num, denom = [int(s) for s in line.replace('/', ' ').split()]
     except ValueError:
-        print("Error:input arguments %s are invalid integer numbers" % ','.join(sys.argv[1:3]))
-        return 1
-    
+        return False, "line %d: expected numerator and denominator, got '%s'" % (lineno, line)
+    if denom == 0:
+        return False, "line %d: denominator cannot be 0" % lineno
+
+    # the period structure only depends on the reduced denominator
+    preperiod, period = getCachedPeriod(abs(denom / gcd(num, denom)))
+    return True, formatPeriod(num, denom, preperiod, period)
+
+
+def evaluateBatch(fh, jobs, chunksize = BATCH_CHUNKSIZE):
+    # yields the results of _evaluateLine for the lines of fh in input order,
+    # evaluated by a pool of jobs processes
+    lines = enumerate(fh, 1)
+    if jobs <= 1:
+        for result in itertools.imap(_evaluateLine, lines):
+            yield result
+        return
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        # the pool consumes its input iterator right away, so it gets the
+        # input in windows to keep the memory bounded
+        window = jobs * chunksize * BATCH_READAHEAD
+        while True:
+            items = list(itertools.islice(lines, window))
+            if not items:
+                break
+            for result in pool.imap(_evaluateLine, items, chunksize):
+                yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def runBatch(filename, jobs):
+    # batch mode, writes one line per fraction to stdout and the errors to
+    # stderr, returns the exit status
+    fh = sys.stdin if filename == '-' else open(filename, 'r')
+    errors = 0
+    try:
+        for result in evaluateBatch(fh, jobs):
+            if result is None:
+                continue
+            ok, text = result
+            if ok:
+                sys.stdout.write(text + '\n')
+            else:
+                sys.stderr.write(text + '\n')
+                errors += 1
+    finally:
+        if fh is not sys.stdin:
+            fh.close()
+    return 1 if errors else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "calculate the full decimal expansion of numerator/denominator")
+    parser.add_argument("numerator", type = int, nargs = '?')
+    parser.add_argument("denominator", type = int, nargs = '?')
+    parser.add_argument("-p", "--period", action = "store_true",
+                        help = "only compute the lengths of the pre-period and the period (works for huge denominators)")
+    parser.add_argument("-s", "--stream", action = "store_true",
+                        help = "write the digits up to the end of the first period in blocks with constant memory")
+    parser.add_argument("-o", "--output", metavar = "FILE", help = "write the digits of --stream to FILE instead of stdout")
+    parser.add_argument("-b", "--batch", metavar = "FILE",
+                        help = "compute the pre-period and period of every fraction in FILE ('-' for stdin), one "
+                               "'numerator denominator' or 'numerator/denominator' per line")
+    parser.add_argument("-j", "--jobs", type = int, default = multiprocessing.cpu_count(),
+                        help = "number of processes for --batch (default: number of CPUs)")
+    args = parser.parse_args()
+
+    if args.batch:
+        return runBatch(args.batch, args.jobs)
+
+    num, denom = args.numerator, args.denominator
+    if num is None or denom is None:
+        parser.error("numerator and denominator are required without --batch")
+
     if denom == 0:
         print("Error: denominator cannot be 0.")
         return 1
+
+    if args.period:
+        preperiod, period = getPeriod(num, denom)
+        print(formatPeriod(num, denom, preperiod, period))
+        return 0
+
+    if args.stream:
+        if args.output:
+            with open(args.output, 'wb') as fh:
+                preperiod, period = streamDivision(num, denom, fh)
+        else:
+            preperiod, period = streamDivision(num, denom, sys.stdout)
+        sys.stderr.write("%d/%d: %d digit%s before the period, periodic part of %d digit%s\n" % (num, denom,
+                         preperiod, ['','s'][preperiod != 1], period, ['','s'][period != 1]))
+        return 0
+
     print ("calculating %d/%d" % (num,denom))
-   
+
     # (count, pos) of already returned remainders to get the period
     remdict = dict()
-   
+
     fullnumlist = []
     pos = 0
 
@@ -58,11 +381,12 @@ def main():
         print("... (periodic part %s (%d digit%s)" % (period, len(period), ['','s'][len(period)>1]))
     else:
         print("")
-        
- 
 
 
-try:
-    main()
-except KeyboardInterrupt:
-    pass
+
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,538 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2013, Carsten Juttner <carjay@gmx.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Benchmarks of the smaps parser and the pagemap readers. A procfs-like tree
+# with generated smaps, maps, pagemap, kpagecount and kpageflags files is
+# built once, every benchmark runs in its own interpreter so its peak RSS can
+# be measured, and the results are compared against a stored baseline.
+
+import argparse
+import json
+import logging
+import os
+import pagemap
+import resource
+import smaps
+import subprocess
+import sys
+import time
+
+try:
+    import numpy
+except ImportError:
+    print("needs numpy (available on PyPi)")
+    sys.exit(1)
+
+lh = logging.getLogger(__name__)
+info    = lh.info
+debug   = lh.debug
+error   = lh.error
+warning = lh.warning
+
+
+# bump when the generated data changes, older fixture trees are rebuilt
+FIXTURE_VERSION = 2
+
+# number of mappings of the smaps fixtures
+SMAPS_MAPCOUNTS = (1000, 10000, 100000)
+
+# smaps fixtures of the parser speed target, kept at their size with --quick:
+# name -> (number of mappings, fraction of mappings lacking a field line which
+# defeats the columnar parse of the whole file)
+SMAPS_PINNED = {
+    "smaps50000"          : (50000, 0.0),
+    "smapsirregular50000" : (50000, 0.01),
+}
+
+# pagemap fixtures: name -> (virtual size, fraction present, fraction
+# swapped, fraction in transparent huge pages)
+PAGEMAP_FIXTURES = {
+    "sparse"  : (32 << 30, 0.02, 0.0,  0.0),
+    "dense"   : (4 << 30,  1.0,  0.0,  0.0),
+    "swapped" : (4 << 30,  0.5,  0.3,  0.0),
+    "thp"     : (8 << 30,  0.95, 0.0,  0.9),
+}
+
+# --quick divides the sizes by this
+QUICK_DIVISOR = 10
+
+# default place of the fixture tree and of the baseline
+BENCH_FIXTUREDIR = "/tmp/memview-bench"
+BENCH_BASELINE   = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+
+# relative loss of throughput or growth of peak RSS reported as regression
+BENCH_TOLERANCE = 0.2
+
+# the scan benchmarks pass the range this often to scanMappings that the
+# pages read add up to at least this, a single range is read so fast that
+# the start and teardown of the thread pool would dominate
+SCAN_MINPAGES = 1 << 27
+
+# first mapping address of the pagemap fixtures
+_PAGEMAP_BASE = 0x100000000
+
+_PAGEMAP_PIDBASE = 2000
+_SMAPS_PIDBASE   = 1000
+
+PI = pagemap.PageInfo
+
+# kpageflags of the generated pages
+_ANONFLAGS = ((1 << PI.KPF_UPTODATE) | (1 << PI.KPF_LRU) | (1 << PI.KPF_MMAP) | (1 << PI.KPF_ANON) |
+              (1 << PI.KPF_SWAPBACKED))
+_THPHEAD   = _ANONFLAGS | (1 << PI.KPF_COMPOUND_HEAD) | (1 << PI.KPF_THP)
+_THPTAIL   = _ANONFLAGS | (1 << PI.KPF_COMPOUND_TAIL) | (1 << PI.KPF_THP)
+
+
+def _getFixtureConfig(quick):
+    '''
+        private helper returning the fixture parameters as a dict
+    '''
+    divisor = QUICK_DIVISOR if quick else 1
+    hugepages = pagemap.HPAGE_PMD_SIZE / pagemap.PAGESIZE
+    config = {"version"  : FIXTURE_VERSION,
+              "pagesize" : pagemap.PAGESIZE,
+              "smaps"    : {},
+              "pagemap"  : {}}
+    for idx, mapcount in enumerate(SMAPS_MAPCOUNTS):
+        config["smaps"]["smaps%d" % (mapcount / divisor)] = {"pid" : _SMAPS_PIDBASE + idx, "mapcount" : mapcount / divisor}
+    for idx, (name, (mapcount, irregular)) in enumerate(sorted(SMAPS_PINNED.iteritems()), len(SMAPS_MAPCOUNTS)):
+        config["smaps"][name] = {"pid" : _SMAPS_PIDBASE + idx, "mapcount" : mapcount, "irregular" : irregular}
+    for idx, (name, (size, present, swapped, thp)) in enumerate(sorted(PAGEMAP_FIXTURES.iteritems())):
+        pages = (size / divisor / pagemap.PAGESIZE) / hugepages * hugepages
+        config["pagemap"][name] = {"pid"          : _PAGEMAP_PIDBASE + idx,
+                                   "startaddress" : _PAGEMAP_BASE,
+                                   "stopaddress"  : _PAGEMAP_BASE + pages * pagemap.PAGESIZE,
+                                   "present"      : present,
+                                   "swapped"      : swapped,
+                                   "thp"          : thp}
+    return config
+
+
+
+_SMAPS_RECORD = '''%(start)x-%(stop)x %(perms)s %(offset)08x %(dev)s %(inode)d%(name)s
+Size:           %(size)8d kB
+KernelPageSize: %(ps)8d kB
+MMUPageSize:    %(ps)8d kB
+Rss:            %(rss)8d kB
+Pss:            %(pss)8d kB
+Pss_Dirty:      %(dirty)8d kB
+Shared_Clean:   %(sclean)8d kB
+Shared_Dirty:          0 kB
+Private_Clean:  %(pclean)8d kB
+Private_Dirty:  %(dirty)8d kB
+Referenced:     %(rss)8d kB
+Anonymous:      %(anon)8d kB
+KSM:                   0 kB
+LazyFree:              0 kB
+AnonHugePages:         0 kB
+ShmemPmdMapped:        0 kB
+FilePmdMapped:         0 kB
+Shared_Hugetlb:        0 kB
+Private_Hugetlb:       0 kB
+Swap:           %(swap)8d kB
+SwapPss:        %(swap)8d kB
+Locked:                0 kB
+THPeligible:    %(thp)8d
+VmFlags: %(vmflags)s
+'''
+
+
+def _writeSMaps(dirname, mapcount, rand, irregular = 0.0):
+    '''
+        private helper writing <dirname>/smaps and <dirname>/maps with
+        mapcount mappings, a mix of anonymous mappings and shared libraries
+        with the usual text/rodata/data layout
+        irregular -- fraction of the mappings without a Locked line
+    '''
+    pagekb = pagemap.PAGESIZE / 1024
+    sizes  = rand.randint(1, 256, mapcount) * pagekb
+    rsss   = (sizes * rand.random_sample(mapcount)).astype(int) / pagekb * pagekb
+    swaps  = numpy.where(rand.random_sample(mapcount) < 0.1, (sizes - rsss) / 2 / pagekb * pagekb, 0)
+    kinds  = rand.randint(0, 4, mapcount)
+    broken = rand.random_sample(mapcount) < irregular if irregular else numpy.zeros(mapcount, bool)
+
+    records = []
+    headers = []
+    address = 0x400000
+    for idx in xrange(mapcount):
+        size, rss, swap, kind = int(sizes[idx]), int(rsss[idx]), int(swaps[idx]), kinds[idx]
+        if idx == 0:
+            name, perms, inode, anon = "[heap]", "rw-p", 0, True
+        elif idx == mapcount - 1:
+            name, perms, inode, anon = "[stack]", "rw-p", 0, True
+        elif kind == 0:
+            name, perms, inode, anon = "", "rw-p", 0, True
+        else:
+            name, perms, inode, anon = "/usr/lib/libbench%d.so" % (idx / 3), ("r-xp", "r--p", "rw-p")[kind - 1], 100000 + idx / 3, False
+        values = {"start"   : address,
+                  "stop"    : address + size * 1024,
+                  "perms"   : perms,
+                  "offset"  : 0 if anon else (idx % 3) * 0x1000,
+                  "dev"     : "00:00" if anon else "08:01",
+                  "inode"   : inode,
+                  "name"    : " " * (26 - len(str(inode))) + name if name else "",
+                  "size"    : size,
+                  "ps"      : pagekb,
+                  "rss"     : rss,
+                  "pss"     : rss if anon else rss / 2,
+                  "dirty"   : rss if anon else 0,
+                  "sclean"  : 0 if anon else rss / 2,
+                  "pclean"  : 0 if anon else rss - rss / 2,
+                  "anon"    : rss if anon else 0,
+                  "swap"    : swap,
+                  "thp"     : 1 if anon else 0,
+                  "vmflags" : "rd wr mr mw me ac" if anon else "rd ex mr mw me"}
+        record = _SMAPS_RECORD % values
+        if broken[idx]:
+            record = record.replace("Locked:                0 kB\n", "")
+        records.append(record)
+        headers.append(record[:record.index("\n") + 1])
+        # leave gaps like a real address space
+        address += size * 1024 + (0x1000 if idx % 7 == 0 else 0)
+
+    with open(os.path.join(dirname, "smaps"), 'wb') as fh:
+        fh.write("".join(records))
+    with open(os.path.join(dirname, "maps"), 'wb') as fh:
+        fh.write("".join(headers))
+
+
+
+def _writePageMaps(root, fixtures, rand):
+    '''
+        private helper writing the <pid>/pagemap files of the pagemap
+        fixtures and the kpagecount/kpageflags files for all their page
+        frames
+
+        the page frames are handed out in random order, except for huge
+        pages which get contiguous aligned frames like in the kernel
+    '''
+    hugepages = pagemap.HPAGE_PMD_SIZE / pagemap.PAGESIZE
+    nextpfn = hugepages
+    layouts = []
+    for name, fixture in sorted(fixtures.iteritems()):
+        pagecount = (fixture["stopaddress"] - fixture["startaddress"]) / pagemap.PAGESIZE
+        groups = pagecount / hugepages
+        thpgroups = rand.random_sample(groups) < fixture["thp"]
+        # present fraction of the remaining pages so the total matches
+        basepresent = 0.0
+        if fixture["thp"] < 1.0:
+            basepresent = max(0.0, min(1.0, (fixture["present"] - fixture["thp"]) / (1.0 - fixture["thp"])))
+        sample  = rand.random_sample(pagecount)
+        present = sample < basepresent
+        swapped = ~present & (sample < basepresent + fixture["swapped"])
+        present |= numpy.repeat(thpgroups, hugepages)
+        swapped &= ~present
+
+        ishuge = numpy.repeat(thpgroups, hugepages)
+        single = numpy.flatnonzero(present & ~ishuge)
+        pfns = numpy.zeros(pagecount, dtype=numpy.uint64)
+        # huge pages first, on aligned contiguous frames
+        hugeidx = numpy.flatnonzero(ishuge)
+        pfns[hugeidx] = nextpfn + numpy.arange(len(hugeidx), dtype=numpy.uint64)
+        nextpfn += len(hugeidx)
+        pfns[single] = nextpfn + rand.permutation(len(single)).astype(numpy.uint64)
+        nextpfn += len(single)
+        nextpfn = (nextpfn + hugepages - 1) / hugepages * hugepages
+        layouts.append((fixture, present, swapped, ishuge, pfns))
+
+    pageflags  = numpy.zeros(nextpfn, dtype=numpy.uint64)
+    pagecounts = numpy.zeros(nextpfn, dtype=numpy.uint64)
+    for fixture, present, swapped, ishuge, pfns in layouts:
+        values = numpy.zeros(len(present), dtype=numpy.uint64)
+        values[present] = numpy.uint64(1 << 63) | numpy.uint64(1 << 56) | pfns[present]
+        swapidx = numpy.flatnonzero(swapped)
+        values[swapidx] = numpy.uint64(1 << 62) | (numpy.arange(len(swapidx), dtype=numpy.uint64) << numpy.uint64(5))
+
+        pageflags[pfns[present & ~ishuge]] = _ANONFLAGS
+        pagecounts[pfns[present]] = 1
+        hugepfns = pfns[ishuge]
+        if len(hugepfns):
+            pageflags[hugepfns] = _THPTAIL
+            pageflags[hugepfns[::pagemap.HPAGE_PMD_SIZE / pagemap.PAGESIZE]] = _THPHEAD
+
+        dirname = os.path.join(root, str(fixture["pid"]))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        # the pagemap is indexed by virtual page number, the file is sparse
+        # up to the first mapping
+        with open(os.path.join(dirname, "pagemap"), 'wb') as fh:
+            fh.seek(fixture["startaddress"] / pagemap.PAGESIZE * 8)
+            values.tofile(fh)
+        with open(os.path.join(dirname, "maps"), 'wb') as fh:
+            fh.write("%x-%x rw-p 00000000 00:00 0\n" % (fixture["startaddress"], fixture["stopaddress"]))
+
+    pageflags.tofile(os.path.join(root, "kpageflags"))
+    pagecounts.tofile(os.path.join(root, "kpagecount"))
+
+
+
+def buildFixtures(root, quick = False):
+    '''
+        generates the fixture tree under root unless an up to date one is
+        there already
+        root  -- directory for the tree
+        quick -- generate smaller fixtures
+
+        returns the fixture config dict (also stored as root/fixtures.json)
+    '''
+    config = _getFixtureConfig(quick)
+    configfile = os.path.join(root, "fixtures.json")
+    try:
+        with open(configfile) as fh:
+            if json.load(fh) == json.loads(json.dumps(config)):
+                return config
+    except (IOError, ValueError):
+        pass
+
+    info("generating fixtures in '%s'" % root)
+    if not os.path.isdir(root):
+        os.makedirs(root)
+    rand = numpy.random.RandomState(4711)
+    for name, fixture in sorted(config["smaps"].iteritems()):
+        dirname = os.path.join(root, str(fixture["pid"]))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        _writeSMaps(dirname, fixture["mapcount"], rand, fixture.get("irregular", 0.0))
+    _writePageMaps(root, config["pagemap"], rand)
+
+    with open(configfile, 'wb') as fh:
+        json.dump(config, fh, indent = 1, sort_keys = True, separators = (",", ": "))
+    return config
+
+
+
+# benchmark name prefix -> (fixture group, unit of the throughput)
+_KINDS = {
+    "smaps"    : ("smaps",   "mappings/s"),
+    "maps"     : ("smaps",   "mappings/s"),
+    "pagemap"  : ("pagemap", "pages/s"),
+    "scan"     : ("pagemap", "pages/s"),
+    "compound" : ("pagemap", "pages/s"),
+}
+
+
+def getBenchmarks(config):
+    '''
+        returns the sorted list of benchmark names for a fixture config
+    '''
+    names = []
+    for name in config["smaps"]:
+        names.append("smaps/%s" % name)
+        names.append("maps/%s" % name)
+    for name in config["pagemap"]:
+        names.append("pagemap/%s" % name)
+        names.append("scan/%s" % name)
+    if "thp" in config["pagemap"]:
+        names.append("compound/thp")
+    return sorted(names)
+
+
+
+def _runOnce(kind, fixture, root):
+    '''
+        private helper running one benchmark pass
+
+        returns a tuple (units processed, bytes read)
+    '''
+    pid = fixture["pid"]
+    if kind == "smaps":
+        s = smaps.SMaps(pid, root)
+        return len(s.maplist), os.path.getsize(os.path.join(root, str(pid), "smaps"))
+    if kind == "maps":
+        m = smaps.Maps(pid, root)
+        return len(m.maplist), os.path.getsize(os.path.join(root, str(pid), "maps"))
+
+    pm = pagemap.PageMap(pid, root)
+    start, stop = fixture["startaddress"], fixture["stopaddress"]
+    pages = (stop - start) / pagemap.PAGESIZE
+    if kind == "pagemap":
+        present = 0
+        for pia in pm.iterPageInfoArrays(start, stop, pagemap.PAGESIZE):
+            present += pia.getPresentCount()
+        # pagemap words plus the kpagecount/kpageflags words
+        return pages, (pages + 2 * present) * 8
+    if kind == "scan":
+        passes = max(1, SCAN_MINPAGES / pages)
+        pm.scanMappings([(start, stop, pagemap.PAGESIZE)] * passes)
+        return pages * passes, pages * passes * 8
+    if kind == "compound":
+        records = 0
+        for cpa in pm.iterCompoundPageArrays(start, stop):
+            records += len(cpa)
+        return pages, (pages + 2 * records) * 8
+    raise ValueError, "unknown benchmark kind '%s'" % kind
+
+
+
+def getPeakRSS():
+    '''
+        returns the peak resident set size of this process in bytes
+
+        VmHWM starts over with exec, unlike ru_maxrss which keeps the peak of
+        the process that started the benchmark
+    '''
+    with open("/proc/self/status", 'rb') as fh:
+        for l in fh:
+            if l.startswith("VmHWM:"):
+                return int(l.split()[1]) << 10
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+
+def runChild(name, root, repeat):
+    '''
+        runs one benchmark in this interpreter and returns its result dict,
+        the time is the best of repeat passes
+    '''
+    with open(os.path.join(root, "fixtures.json")) as fh:
+        config = json.load(fh)
+    kind, fixturename = name.split("/")
+    group, unit = _KINDS[kind]
+    fixture = config[group][fixturename]
+
+    best = None
+    for i in xrange(repeat):
+        starttime = time.time()
+        startcpu  = time.clock()
+        units, nbytes = _runOnce(kind, fixture, root)
+        elapsed = time.time() - starttime
+        cputime = time.clock() - startcpu
+        if best is None or elapsed < best[0]:
+            best = (elapsed, cputime)
+
+    elapsed, cputime = best
+    return {"seconds"    : elapsed,
+            "cpuseconds" : cputime,
+            "units"      : units,
+            "unit"       : unit,
+            "throughput" : units / max(elapsed, 1e-9),
+            "mbytes_s"   : nbytes / max(elapsed, 1e-9) / (1 << 20),
+            "maxrss"     : getPeakRSS()}
+
+
+
+def runBenchmarks(root, names, repeat):
+    '''
+        runs the benchmarks, each in a fresh interpreter
+
+        returns a dict of name -> result dict
+    '''
+    results = {}
+    for name in names:
+        cmd = [sys.executable, os.path.abspath(__file__), "--child", name, "--fixtures", root, "--repeat", str(repeat)]
+        proc = subprocess.Popen(cmd, stdout = subprocess.PIPE)
+        out = proc.communicate()[0]
+        if proc.returncode != 0:
+            error("benchmark '%s' failed with exit code %d" % (name, proc.returncode))
+            continue
+        results[name] = json.loads(out.splitlines()[-1])
+    return results
+
+
+
+def getBaselineKey(name, quick):
+    '''
+        returns the key of a benchmark in the baseline, the results of the
+        smaller --quick fixtures are kept apart
+    '''
+    return "quick:" + name if quick else name
+
+
+
+def compareBaseline(results, baseline, tolerance):
+    '''
+        compares results against baseline results
+
+        returns a list of (name, message) of the regressions
+    '''
+    regressions = []
+    for name, result in sorted(results.iteritems()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result["throughput"] < base["throughput"] * (1.0 - tolerance):
+            regressions.append((name, "throughput %.0f %s, baseline %.0f" % (result["throughput"], result["unit"], base["throughput"])))
+        if result["maxrss"] > base["maxrss"] * (1.0 + tolerance):
+            regressions.append((name, "peak RSS %.1f MByte, baseline %.1f" % (result["maxrss"] / 1048576.0, base["maxrss"] / 1048576.0)))
+    return regressions
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "benchmark the smaps and pagemap readers on generated procfs data")
+    parser.add_argument("benchmarks", nargs = '*', help = "benchmarks to run, prefixes like 'smaps' or 'pagemap/thp' (default: all)")
+    parser.add_argument("--fixtures", default = BENCH_FIXTUREDIR, help = "directory of the generated procfs tree (default: %(default)s)")
+    parser.add_argument("--quick", action = "store_true", help = "use %dx smaller fixtures" % QUICK_DIVISOR)
+    parser.add_argument("--repeat", type = int, default = 5, help = "passes per benchmark, the best one counts")
+    parser.add_argument("--baseline", default = BENCH_BASELINE, help = "baseline file (default: %(default)s)")
+    parser.add_argument("--save", action = "store_true", help = "store the results as new baseline")
+    parser.add_argument("--tolerance", type = float, default = BENCH_TOLERANCE, help = "allowed relative slowdown (default: %(default)s)")
+    parser.add_argument("--child", help = argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    logging.basicConfig(level = logging.INFO)
+
+    if args.child:
+        print(json.dumps(runChild(args.child, args.fixtures, args.repeat)))
+        return 0
+
+    config = buildFixtures(args.fixtures, args.quick)
+    names = [name for name in getBenchmarks(config)
+             if not args.benchmarks or any(name.startswith(prefix) for prefix in args.benchmarks)]
+    results = runBenchmarks(args.fixtures, names, args.repeat)
+    keyed = dict((getBaselineKey(name, args.quick), result) for name, result in results.iteritems())
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)
+
+    print("%-26s %10s %14s %12s %10s %10s" % ("benchmark", "seconds", "throughput", "MByte/s", "peak RSS", "baseline"))
+    for name in names:
+        if name not in results:
+            continue
+        result = results[name]
+        base = baseline.get(getBaselineKey(name, args.quick))
+        ratio = "%+.0f%%" % ((result["throughput"] / base["throughput"] - 1.0) * 100) if base else "-"
+        print("%-26s %10.3f %14s %12.1f %9.1fM %10s" % (name, result["seconds"], "%.0f %s" % (result["throughput"], result["unit"]),
+                                                        result["mbytes_s"], result["maxrss"] / 1048576.0, ratio))
+
+    if args.save:
+        baseline.update(keyed)
+        with open(args.baseline, 'wb') as fh:
+            json.dump(baseline, fh, indent = 1, sort_keys = True, separators = (",", ": "))
+            fh.write("\n")
+        info("baseline saved to '%s'" % args.baseline)
+        return 0
+
+    regressions = compareBaseline(keyed, baseline, args.tolerance)
+    for name, message in regressions:
+        print("REGRESSION %s: %s" % (name, message))
+    return 1 if regressions or len(results) != len(names) else 0
+
+
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+    except KeyboardInterrupt:
+        pass
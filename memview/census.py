@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2013, Carsten Juttner <carjay@gmx.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# System wide memory census, the present page frame numbers of all processes
+# are collected and compared to get the exact unique and shared memory.
+# Needs root, without CAP_SYS_ADMIN the page frame numbers read as 0.
+
+import argparse
+import errno
+import logging
+import multiprocessing
+import os
+import pagemap
+import shutil
+import smaps
+import sys
+import tempfile
+
+try:
+    import numpy
+except ImportError:
+    print("needs numpy (available on PyPi)")
+    sys.exit(1)
+
+lh = logging.getLogger(__name__)
+info    = lh.info
+debug   = lh.debug
+error   = lh.error
+warning = lh.warning
+
+
+class ProcessCensus:
+    '''
+        holds the memory accounting of one process, all sizes in pages
+    '''
+    pid        = None
+    name       = None # command name
+
+    rss        = None # resident pages (each page frame counted once)
+    uss        = None # pages not mapped by any other scanned process
+    pss        = None # proportional set size from the page frame overlap
+    kernelpss  = None # proportional set size from /proc/kpagecount
+    sharedbyn  = None # numpy array, number of pages shared by exactly n processes
+
+    pfnfile    = None # .npy file with the sorted unique page frame numbers
+                      # (only during census)
+
+    def __repr__(self):
+        return "<ProcessCensus pid:%d name:'%s' rss:%d uss:%d pss:%.1f kernelpss:%.1f>" % (
+                self.pid, self.name, self.rss, self.uss, self.pss, self.kernelpss)
+
+
+
+def _collectProcess(args):
+    '''
+        private helper running in the census worker processes, collects the
+        present page frame numbers of one process
+        args -- tuple (pid, directory for the page frame number file,
+                procfs root)
+
+        returns a ProcessCensus instance or None if the process is not
+        accessible (anymore)
+    '''
+    pid, tmpdir, procroot = args
+    try:
+        with open("%s/%d/comm" % (procroot, pid), 'rb') as fh:
+            name = fh.read().strip()
+        s  = smaps.Maps(pid, procroot)
+        pm = pagemap.PageMap(pid, procroot)
+
+        # only kpagecount is needed, not kpageflags
+        try:
+            fhpgcnt = open("%s/kpagecount" % procroot, 'rb', 0)
+        except IOError:
+            fhpgcnt = None
+
+        pfnlist   = []
+        kernelpss = 0.0
+        try:
+            for me in s.maplist:
+                # vsyscall is above the task virtual address space so pagemap
+                # does not return anything for it
+                if me.name == "[vsyscall]":
+                    continue
+                for pia in pm.iterPageInfoArrays(me.startaddress, me.stopaddress, pagemap.PAGESIZE, kpageinfo = False):
+                    pfns = pia.pfn[pia.getPFNIndices()]
+                    pfnlist.append(pfns)
+                    if fhpgcnt:
+                        mapcount = pagemap.readWords(fhpgcnt, pfns)
+                        kernelpss += float((1.0 / mapcount[mapcount > 0]).sum())
+        finally:
+            if fhpgcnt:
+                fhpgcnt.close()
+    except (IOError, OSError), exc:
+        debug("_collectProcess: skipping pid %d: %s" % (pid, exc))
+        return None
+
+    pc = ProcessCensus()
+    pc.pid       = pid
+    pc.name      = name
+    pc.kernelpss = kernelpss
+    if pfnlist:
+        pfns = numpy.unique(numpy.concatenate(pfnlist))
+    else:
+        pfns = numpy.zeros(0, dtype=numpy.uint64)
+    # page frame numbers fit into 32 bit below 16 TByte of physical memory
+    if len(pfns) and pfns[-1] < (1 << 32):
+        pfns = pfns.astype(numpy.uint32)
+    pc.rss = len(pfns)
+    # the page frames go through a file, so the parent only needs to hold
+    # those of one process at a time
+    pc.pfnfile = os.path.join(tmpdir, "%d.npy" % pid)
+    numpy.save(pc.pfnfile, pfns)
+    return pc
+
+
+
+class Census:
+    '''
+        collects and compares the present pages of all processes
+
+        the share count of every page frame is kept in an array indexed by
+        the page frame number (4 byte per page frame of physical memory), the
+        per process page frame numbers are kept in temporary files, so only
+        those of one process are in memory at a time
+    '''
+    processlist = None # list of ProcessCensus instances, sorted by pid
+
+    _sharecounts = None # number of processes mapping each page frame, indexed by pfn
+
+    def __init__(self, pids = None, workers = None, procroot = smaps.PROCROOT):
+        '''
+            runs the census
+            pids     -- list of pids to include, default is all processes
+            workers  -- number of worker processes, default is the cpu count
+            procroot -- mount point of the procfs, or a directory with the
+                        same layout
+
+            raises IOError (EPERM) if not running as root on the live procfs
+        '''
+        # the page frame numbers read as 0 without the necessary permissions,
+        # every figure would be meaningless
+        if os.path.realpath(procroot) == "/proc" and os.geteuid() != 0:
+            raise IOError(errno.EPERM, "Census: needs root, the page frame numbers are not available otherwise")
+        if pids is None:
+            pids = sorted(int(entry) for entry in os.listdir(procroot) if entry.isdigit())
+
+        self.processlist = []
+        self._sharecounts = numpy.zeros(0, dtype=numpy.uint32)
+        tmpdir = tempfile.mkdtemp(prefix = "census")
+        try:
+            pool = multiprocessing.Pool(workers)
+            try:
+                for pc in pool.imap(_collectProcess, [(pid, tmpdir, procroot) for pid in pids], chunksize = 4):
+                    if pc is not None:
+                        self._addPFNs(numpy.load(pc.pfnfile))
+                        self.processlist.append(pc)
+            finally:
+                pool.close()
+                pool.join()
+            self._compare()
+        finally:
+            shutil.rmtree(tmpdir, True)
+
+
+    def _addPFNs(self, pfns):
+        '''
+            private helper counting the sorted unique page frame numbers of one
+            process in the share counts
+        '''
+        if not len(pfns):
+            return
+        if pfns[-1] >= len(self._sharecounts):
+            # grown in steps so the array is copied only a few times
+            size = max(int(pfns[-1]) + 1, 2 * len(self._sharecounts))
+            self._sharecounts = numpy.concatenate((self._sharecounts,
+                                                   numpy.zeros(size - len(self._sharecounts), dtype=numpy.uint32)))
+        # the pfns of a process are unique, so each is incremented once
+        self._sharecounts[pfns] += 1
+
+
+    def _compare(self):
+        '''
+            private helper to compute the sharing of every page frame between
+            the processes
+        '''
+        for pc in self.processlist:
+            pfns = numpy.load(pc.pfnfile)
+            n = self._sharecounts[pfns]
+            pc.uss       = int(numpy.count_nonzero(n == 1))
+            pc.pss       = float((1.0 / n).sum())
+            pc.sharedbyn = numpy.bincount(n)
+            pc.pfnfile   = None
+        self._sharecounts = None
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "system wide unique/shared memory accounting")
+    parser.add_argument("pids", nargs = '*', type = int, help = "process ids (default: all processes)")
+    parser.add_argument("-j", "--jobs", type = int, default = None, help = "number of worker processes")
+    args = parser.parse_args()
+
+    logging.basicConfig(level = logging.INFO)
+    # kernel threads have no mappings and other processes may not be
+    # accessible, the worker processes should not report each of them
+    logging.getLogger("smaps").setLevel(logging.CRITICAL)
+    logging.getLogger("pagemap").setLevel(logging.CRITICAL)
+
+    pagesize = pagemap.PAGESIZE
+    try:
+        c = Census(args.pids or None, args.jobs)
+    except IOError, exc:
+        error(exc.strerror)
+        sys.exit(1)
+
+    print("%8s %-16s %12s %12s %12s %12s %12s" % ("pid", "name", "rss kB", "uss kB", "pss kB", "kernelpss kB", "shared kB"))
+    for pc in sorted(c.processlist, key = lambda pc: pc.pss, reverse = True):
+        print("%8d %-16s %12d %12d %12d %12d %12d" % (pc.pid, pc.name[:16],
+                                                     pc.rss * pagesize / 1024, pc.uss * pagesize / 1024,
+                                                     pc.pss * pagesize / 1024, pc.kernelpss * pagesize / 1024,
+                                                     (pc.rss - pc.uss) * pagesize / 1024))
+
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,508 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2013, Carsten Juttner <carjay@gmx.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Content scanner, finds zero pages and pages with identical content within
+# and across processes by reading the present pages from /proc/<pid>/mem
+# (needs ptrace permissions on the processes, i.e. usually root)
+
+import argparse
+import errno
+import hashlib
+import logging
+import os
+import Queue
+import pagemap
+import shutil
+import smaps
+import sys
+import tempfile
+
+from multiprocessing.pool import ThreadPool
+
+try:
+    import numpy
+except ImportError:
+    print("needs numpy (available on PyPi)")
+    sys.exit(1)
+
+lh = logging.getLogger(__name__)
+info    = lh.info
+debug   = lh.debug
+error   = lh.error
+warning = lh.warning
+
+
+# pages read from /proc/<pid>/mem per readinto
+CONTENT_BATCHPAGES = 1024
+
+# default number of hashing threads (hashlib releases the GIL for big
+# buffers)
+CONTENT_WORKERS = 4
+
+# page records (hash, page frame number, process index) collected before
+# they are sorted and written to a temporary file, and records compared at
+# once when the files are merged, each record takes 20 byte
+CONTENT_RUNRECORDS   = 1 << 20
+CONTENT_MERGERECORDS = 1 << 20
+
+# hash value of pages that only contain zeros, the digests of all other
+# pages have the lowest bit set
+ZEROHASH = 0
+
+RECORD_DTYPE = numpy.dtype([("hash", "<u8"), ("pfn", "<u8"), ("proc", "<u4")])
+
+
+def _hashPages(buf, count, pagesize):
+    '''
+        private helper running in the hashing threads
+        buf      -- numpy uint8 array holding count pages
+        count    -- number of pages in buf
+
+        returns a numpy uint64 array with the hash of each page, ZEROHASH for
+        pages that only contain zeros
+    '''
+    pages  = buf[:count * pagesize].view(numpy.uint64).reshape(count, pagesize / 8)
+    hashes = numpy.zeros(count, dtype=numpy.uint64)
+    nonzero = numpy.flatnonzero(pages.any(axis=1))
+    if len(nonzero):
+        digests = "".join(hashlib.sha1(buffer(buf, idx * pagesize, pagesize)).digest()[:8] for idx in nonzero)
+        hashes[nonzero] = numpy.frombuffer(digests, dtype="<u8") | numpy.uint64(1)
+    return hashes
+
+
+
+class ProcessContent:
+    '''
+        holds the content statistics of one process, all counts in pages
+    '''
+    pid            = None
+    pagecount      = 0    # present pages that were read
+    zerocount      = 0    # pages that only contain zeros
+    duplicatecount = 0    # non-zero pages whose content is also on another page frame
+    internalcount  = 0    # pages that could be merged within the process alone
+    errorcount     = 0    # present pages that could not be read
+
+    def __repr__(self):
+        return "<ProcessContent pid:%d pages:%d zero:%d duplicate:%d internal:%d errors:%d>" % (self.pid,
+                self.pagecount, self.zerocount, self.duplicatecount, self.internalcount, self.errorcount)
+
+
+
+def _isBeforeOrAt(records, key):
+    '''
+        private helper returning a bool array telling which records sort
+        before or equal to key, a tuple (hash, pfn, proc)
+    '''
+    # numpy scalars, python ints below 2^63 would be compared as float
+    h, f, p = numpy.uint64(key[0]), numpy.uint64(key[1]), numpy.uint32(key[2])
+    return ((records["hash"] < h) |
+            ((records["hash"] == h) & ((records["pfn"] < f) | ((records["pfn"] == f) & (records["proc"] <= p)))))
+
+
+
+def iterMergedRecords(runs, mergerecords = CONTENT_MERGERECORDS):
+    '''
+        merges sorted record arrays (see RECORD_DTYPE)
+        runs         -- list of record arrays sorted by (hash, pfn, proc),
+                        e.g. memory mapped .npy files
+        mergerecords -- records taken from all runs together per step
+
+        yields record arrays in (hash, pfn, proc) order, each following the
+        previous one
+    '''
+    runs = [run for run in runs if len(run)]
+    pos  = [0] * len(runs)
+    blockrecords = max(1, mergerecords / max(1, len(runs)))
+    while True:
+        active = [idx for idx in xrange(len(runs)) if pos[idx] < len(runs[idx])]
+        if not active:
+            break
+        # every run holds all of its records up to the smallest last key of
+        # the next blocks, the run with that key gives its whole block
+        ends = dict((idx, min(pos[idx] + blockrecords, len(runs[idx]))) for idx in active)
+        cut  = min(tuple(runs[idx][ends[idx] - 1].tolist()) for idx in active)
+        parts = []
+        for idx in active:
+            block = runs[idx][pos[idx]:ends[idx]]
+            count = int(numpy.count_nonzero(_isBeforeOrAt(block, cut)))
+            parts.append(numpy.array(block[:count]))
+            pos[idx] += count
+        records = numpy.concatenate(parts)
+        yield records[numpy.lexsort((records["proc"], records["pfn"], records["hash"]))]
+
+
+
+class ContentCounter:
+    '''
+        computes the duplicate statistics from records (see RECORD_DTYPE)
+        given in (hash, pfn, proc) order, chunk by chunk
+
+        only the counts of the hash group at the end of the last chunk are
+        kept besides a few integers per process, so the memory does not
+        depend on the number of records
+    '''
+    framecount  = 0 # distinct page frames
+    zeroframes  = 0 # distinct page frames with ZEROHASH
+    contents    = 0 # distinct contents of the page frames
+
+    def __init__(self, proccount, pfnsavailable = True):
+        '''
+            proccount     -- number of processes, the proc field of the
+                             records is an index below it
+            pfnsavailable -- False if the page frame numbers are all 0 (no
+                             permission), every page counts as its own frame
+        '''
+        self.proccount     = proccount
+        self.pfnsavailable = pfnsavailable
+        self.duplicates    = numpy.zeros(proccount, dtype=numpy.int64) # pages per process, see ProcessContent
+        self.frames        = numpy.zeros(proccount, dtype=numpy.int64) # distinct page frames per process
+        self.proccontents  = numpy.zeros(proccount, dtype=numpy.int64) # distinct contents per process
+
+        self._lastkey    = None
+        self._groupid    = -1   # number of the open hash group
+        self._grouphash  = None
+        self._groupframes = 0
+        self._groupcounts = numpy.zeros(proccount, dtype=numpy.int64) # pages per process in the open group
+        self._lastgroup  = numpy.full(proccount, -1, dtype=numpy.int64) # last group each process was in
+
+
+    def add(self, records):
+        '''
+            counts the next records, they have to follow the ones before
+        '''
+        if not len(records):
+            return
+        h = records["hash"]
+        f = records["pfn"]
+        p = records["proc"].astype(numpy.int64)
+
+        newgroup = numpy.empty(len(records), dtype=bool)
+        newgroup[1:] = h[1:] != h[:-1]
+        newgroup[0]  = self._lastkey is None or h[0] != self._lastkey[0]
+        if self.pfnsavailable:
+            newframe = newgroup.copy()
+            newframe[1:] |= f[1:] != f[:-1]
+            newframe[0]  |= self._lastkey is not None and f[0] != self._lastkey[1]
+            newpair = newframe.copy()
+            newpair[1:] |= p[1:] != p[:-1]
+            newpair[0]  |= self._lastkey is not None and p[0] != self._lastkey[2]
+        else:
+            newframe = numpy.ones(len(records), dtype=bool)
+            newpair  = newframe
+        self._lastkey = (h[-1], f[-1], p[-1])
+
+        self.framecount += int(numpy.count_nonzero(newframe))
+        self.zeroframes += int(numpy.count_nonzero(newframe & (h == ZEROHASH)))
+        self.contents   += int(numpy.count_nonzero(newgroup))
+        self.frames     += numpy.bincount(p[newpair], minlength=self.proccount)
+
+        # hash group of every record, the open group keeps its number
+        opengroup = self._groupid
+        gid  = opengroup + numpy.cumsum(newgroup)
+        last = int(gid[-1])
+
+        # (group, process) pairs not seen before give the distinct contents
+        # of every process
+        pairs = numpy.unique(gid * self.proccount + p)
+        pairgroups = pairs / self.proccount
+        pairprocs  = pairs % self.proccount
+        isnew = self._lastgroup[pairprocs] != pairgroups
+        self.proccontents += numpy.bincount(pairprocs[isnew], minlength=self.proccount)
+        numpy.maximum.at(self._lastgroup, pairprocs, pairgroups)
+
+        # page frames per group, index 0 is the open group
+        groupframes = numpy.bincount(gid - opengroup, weights=newframe, minlength=last - opengroup + 1).astype(numpy.int64)
+        groupframes[0] += self._groupframes
+
+        # pages of all complete groups with several page frames are
+        # duplicates, the last group stays open
+        dup = (gid < last) & (groupframes[gid - opengroup] > 1) & (h != ZEROHASH)
+        self.duplicates += numpy.bincount(p[dup], minlength=self.proccount)
+        if last != opengroup:
+            self._closeGroup(groupframes[0])
+            self._groupcounts[:] = 0
+            self._grouphash = h[-1]
+        self._groupcounts += numpy.bincount(p[gid == last], minlength=self.proccount)
+        self._groupframes  = groupframes[last - opengroup]
+        self._groupid      = last
+
+
+    def _closeGroup(self, frames):
+        '''
+            private helper counting the pages of the open group as
+            duplicates if it has several page frames
+        '''
+        if frames > 1 and self._grouphash != ZEROHASH:
+            self.duplicates += self._groupcounts
+
+
+    def finish(self):
+        '''
+            completes the last group, call after the last add()
+        '''
+        self._closeGroup(self._groupframes)
+        self._groupcounts[:] = 0
+        self._groupframes = 0
+
+
+class ContentScan:
+    '''
+        hashes the present pages of processes and compares the hashes
+
+        a page frame mapped by several processes (e.g. shared library code)
+        is counted once, only different page frames with the same content
+        count as duplicates
+    '''
+    processlist  = None # list of ProcessContent instances
+    framecount   = 0    # distinct page frames that were read
+    zeroframes   = 0    # distinct page frames that only contain zeros
+    reclaimable  = 0    # page frames that merging identical content would free
+
+    def __init__(self, pids, workers = CONTENT_WORKERS, batchpages = CONTENT_BATCHPAGES,
+                 runrecords = CONTENT_RUNRECORDS, mergerecords = CONTENT_MERGERECORDS):
+        '''
+            runs the scan
+            pids         -- list of pids
+            workers      -- number of hashing threads
+            batchpages   -- number of pages read at once
+            runrecords   -- page records collected before they are sorted
+                            and written to a temporary file
+            mergerecords -- page records compared at once in the end
+
+            the memory used is 2 * workers * batchpages pages for reading
+            plus about 20 byte per record for runrecords and mergerecords,
+            the records of all pages go to temporary files
+        '''
+        self.pagesize     = pagemap.PAGESIZE
+        self.batchpages   = batchpages
+        self.runrecords   = runrecords
+        self.mergerecords = mergerecords
+        self.processlist  = []
+
+        self._tmpdir   = tempfile.mkdtemp(prefix = "content")
+        self._runfiles = []
+        self._pending  = []    # list of (hashes, pfns, procidx) not written yet
+        self._pendingcount = 0
+        self._pfnsavailable = False
+
+        try:
+            self._pool = ThreadPool(workers)
+            # reusable read buffers, a buffer is given back after its pages
+            # are hashed, so reading and hashing overlap
+            self._buffers = Queue.Queue()
+            for i in range(2 * workers):
+                self._buffers.put(numpy.empty(batchpages * self.pagesize, dtype=numpy.uint8))
+            scanned = [] # ProcessContent or None for every pid, indexed by the proc field
+            try:
+                for pid in pids:
+                    scanned.append(self._scanProcess(pid, len(scanned)))
+            finally:
+                self._pool.close()
+                self._pool.join()
+            self._writeRun()
+            self._compare(scanned)
+            self.processlist = [pc for pc in scanned if pc is not None]
+        finally:
+            shutil.rmtree(self._tmpdir, True)
+
+
+    def _addRecords(self, hashes, pfns, procidx):
+        '''
+            private helper collecting the records of read pages, they are
+            written as a sorted run once runrecords are collected
+        '''
+        self._pending.append((hashes, pfns, procidx))
+        self._pendingcount += len(hashes)
+        if self._pendingcount >= self.runrecords:
+            self._writeRun()
+
+
+    def _writeRun(self):
+        '''
+            private helper writing the collected records sorted by (hash,
+            pfn, proc) to a temporary .npy file
+        '''
+        if not self._pendingcount:
+            return
+        records = numpy.empty(self._pendingcount, dtype=RECORD_DTYPE)
+        pos = 0
+        for hashes, pfns, procidx in self._pending:
+            records["hash"][pos:pos + len(hashes)] = hashes
+            records["pfn"][pos:pos + len(hashes)]  = pfns
+            records["proc"][pos:pos + len(hashes)] = procidx
+            pos += len(hashes)
+        records = records[numpy.lexsort((records["proc"], records["pfn"], records["hash"]))]
+        filename = os.path.join(self._tmpdir, "run%d.npy" % len(self._runfiles))
+        numpy.save(filename, records)
+        self._runfiles.append(filename)
+        self._pending = []
+        self._pendingcount = 0
+
+
+    def _submit(self, fh, addresses, pfns, results):
+        '''
+            private helper reading the pages at the given addresses (sorted,
+            at most batchpages) into a free buffer and queueing their hashing
+        '''
+        buf = self._buffers.get()
+        # consecutive addresses are read at once
+        breaks = numpy.flatnonzero(numpy.diff(addresses) != self.pagesize) + 1
+        starts = numpy.concatenate(([0], breaks))
+        stops  = numpy.concatenate((breaks, [len(addresses)]))
+        valid  = numpy.ones(len(addresses), dtype=bool)
+        for start, stop in zip(starts, stops):
+            view = buf[start * self.pagesize:stop * self.pagesize]
+            try:
+                fh.seek(int(addresses[start]))
+                readsize = fh.readinto(view)
+            except IOError, exc:
+                # e.g. VM_IO/VM_PFNMAP mappings
+                if exc.errno not in (errno.EIO, errno.EFAULT):
+                    self._buffers.put(buf)
+                    raise
+                readsize = 0
+            if readsize < len(view):
+                valid[start + readsize / self.pagesize:stop] = False
+
+        def hashBatch():
+            # the buffer is given back even if hashing fails, the pool only
+            # calls back on success
+            try:
+                return _hashPages(buf, len(addresses), self.pagesize)
+            finally:
+                self._buffers.put(buf)
+        results.append((pfns, valid, self._pool.apply_async(hashBatch)))
+
+
+
+    def _addBatch(self, pc, procidx, pfns, valid, result):
+        '''
+            private helper taking the hashes of a batch once they are ready
+        '''
+        try:
+            hashes = result.get()
+        except Exception, exc:
+            warning("_scanProcess: pid %d: hashing %d pages failed: %r" % (pc.pid, len(pfns), exc))
+            pc.errorcount += len(pfns)
+            return
+        pc.errorcount += int(numpy.count_nonzero(~valid))
+        pfns   = pfns[valid]
+        hashes = hashes[valid]
+        pc.pagecount += len(pfns)
+        pc.zerocount += int(numpy.count_nonzero(hashes == ZEROHASH))
+        if not self._pfnsavailable and pfns.any():
+            self._pfnsavailable = True
+        self._addRecords(hashes, pfns, procidx)
+
+
+    def _scanProcess(self, pid, procidx):
+        '''
+            private helper reading and hashing the present pages of a process
+            procidx -- index of the process in the records
+
+            returns a ProcessContent instance or None if the process is not
+            accessible, its records are ignored then
+        '''
+        pc = ProcessContent()
+        pc.pid = pid
+        results = []
+        try:
+            maplist = smaps.Maps(pid).maplist
+            pm = pagemap.PageMap(pid)
+            with open("/proc/%d/mem" % pid, 'rb', 0) as fh:
+                for me in maplist:
+                    # vsyscall is above the task virtual address space and
+                    # vvar can not be read
+                    if me.name in ("[vsyscall]", "[vvar]", "[vvar_vclock]") or not me.access & me.VM_READ:
+                        continue
+                    for pia in pm.iterPageInfoArrays(me.startaddress, me.stopaddress, self.pagesize, self.batchpages, kpageinfo = False):
+                        indices = pia.getPFNIndices()
+                        if len(indices):
+                            addresses = numpy.uint64(pia.startaddress) + indices.astype(numpy.uint64) * numpy.uint64(self.pagesize)
+                            self._submit(fh, addresses, pia.pfn[indices], results)
+                        # the finished batches are taken right away, so only
+                        # the batches in flight are held
+                        while results and results[0][2].ready():
+                            self._addBatch(pc, procidx, *results.pop(0))
+        except (IOError, OSError), exc:
+            debug("_scanProcess: skipping pid %d: %s" % (pid, exc))
+            for pfns, valid, result in results:
+                result.wait()
+            return None
+
+        for pfns, valid, result in results:
+            self._addBatch(pc, procidx, pfns, valid, result)
+        debug("_scanProcess: pid %d: %d pages" % (pid, pc.pagecount))
+        return pc
+
+
+    def _compare(self, scanned):
+        '''
+            private helper computing the duplicate statistics from the runs
+            scanned -- ProcessContent or None for every proc index
+        '''
+        counter = ContentCounter(len(scanned), self._pfnsavailable)
+        ignored = numpy.array([pc is None for pc in scanned], dtype=bool)
+        runs = [numpy.load(filename, mmap_mode='r') for filename in self._runfiles]
+        for records in iterMergedRecords(runs, self.mergerecords):
+            if ignored.any():
+                records = records[~ignored[records["proc"]]]
+            counter.add(records)
+        counter.finish()
+        del runs
+
+        self.framecount  = counter.framecount
+        self.zeroframes  = counter.zeroframes
+        self.reclaimable = counter.framecount - counter.contents
+        for procidx, pc in enumerate(scanned):
+            if pc is not None:
+                pc.duplicatecount = int(counter.duplicates[procidx])
+                pc.internalcount  = int(counter.frames[procidx] - counter.proccontents[procidx])
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "find zero and duplicate pages within and across processes")
+    parser.add_argument("pids", nargs = '+', type = int, help = "process ids")
+    parser.add_argument("-j", "--jobs", type = int, default = CONTENT_WORKERS, help = "number of hashing threads")
+    args = parser.parse_args()
+
+    logging.basicConfig(level = logging.INFO)
+
+    pagesize = pagemap.PAGESIZE
+    cs = ContentScan(args.pids, args.jobs)
+
+    print("%8s %12s %12s %12s %12s %12s" % ("pid", "read kB", "zero kB", "dup kB", "internal kB", "errors kB"))
+    for pc in cs.processlist:
+        print("%8d %12d %12d %12d %12d %12d" % (pc.pid, pc.pagecount * pagesize / 1024, pc.zerocount * pagesize / 1024,
+                                                pc.duplicatecount * pagesize / 1024, pc.internalcount * pagesize / 1024,
+                                                pc.errorcount * pagesize / 1024))
+    print("%d page frames, %d zero (%d kB), merging identical content would free %d (%d kB)" % (cs.framecount,
+            cs.zeroframes, cs.zeroframes * pagesize / 1024, cs.reclaimable, cs.reclaimable * pagesize / 1024))
+
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
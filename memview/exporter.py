@@ -0,0 +1,530 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2013, Carsten Juttner <carjay@gmx.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Metrics exporter daemon, collects the memory of processes per mapping class
+# from smaps in a bounded pool of threads and serves the latest values in the
+# Prometheus text format over HTTP or a unix socket. The collections are
+# spaced so that their CPU time stays below a configurable share of one CPU.
+
+import argparse
+import BaseHTTPServer
+import errno
+import logging
+import os
+import smaps
+import SocketServer
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
+
+lh = logging.getLogger(__name__)
+info    = lh.info
+debug   = lh.debug
+error   = lh.error
+warning = lh.warning
+
+
+# mapping classes in the order they are exported
+CLASS_HEAP  = "heap"
+CLASS_STACK = "stack"
+CLASS_ANON  = "anon"
+CLASS_FILE  = "file"
+CLASS_SHMEM = "shmem"
+
+MAPPING_CLASSES = (CLASS_HEAP, CLASS_STACK, CLASS_ANON, CLASS_FILE, CLASS_SHMEM)
+
+# exported metric -> (help text, MapEntry fields summed up)
+METRICS = (
+    ("memview_rss_bytes",  "resident set size",                     ("rss",)),
+    ("memview_pss_bytes",  "proportional set size",                 ("pss",)),
+    ("memview_swap_bytes", "swapped out memory",                    ("swap",)),
+    ("memview_thp_bytes",  "memory backed by transparent huge pages", ("anonhugepages", "shmempmdmapped", "filepmdmapped")),
+)
+
+# names of shared memory that is backed by a file system entry
+_SHMEMPREFIXES = ("/dev/shm/", "/SYSV", "/memfd:", "/dev/zero")
+
+EXPORTER_INTERVAL  = 15.0  # seconds between two collections of a process
+EXPORTER_CPUBUDGET = 0.05  # share of one CPU the collections may use
+EXPORTER_WORKERS   = 2     # collections running at the same time
+EXPORTER_PORT      = 9477
+
+# the scheduler looks for due processes at least this often (seconds)
+_SCHEDULE_TICK = 0.5
+
+
+def getMappingClass(me):
+    '''
+        returns the CLASS_* of a MapEntry
+    '''
+    name = me.name
+    if name == "[heap]":
+        return CLASS_HEAP
+    if name.startswith("[stack"):
+        return CLASS_STACK
+    if name.startswith(_SHMEMPREFIXES) or (me.access & me.VM_MAYSHARE and not me.inode):
+        return CLASS_SHMEM
+    if me.inode:
+        return CLASS_FILE
+    return CLASS_ANON
+
+
+
+def getThreadCPUTime():
+    '''
+        returns the CPU time in seconds the calling thread used so far, this
+        includes the time the kernel spends generating the procfs files
+
+        falls back to the wall clock time if the kernel does not report the
+        thread run time, so the costs are overestimated
+    '''
+    try:
+        with open("/proc/thread-self/schedstat", 'rb') as fh:
+            return int(fh.read().split()[0]) / 1e9
+    except (IOError, ValueError, IndexError):
+        return time.time()
+
+
+
+class ProcessMetrics:
+    '''
+        holds the result of one collection of a process
+    '''
+    pid       = None
+    comm      = None
+    timestamp = None # end of the collection (seconds since the epoch)
+    duration  = None # wall time of the collection in seconds
+    cputime   = None # CPU time of the collection in seconds
+    mappings  = None # dict of CLASS_* -> number of mappings
+    values    = None # dict of (metric name, CLASS_*) -> bytes
+
+    def __repr__(self):
+        return "<ProcessMetrics pid:%d comm:'%s' mappings:%d duration:%.3f cpu:%.3f>" % (self.pid, self.comm,
+                sum(self.mappings.itervalues()), self.duration, self.cputime)
+
+
+
+def collectProcess(pid):
+    '''
+        reads the smaps of a process and sums up the metrics per mapping class
+        pid -- pid as a decimal number
+
+        returns a ProcessMetrics instance, raises IOError/OSError if the
+        process is gone or not accessible
+    '''
+    starttime = time.time()
+    startcpu  = getThreadCPUTime()
+
+    pm = ProcessMetrics()
+    pm.pid = pid
+    with open("/proc/%d/comm" % pid, 'rb') as fh:
+        pm.comm = fh.read().rstrip("\n")
+    pm.mappings = dict((cls, 0) for cls in MAPPING_CLASSES)
+    pm.values   = dict(((metric, cls), 0) for metric, helptext, fields in METRICS for cls in MAPPING_CLASSES)
+
+    for me in smaps.SMaps(pid).maplist:
+        cls = getMappingClass(me)
+        pm.mappings[cls] += 1
+        for metric, helptext, fields in METRICS:
+            for field in fields:
+                value = getattr(me, field)
+                if value:
+                    pm.values[(metric, cls)] += value
+
+    pm.timestamp = time.time()
+    pm.duration  = pm.timestamp - starttime
+    pm.cputime   = getThreadCPUTime() - startcpu
+    return pm
+
+
+
+def _escapeLabel(value):
+    '''
+        private helper escaping a label value for the Prometheus text format
+    '''
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+
+class CPUBudget:
+    '''
+        token bucket over CPU seconds, refilled with share seconds per wall
+        clock second up to burst seconds. The cost of a collection is only
+        known afterwards, so the bucket can go negative and nothing new is
+        started until it is refilled.
+    '''
+    share  = None
+    burst  = None
+    tokens = None
+
+    def __init__(self, share, burst):
+        '''
+            share -- CPU seconds per second (0.05 is 5% of one CPU)
+            burst -- maximum CPU seconds that can be used at once after an
+                     idle time
+        '''
+        self.share   = share
+        self.burst   = burst
+        self.tokens  = burst
+        self._last   = time.time()
+
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self._last) * self.share)
+        self._last  = now
+
+
+    def isAvailable(self, now):
+        '''
+            returns True if a new collection may start
+        '''
+        self._refill(now)
+        return self.tokens > 0
+
+
+    def consume(self, cputime, now):
+        '''
+            books the CPU time of a finished collection
+        '''
+        self._refill(now)
+        self.tokens -= cputime
+
+
+    def getWait(self, now):
+        '''
+            returns the seconds until the bucket is positive again
+        '''
+        self._refill(now)
+        if self.tokens > 0:
+            return 0.0
+        return -self.tokens / self.share
+
+
+
+class Exporter:
+    '''
+        schedules the collections of a set of processes and keeps their
+        latest results, call start() and getText() or use serve()
+
+        every process is collected at most every interval seconds and its
+        interval is stretched to cost * number of processes / cpubudget,
+        so each process gets a fair share of the budget. The CPUBudget on
+        top caps the total when many new processes show up at once.
+    '''
+    interval  = None
+    cpubudget = None
+    results   = None # dict of pid -> latest ProcessMetrics
+    skipped   = 0    # collections postponed because the budget was used up
+    failed    = 0    # collections that failed, e.g. because the process exited
+    cputime   = 0.0  # CPU seconds of all collections so far
+
+    def __init__(self, pids = None, match = None, interval = EXPORTER_INTERVAL, cpubudget = EXPORTER_CPUBUDGET,
+                 workers = EXPORTER_WORKERS):
+        '''
+            pids      -- list of pids to collect
+            match     -- list of process names (comm), the matching processes
+                         are looked up again before each scheduling round
+            interval  -- minimum seconds between two collections of a process
+            cpubudget -- share of one CPU the collections may use
+            workers   -- number of collections running at the same time
+        '''
+        if cpubudget <= 0:
+            raise ValueError, "Exporter: the CPU budget must be positive"
+        self.interval  = interval
+        self.cpubudget = cpubudget
+        self.results   = {}
+
+        self._pids     = list(pids or [])
+        self._match    = set(match or [])
+        self._workers  = workers
+        self._budget   = CPUBudget(cpubudget, cpubudget * interval)
+        self._lock     = threading.Lock()
+        self._wakeup   = threading.Condition(self._lock)
+        self._due      = {}    # pid -> time of the next collection
+        self._running  = set() # pids being collected
+        self._pool     = None
+        self._thread   = None
+        self._stopped  = False
+
+
+    def _getTargets(self):
+        '''
+            private helper returning the set of pids to collect
+        '''
+        targets = set(self._pids)
+        if self._match:
+            for entry in os.listdir("/proc"):
+                if not entry.isdigit():
+                    continue
+                try:
+                    with open("/proc/%s/comm" % entry, 'rb') as fh:
+                        comm = fh.read().rstrip("\n")
+                except IOError:
+                    continue
+                if comm in self._match:
+                    targets.add(int(entry))
+        return targets
+
+
+    def _collect(self, pid):
+        '''
+            private helper running in the pool, all errors are returned
+            since the pool only calls back on success and the pid would
+            stay in _running otherwise
+        '''
+        try:
+            return pid, collectProcess(pid), None
+        except (IOError, OSError), exc:
+            return pid, None, exc
+        except Exception, exc:
+            warning("_collect: pid %d: unexpected error %r" % (pid, exc))
+            return pid, None, exc
+
+
+    def _finished(self, result):
+        '''
+            private helper called by the pool when a collection is done
+        '''
+        pid, pm, exc = result
+        now = time.time()
+        with self._lock:
+            self._running.discard(pid)
+            if pm is None:
+                self.failed += 1
+                debug("_finished: pid %d: %s" % (pid, exc))
+                self.results.pop(pid, None)
+                if getattr(exc, "errno", None) in (errno.ENOENT, errno.ESRCH):
+                    # the process exited
+                    self._due.pop(pid, None)
+                else:
+                    self._due[pid] = now + self.interval
+            else:
+                self.results[pid] = pm
+                self.cputime += pm.cputime
+                self._budget.consume(pm.cputime, now)
+                share = self.cpubudget / max(1, len(self._due))
+                self._due[pid] = now + max(self.interval, pm.cputime / share)
+            self._wakeup.notify()
+
+
+    def _schedule(self):
+        '''
+            private helper, the scheduler thread
+        '''
+        nexttargets = 0
+        with self._lock:
+            while not self._stopped:
+                now = time.time()
+                if now >= nexttargets:
+                    self._lock.release()
+                    try:
+                        targets = self._getTargets()
+                    finally:
+                        self._lock.acquire()
+                    for pid in targets:
+                        self._due.setdefault(pid, now)
+                    for pid in set(self._due) - targets - self._running:
+                        del self._due[pid]
+                        self.results.pop(pid, None)
+                    nexttargets = now + self.interval
+
+                wait = min(_SCHEDULE_TICK, nexttargets - now)
+                due = sorted((when, pid) for pid, when in self._due.iteritems() if when <= now and pid not in self._running)
+                for when, pid in due:
+                    if len(self._running) >= self._workers:
+                        break
+                    if not self._budget.isAvailable(now):
+                        self.skipped += 1
+                        wait = min(wait, max(self._budget.getWait(now), 0.01))
+                        break
+                    self._running.add(pid)
+                    self._pool.apply_async(self._collect, (pid,), callback = self._finished)
+                self._wakeup.wait(max(wait, 0.01))
+
+
+    def start(self):
+        '''
+            starts the scheduler thread and the collection pool
+        '''
+        self._pool   = ThreadPool(self._workers)
+        self._thread = threading.Thread(target = self._schedule, name = "exporter-scheduler")
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def stop(self):
+        '''
+            stops the scheduler and waits for running collections
+        '''
+        with self._lock:
+            self._stopped = True
+            self._wakeup.notify()
+        self._thread.join()
+        self._pool.close()
+        self._pool.join()
+
+
+    def getText(self):
+        '''
+            returns the latest results in the Prometheus text format
+        '''
+        with self._lock:
+            results = sorted(self.results.iteritems())
+            skipped, failed, cputime = self.skipped, self.failed, self.cputime
+
+        lines = []
+        for metric, helptext, fields in METRICS:
+            lines.append("# HELP %s %s" % (metric, helptext))
+            lines.append("# TYPE %s gauge" % metric)
+            for pid, pm in results:
+                labels = 'pid="%d",comm="%s"' % (pid, _escapeLabel(pm.comm))
+                for cls in MAPPING_CLASSES:
+                    lines.append('%s{%s,class="%s"} %d' % (metric, labels, cls, pm.values[(metric, cls)]))
+
+        lines.append("# HELP memview_mappings number of mappings")
+        lines.append("# TYPE memview_mappings gauge")
+        for pid, pm in results:
+            labels = 'pid="%d",comm="%s"' % (pid, _escapeLabel(pm.comm))
+            for cls in MAPPING_CLASSES:
+                lines.append('memview_mappings{%s,class="%s"} %d' % (labels, cls, pm.mappings[cls]))
+
+        for metric, helptext, attr in (("memview_collect_seconds", "wall time of the last collection", "duration"),
+                                       ("memview_collect_cpu_seconds", "CPU time of the last collection", "cputime"),
+                                       ("memview_collect_timestamp_seconds", "end of the last collection", "timestamp")):
+            lines.append("# HELP %s %s" % (metric, helptext))
+            lines.append("# TYPE %s gauge" % metric)
+            for pid, pm in results:
+                lines.append('%s{pid="%d",comm="%s"} %.6f' % (metric, pid, _escapeLabel(pm.comm), getattr(pm, attr)))
+
+        for metric, helptext, value in (("memview_exporter_cpu_seconds_total", "CPU time of all collections", "%.6f" % cputime),
+                                        ("memview_exporter_skipped_total", "collections postponed by the CPU budget", "%d" % skipped),
+                                        ("memview_exporter_failed_total", "collections that failed", "%d" % failed)):
+            lines.append("# HELP %s %s" % (metric, helptext))
+            lines.append("# TYPE %s counter" % metric)
+            lines.append("%s %s" % (metric, value))
+        return "\n".join(lines) + "\n"
+
+
+    def serve(self, address = None, unixpath = None):
+        '''
+            serves getText() on GET requests until interrupted
+            address  -- (host, port) for HTTP over TCP
+            unixpath -- path of a unix socket for HTTP over it, used instead
+                        of address if given
+        '''
+        if unixpath:
+            server = _UnixHTTPServer(unixpath, _MetricsHandler)
+        else:
+            server = _TCPHTTPServer(address or ("127.0.0.1", EXPORTER_PORT), _MetricsHandler)
+        server.exporter = self
+        self.start()
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            self.stop()
+
+
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''
+        private request handler serving the metrics on every path
+    '''
+    def do_GET(self):
+        body = self.server.exporter.getText()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def address_string(self):
+        # unix socket peers have no address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return "unix"
+
+
+    def log_message(self, format, *args):
+        debug("%s %s" % (self.address_string(), format % args))
+
+
+
+class _TCPHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads      = True
+    allow_reuse_address = True
+
+
+
+class _UnixHTTPServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        # a socket left over from an earlier run
+        try:
+            os.unlink(self.server_address)
+        except OSError, exc:
+            if exc.errno != errno.ENOENT:
+                raise
+        SocketServer.UnixStreamServer.server_bind(self)
+
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "export the memory of processes per mapping class in the Prometheus text format")
+    parser.add_argument("pids", nargs = '*', type = int, help = "process ids")
+    parser.add_argument("-m", "--match", action = "append", metavar = "NAME", help = "also collect all processes with this name (comm), can be repeated")
+    parser.add_argument("-i", "--interval", type = float, default = EXPORTER_INTERVAL, help = "minimum seconds between two collections of a process")
+    parser.add_argument("--cpu", type = float, default = EXPORTER_CPUBUDGET, help = "share of one CPU the collections may use (default: %(default)s)")
+    parser.add_argument("-j", "--jobs", type = int, default = EXPORTER_WORKERS, help = "number of collections running at the same time")
+    parser.add_argument("-l", "--listen", default = "127.0.0.1:%d" % EXPORTER_PORT, metavar = "HOST:PORT", help = "HTTP address (default: %(default)s)")
+    parser.add_argument("-u", "--unix", metavar = "PATH", help = "serve on a unix socket instead of TCP")
+    parser.add_argument("-v", "--verbose", action = "store_true", help = "log every collection and request")
+    args = parser.parse_args()
+
+    logging.basicConfig(level = logging.DEBUG if args.verbose else logging.INFO)
+
+    if not args.pids and not args.match:
+        parser.error("no processes given, use pids and/or --match")
+
+    host, sep, port = args.listen.rpartition(':')
+    exporter = Exporter(args.pids, args.match, args.interval, args.cpu, args.jobs)
+    info("serving on %s" % (args.unix or args.listen))
+    exporter.serve((host or "127.0.0.1", int(port)), args.unix)
+
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
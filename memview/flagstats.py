@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2013, Carsten Juttner <carjay@gmx.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Statistics of the /proc/kpageflags bits of the present pages of mappings
+# and processes (needs root permissions)
+
+import logging
+import pagemap
+import smaps
+import sys
+
+try:
+    import numpy
+except ImportError:
+    print("needs numpy (available on PyPi)")
+    sys.exit(1)
+
+lh = logging.getLogger(__name__)
+info    = lh.info
+debug   = lh.debug
+error   = lh.error
+warning = lh.warning
+
+PI = pagemap.PageInfo
+
+
+class FlagStats:
+    '''
+        counts the KPF_* bits of a set of pages, all counts in pages
+    '''
+    pagecount = 0    # number of counted pages
+    bitcounts = None # numpy array, number of pages with each of the 64 bits set
+
+    def __init__(self):
+        self.bitcounts = numpy.zeros(64, dtype=numpy.int64)
+
+
+    def addFlags(self, pageflags, pagecounts = None):
+        '''
+            counts the given kpageflags words
+            pageflags  -- numpy uint64 array
+            pagecounts -- optional numpy array with the number of pages each
+                          word stands for (e.g. the pages of a huge page)
+
+            the words only take a few distinct values, so the bits are
+            counted on the unique values weighted by their frequency
+        '''
+        if len(pageflags) == 0:
+            return
+        if pagecounts is None:
+            values, counts = numpy.unique(pageflags, return_counts=True)
+        else:
+            values, inverse = numpy.unique(pageflags, return_inverse=True)
+            counts = numpy.bincount(inverse, weights=pagecounts).astype(numpy.int64)
+        # bit n of the words is column n after reversing the bits of each
+        # little endian byte
+        bits = numpy.unpackbits(values.astype("<u8").view(numpy.uint8).reshape(-1, 8)[:, :, None], axis=2)[:, :, ::-1]
+        self.bitcounts += numpy.dot(counts, bits.reshape(-1, 64).astype(numpy.int64))
+        self.pagecount += int(counts.sum())
+
+
+    def addPageInfoArray(self, pia):
+        '''
+            counts the flags of the present pages of a PageInfoArray, does
+            nothing if the page flags are not available
+        '''
+        if pia.pageflags is not None:
+            self.addFlags(pia.pageflags[pia.getPFNIndices()])
+
+
+    def addCompoundPageArray(self, cpa):
+        '''
+            like addPageInfoArray but every record counts with the number of
+            pages it stands for, the flags of the tail pages of a huge page
+            are the ones of its head with KPF_COMPOUND_TAIL instead of
+            KPF_COMPOUND_HEAD
+        '''
+        if cpa.pageflags is None:
+            return
+        indices = cpa.getPFNIndices()
+        self.addFlags(cpa.pageflags[indices])
+        huge = cpa.getHugeIndices()
+        if len(huge):
+            tailflags = (cpa.pageflags[huge] & ~numpy.uint64(1 << PI.KPF_COMPOUND_HEAD)) | numpy.uint64(1 << PI.KPF_COMPOUND_TAIL)
+            self.addFlags(tailflags, cpa.pagecounts[huge] - 1)
+
+
+    def add(self, other):
+        '''
+            adds the counts of another FlagStats instance
+        '''
+        self.pagecount += other.pagecount
+        self.bitcounts += other.bitcounts
+
+
+    def getCount(self, bit):
+        '''
+            returns the number of pages with the given KPF_* bit set
+        '''
+        return int(self.bitcounts[bit])
+
+
+    def getFlagCounts(self):
+        '''
+            returns a list of (name, count) for all flags set in any page
+        '''
+        return [(name, self.getCount(bit)) for bit, name in PI.KPF_NAMES if self.bitcounts[bit]]
+
+
+    def getSummary(self):
+        '''
+            returns a dict with the totals of the commonly needed flags
+        '''
+        return {"pages"         : self.pagecount,
+                "thp"           : self.getCount(PI.KPF_THP),      # pages backed by transparent huge pages
+                "hugetlb"       : self.getCount(PI.KPF_HUGE),     # pages backed by hugetlbfs
+                "ksm"           : self.getCount(PI.KPF_KSM),      # pages merged by KSM
+                "compoundheads" : self.getCount(PI.KPF_COMPOUND_HEAD),
+                "compoundtails" : self.getCount(PI.KPF_COMPOUND_TAIL),
+                "dirty"         : self.getCount(PI.KPF_DIRTY),
+                "writeback"     : self.getCount(PI.KPF_WRITEBACK),
+                "unevictable"   : self.getCount(PI.KPF_UNEVICTABLE),
+                "anon"          : self.getCount(PI.KPF_ANON),
+                "swapbacked"    : self.getCount(PI.KPF_SWAPBACKED),
+                "zeropage"      : self.getCount(PI.KPF_ZERO_PAGE),
+               }
+
+
+    def getTHPCoverage(self):
+        '''
+            returns the fraction of the counted pages backed by transparent
+            huge pages
+        '''
+        if self.pagecount == 0:
+            return 0.0
+        return float(self.getCount(PI.KPF_THP)) / self.pagecount
+
+
+    def __repr__(self):
+        return "<FlagStats pages:%d %s>" % (self.pagecount, " ".join("%s:%d" % fc for fc in self.getFlagCounts()))
+
+
+
+def getMappingFlagStats(pm, me):
+    '''
+        returns the FlagStats of one mapping
+        pm -- PageMap instance of the process
+        me -- MapEntry of the mapping
+
+        the flags of a transparent or hugetlb huge page are only read once
+        for all its pages
+    '''
+    fs = FlagStats()
+    for cpa in pm.iterCompoundPageArrays(me.startaddress, me.stopaddress):
+        fs.addCompoundPageArray(cpa)
+    return fs
+
+
+
+def getProcessFlagStats(pid, maplist = None):
+    '''
+        returns a tuple (mappingstats, total) with a list of (MapEntry,
+        FlagStats) per mapping and the FlagStats of the whole process
+        pid     -- pid as a decimal number
+        maplist -- list of MapEntry instances, default is all mappings
+    '''
+    if maplist is None:
+        maplist = smaps.Maps(pid).maplist
+    pm = pagemap.PageMap(pid)
+
+    total = FlagStats()
+    mappingstats = []
+    for me in maplist:
+        # vsyscall is above the task virtual address space so pagemap
+        # does not return anything for it
+        if me.name == "[vsyscall]":
+            continue
+        fs = getMappingFlagStats(pm, me)
+        total.add(fs)
+        mappingstats.append((me, fs))
+    return mappingstats, total
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2013, Carsten Juttner <carjay@gmx.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Fragmentation of mappings: statistics of the runs of present pages and of
+# the holes between them, computed batch by batch from the pagemap
+
+import logging
+import pagemap
+import sys
+
+try:
+    import numpy
+except ImportError:
+    print("needs numpy (available on PyPi)")
+    sys.exit(1)
+
+lh = logging.getLogger(__name__)
+info    = lh.info
+debug   = lh.debug
+error   = lh.error
+warning = lh.warning
+
+# histogram bucket n holds the runs of 2**n to 2**(n+1)-1 pages
+HISTOGRAM_BUCKETS = 64
+
+
+def _getBuckets(lengths):
+    '''
+        private helper returning the power of two histogram of run lengths
+    '''
+    buckets = numpy.zeros(len(lengths), dtype=numpy.intp)
+    # floor(log2(n)) without float rounding issues for big n
+    remaining = lengths.astype(numpy.int64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        big = remaining >= (1 << shift)
+        buckets[big]   += shift
+        remaining[big] >>= shift
+    return numpy.bincount(buckets, minlength=HISTOGRAM_BUCKETS)
+
+
+
+class Fragmentation:
+    '''
+        collects run and hole statistics of the present pages of an address
+        range, the pages are passed in address order with add() and the
+        statistics are complete after finish()
+
+        a hole is a run of not present pages between two present runs, the
+        not present pages before the first and after the last present page
+        are counted as leading and trailing gap
+    '''
+    pagecount     = 0
+    presentcount  = 0
+    runcount      = 0    # number of runs of present pages
+    holecount     = 0
+    largestrun    = 0    # pages
+    largesthole   = 0
+    leadinggap    = 0
+    trailinggap   = 0
+    runhistogram  = None # numpy array, see HISTOGRAM_BUCKETS
+    holehistogram = None
+
+    def __init__(self):
+        self.runhistogram  = numpy.zeros(HISTOGRAM_BUCKETS, dtype=numpy.int64)
+        self.holehistogram = numpy.zeros(HISTOGRAM_BUCKETS, dtype=numpy.int64)
+        self._pending  = None # (present, length) of the run continuing into the next batch
+        self._finished = False
+
+
+    def add(self, present):
+        '''
+            adds the next pages
+            present -- numpy bool array, True for present pages
+        '''
+        if len(present) == 0:
+            return
+        present = numpy.asarray(present, dtype=bool)
+        starts  = numpy.concatenate(([0], numpy.flatnonzero(present[1:] != present[:-1]) + 1))
+        values  = present[starts]
+        lengths = numpy.diff(numpy.concatenate((starts, [len(present)])))
+
+        if self._pending is not None:
+            if self._pending[0] == values[0]:
+                lengths[0] += self._pending[1]
+            else:
+                values  = numpy.concatenate(([self._pending[0]], values))
+                lengths = numpy.concatenate(([self._pending[1]], lengths))
+
+        # the last run may continue in the next batch
+        self._addRuns(values[:-1], lengths[:-1])
+        self._pending = (bool(values[-1]), int(lengths[-1]))
+        self.pagecount    += len(present)
+        self.presentcount += int(numpy.count_nonzero(present))
+
+
+    def addPageInfoArray(self, pia):
+        '''
+            adds the pages of a PageInfoArray
+        '''
+        self.add(pia.present)
+
+
+    def _addRuns(self, values, lengths):
+        '''
+            private helper adding completed runs
+        '''
+        if len(values) == 0:
+            return
+        runlengths = lengths[values]
+        gaplengths = lengths[~values]
+        if not values[0] and self.runcount == 0:
+            # nothing present before, so this is no hole
+            self.leadinggap = int(gaplengths[0])
+            gaplengths = gaplengths[1:]
+
+        if len(runlengths):
+            self.runcount += len(runlengths)
+            self.largestrun = max(self.largestrun, int(runlengths.max()))
+            self.runhistogram += _getBuckets(runlengths)
+        if len(gaplengths):
+            self.holecount += len(gaplengths)
+            self.largesthole = max(self.largesthole, int(gaplengths.max()))
+            self.holehistogram += _getBuckets(gaplengths)
+
+
+    def finish(self):
+        '''
+            completes the statistics after the last add()
+        '''
+        if self._finished:
+            return
+        self._finished = True
+        if self._pending is None:
+            return
+        present, length = self._pending
+        self._pending = None
+        if present:
+            self._addRuns(numpy.array([True]), numpy.array([length]))
+        elif self.runcount == 0:
+            self.leadinggap = length
+        else:
+            self.trailinggap = length
+
+
+    def getSpan(self):
+        '''
+            returns the number of pages from the first to the last present
+            page
+        '''
+        return self.pagecount - self.leadinggap - self.trailinggap if self.presentcount else 0
+
+
+    def getDensity(self):
+        '''
+            returns the fraction of present pages within the span
+        '''
+        span = self.getSpan()
+        return float(self.presentcount) / span if span else 0.0
+
+
+    def getFragmentation(self):
+        '''
+            returns 1 - largestrun / presentcount: 0 if all present pages
+            are one run and close to 1 if they are scattered
+        '''
+        if self.presentcount == 0:
+            return 0.0
+        return 1.0 - float(self.largestrun) / self.presentcount
+
+
+    def getMeanRun(self):
+        '''
+            returns the average length of the present runs in pages
+        '''
+        return float(self.presentcount) / self.runcount if self.runcount else 0.0
+
+
+    def getMeanHole(self):
+        '''
+            returns the average length of the holes in pages
+        '''
+        holepages = self.getSpan() - self.presentcount
+        return float(holepages) / self.holecount if self.holecount else 0.0
+
+
+    def __repr__(self):
+        return "<Fragmentation pages:%d present:%d runs:%d holes:%d largestrun:%d largesthole:%d density:%.3f fragmentation:%.3f>" % (
+                self.pagecount, self.presentcount, self.runcount, self.holecount, self.largestrun, self.largesthole,
+                self.getDensity(), self.getFragmentation())
+
+
+
+def analyzeMapping(pm, startaddress, stopaddress, pagesize = pagemap.PAGESIZE):
+    '''
+        returns the finished Fragmentation of an address range
+        pm -- PageMap instance of the process
+    '''
+    frag = Fragmentation()
+    for pia in pm.iterPageInfoArrays(startaddress, stopaddress, pagesize, kpageinfo = False):
+        frag.addPageInfoArray(pia)
+    frag.finish()
+    return frag
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2013, Carsten Juttner <carjay@gmx.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Per-stage instrumentation of the procfs readers. The code marks its stages
+# with
+#
+#     with instrument.stage("smaps.read") as st:
+#         ...
+#         st.add(bytes = n, syscalls = 2)
+#
+# which records wall and CPU time, bytes, I/O calls and pages per stage name.
+# While instrumentation is disabled stage() hands out a shared object that
+# does nothing, so the cost is one function call per stage.
+
+import json
+import logging
+import os
+import threading
+import time
+
+lh = logging.getLogger(__name__)
+info    = lh.info
+debug   = lh.debug
+error   = lh.error
+warning = lh.warning
+
+
+enabled = False
+
+_lock      = threading.Lock()
+_hooks     = []
+_totals    = {}   # stage name -> StageTotals
+_local     = threading.local()
+_starttime = None # time of enable()
+
+
+def _getCPUTime():
+    '''
+        private helper returning the user + system CPU time of the process,
+        the system time includes the kernel generating the procfs files
+        (time.clock has a finer resolution than os.times on linux)
+    '''
+    return time.clock()
+
+
+
+class Stage:
+    '''
+        one execution of a stage, passed to the hooks
+    '''
+    name      = None
+    parent    = None # name of the enclosing stage of the same thread or None
+    depth     = 0    # nesting level, 0 for outermost stages
+    starttime = None
+    walltime  = 0.0  # seconds, set when the stage ends
+    cputime   = 0.0  # seconds of the whole process, includes other threads
+    bytes     = 0    # bytes read from or written to files
+    syscalls  = 0    # I/O calls (open, seek, read, write, ioctl) issued
+    pages     = 0    # pages processed
+
+    def __init__(self, name):
+        self.name = name
+
+
+    def add(self, bytes = 0, syscalls = 0, pages = 0):
+        '''
+            adds to the counters of the stage
+        '''
+        self.bytes    += bytes
+        self.syscalls += syscalls
+        self.pages    += pages
+
+
+    def __enter__(self):
+        stack = getattr(_local, "stack", None)
+        if stack is None:
+            stack = _local.stack = []
+        if stack:
+            self.parent = stack[-1].name
+            self.depth  = len(stack)
+        stack.append(self)
+        for hook in _hooks:
+            hook("begin", self)
+        self.starttime = time.time()
+        self._startcpu = _getCPUTime()
+        return self
+
+
+    def __exit__(self, exctype, excvalue, traceback):
+        self.walltime = time.time() - self.starttime
+        self.cputime  = _getCPUTime() - self._startcpu
+        _local.stack.pop()
+        with _lock:
+            totals = _totals.get(self.name)
+            if totals is None:
+                totals = _totals[self.name] = StageTotals(self.name)
+            totals.addStage(self)
+        for hook in _hooks:
+            hook("end", self)
+        return False
+
+
+    def __repr__(self):
+        return "<Stage %s wall:%.6f cpu:%.6f bytes:%d syscalls:%d pages:%d>" % (self.name, self.walltime, self.cputime,
+                                                                                self.bytes, self.syscalls, self.pages)
+
+
+
+class _NullStage:
+    '''
+        private stand-in for Stage while instrumentation is disabled
+    '''
+    def add(self, bytes = 0, syscalls = 0, pages = 0):
+        pass
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exctype, excvalue, traceback):
+        return False
+
+
+_NULLSTAGE = _NullStage()
+
+
+
+class StageTotals:
+    '''
+        accumulated counters of all executions of one stage, nested stages
+        are also included in the times of their parents
+    '''
+    name     = None
+    calls    = 0
+    walltime = 0.0
+    cputime  = 0.0
+    bytes    = 0
+    syscalls = 0
+    pages    = 0
+
+    def __init__(self, name):
+        self.name = name
+
+
+    def addStage(self, st):
+        self.calls    += 1
+        self.walltime += st.walltime
+        self.cputime  += st.cputime
+        self.bytes    += st.bytes
+        self.syscalls += st.syscalls
+        self.pages    += st.pages
+
+
+    def getDict(self):
+        '''
+            returns the counters as dict
+        '''
+        return {"calls"    : self.calls,
+                "wall"     : self.walltime,
+                "cpu"      : self.cputime,
+                "bytes"    : self.bytes,
+                "syscalls" : self.syscalls,
+                "pages"    : self.pages}
+
+
+
+def stage(name):
+    '''
+        returns a context manager measuring one execution of the stage name,
+        a do-nothing one while instrumentation is disabled
+    '''
+    if not enabled:
+        return _NULLSTAGE
+    return Stage(name)
+
+
+
+def enable():
+    '''
+        starts recording, the totals of an earlier recording are kept
+    '''
+    global enabled, _starttime
+    if _starttime is None:
+        _starttime = time.time()
+    enabled = True
+
+
+
+def disable():
+    '''
+        stops recording, stages already running are still completed
+    '''
+    global enabled
+    enabled = False
+
+
+
+def reset():
+    '''
+        drops all totals
+    '''
+    global _starttime
+    with _lock:
+        _totals.clear()
+        _starttime = time.time() if enabled else None
+
+
+
+def addHook(hook):
+    '''
+        registers a callable that is called as hook(event, stage) with event
+        "begin" when a stage starts and "end" when it finished, stage is the
+        Stage instance. Hooks run in the thread executing the stage.
+    '''
+    _hooks.append(hook)
+
+
+
+def removeHook(hook):
+    '''
+        unregisters a hook added with addHook
+    '''
+    _hooks.remove(hook)
+
+
+
+def getTotals():
+    '''
+        returns a dict of stage name -> StageTotals (copies)
+    '''
+    with _lock:
+        ret = {}
+        for name, totals in _totals.iteritems():
+            copy = StageTotals(name)
+            copy.__dict__.update(totals.__dict__)
+            ret[name] = copy
+        return ret
+
+
+
+def getSummary():
+    '''
+        returns the totals as a dict that can be serialized as JSON
+    '''
+    return {"wall"   : time.time() - _starttime if _starttime is not None else 0.0,
+            "pid"    : os.getpid(),
+            "stages" : dict((name, totals.getDict()) for name, totals in getTotals().iteritems())}
+
+
+
+def writeSummary(fh):
+    '''
+        writes getSummary() as JSON to a file handle
+    '''
+    json.dump(getSummary(), fh, indent = 1, sort_keys = True, separators = (",", ": "))
+    fh.write("\n")
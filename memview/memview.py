@@ -20,18 +20,34 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import argparse
+import flagstats
+import fragmentation
+import instrument
 import logging
 import os
 import pagemap
+import render
 import smaps
+import snapshot
 import struct
 import sys
+import time
+import watch
+import workingset
+
+try:
+    import numpy
+except ImportError:
+    print("needs numpy (available on PyPi)")
+    sys.exit(1)
 
 
 lg = logging.getLogger("memview")
 info = lg.info
 logging.basicConfig(level = logging.DEBUG)
 
+
 def getHumanReadableSize(size):
     '''
         return human readable size as string
@@ -49,14 +65,262 @@ def getHumanReadableSize(size):
 
 
 
-def main():
-    if len(sys.argv) > 1:
-        pid = int(sys.argv[1])
+def showProcess(pid, maplist, workers):
+    '''
+        print page statistics of all mappings of a process, the pagemap is
+        read in parallel by the given number of threads
+    '''
+    # vsyscall is above the task virtual address space so pagemap
+    # does not return anything for it
+    maplist = [me for me in maplist if me.name != "[vsyscall]"]
+
+    pm = pagemap.PageMap(pid)
+    pagesize = pagemap.PAGESIZE
+    ranges = [(me.startaddress, me.stopaddress, pagesize) for me in maplist]
+    pagecounts = pm.scanMappings(ranges, workers)
+
+    total = pagemap.PageCounts()
+    totalsize   = 0
+    presentsize = 0
+    swapsize    = 0
+    for me, pc in zip(maplist, pagecounts):
+        print("%x-%x %-40s %10s total %10s present %10s swapped" % (me.startaddress, me.stopaddress, "'%s'" % me.name,
+                                                                    getHumanReadableSize(pc.pagecount * pagesize),
+                                                                    getHumanReadableSize(pc.presentcount * pagesize),
+                                                                    getHumanReadableSize(pc.swappedcount * pagesize)))
+        total.add(pc)
+        totalsize   += pc.pagecount * pagesize
+        presentsize += pc.presentcount * pagesize
+        swapsize    += pc.swappedcount * pagesize
+
+    print("process %d: %d mappings, %d pages (%s), %d present (%s), %d swapped (%s)" % (pid, len(maplist),
+                                                                                      total.pagecount, getHumanReadableSize(totalsize),
+                                                                                      total.presentcount, getHumanReadableSize(presentsize),
+                                                                                      total.swappedcount, getHumanReadableSize(swapsize)
+                                                                                      ))
+
+
+
+def showSampledProcess(pid, maplist, errorbound, timebudget):
+    '''
+        print estimates of the present and swapped pages of all mappings of a
+        process from a sample of the pagemap
+    '''
+    # vsyscall is above the task virtual address space so pagemap
+    # does not return anything for it
+    maplist = [me for me in maplist if me.name != "[vsyscall]"]
+    if timebudget is not None:
+        timebudget = timebudget / max(1, len(maplist))
+
+    pm = pagemap.PageMap(pid)
+    pagesize = pagemap.PAGESIZE
+    totalpresent = 0.0
+    totalswapped = 0.0
+    sampled = 0
+    for me in maplist:
+        ps = pm.samplePages(me.startaddress, me.stopaddress, pagesize, errorbound, timebudget)
+        present, presenterr = ps.getPageEstimate("present")
+        swapped, swappederr = ps.getPageEstimate("swapped")
+        totalpresent += present
+        totalswapped += swapped
+        sampled += ps.samplecount
+        print("%x-%x %-40s %10s total %10s +- %-10s present %10s +- %-10s swapped%s" % (me.startaddress, me.stopaddress, "'%s'" % me.name,
+                getHumanReadableSize(ps.pagecount * pagesize),
+                getHumanReadableSize(present * pagesize), getHumanReadableSize(presenterr * pagesize),
+                getHumanReadableSize(swapped * pagesize), getHumanReadableSize(swappederr * pagesize),
+                " (exact)" if ps.exact else ""))
+
+    print("process %d: %d mappings, about %s present, %s swapped (%d pages read)" % (pid, len(maplist),
+            getHumanReadableSize(totalpresent * pagesize), getHumanReadableSize(totalswapped * pagesize), sampled))
+
+
+
+def showFlagStats(pid, maplist):
+    '''
+        print the page flag statistics of the given mappings of a process
+    '''
+    pagesize = pagemap.PAGESIZE
+    mappingstats, total = flagstats.getProcessFlagStats(pid, maplist)
+    print("%-33s %-40s %10s %6s %10s %10s %10s %10s %10s" % ("mapping", "name", "present", "thp", "ksm", "dirty",
+                                                              "writeback", "unevict", "compound"))
+    for me, fs in mappingstats + [(None, total)]:
+        if not fs.pagecount:
+            continue
+        summary = fs.getSummary()
+        if me is None:
+            mapping, name = "process %d" % pid, ""
+        else:
+            mapping, name = "%x-%x" % (me.startaddress, me.stopaddress), "'%s'" % me.name
+        print("%-33s %-40s %10s %5.1f%% %10s %10s %10s %10s %5d/%-5d" % (mapping, name,
+                getHumanReadableSize(fs.pagecount * pagesize), 100.0 * fs.getTHPCoverage(),
+                getHumanReadableSize(summary["ksm"] * pagesize), getHumanReadableSize(summary["dirty"] * pagesize),
+                getHumanReadableSize(summary["writeback"] * pagesize), getHumanReadableSize(summary["unevictable"] * pagesize),
+                summary["compoundheads"], summary["compoundtails"]))
+
+    print("page flags of process %d:" % pid)
+    for name, count in total.getFlagCounts():
+        print("  %-14s %8d pages (%s)" % (name, count, getHumanReadableSize(count * pagesize)))
+
+
+
+def showFragmentation(pid, maplist):
+    '''
+        print the fragmentation of the [heap] and the anonymous mappings of a
+        process
+    '''
+    pagesize = pagemap.PAGESIZE
+    pm = pagemap.PageMap(pid)
+    for me in maplist:
+        if me.name != "[heap]" and (me.name or me.inode):
+            continue
+        frag = fragmentation.analyzeMapping(pm, me.startaddress, me.stopaddress, pagesize)
+        if not frag.presentcount:
+            continue
+        print("%x-%x '%s' %s:" % (me.startaddress, me.stopaddress, me.name, getHumanReadableSize(frag.pagecount * pagesize)))
+        print("  %d present in %d runs (mean %.1f, largest %s), %d holes (mean %.1f, largest %s)" % (
+                frag.presentcount, frag.runcount, frag.getMeanRun(), getHumanReadableSize(frag.largestrun * pagesize),
+                frag.holecount, frag.getMeanHole(), getHumanReadableSize(frag.largesthole * pagesize)))
+        print("  density %.1f%% of %s span, fragmentation %.3f, leading gap %s, trailing gap %s" % (
+                100.0 * frag.getDensity(), getHumanReadableSize(frag.getSpan() * pagesize), frag.getFragmentation(),
+                getHumanReadableSize(frag.leadinggap * pagesize), getHumanReadableSize(frag.trailinggap * pagesize)))
+        for bucket in range(fragmentation.HISTOGRAM_BUCKETS):
+            runs, holes = frag.runhistogram[bucket], frag.holehistogram[bucket]
+            if runs or holes:
+                print("    %10d-%-10d pages: %8d runs %8d holes" % (1 << bucket, (2 << bucket) - 1, runs, holes))
+
+
+
+def showWatchSample(watcher, added, removed, rescanned):
+    '''
+        print the changes of one Watcher sample
+    '''
+    pagesize = pagemap.PAGESIZE
+    total = pagemap.PageCounts()
+    for history in watcher.mappings.itervalues():
+        total.add(history.getLatest().pagecounts)
+
+    print("%s: %d mappings (%d added, %d removed, %d rescanned), %s present, %s swapped" % (
+            time.strftime("%H:%M:%S"), len(watcher.mappings), len(added), len(removed), len(rescanned),
+            getHumanReadableSize(total.presentcount * pagesize), getHumanReadableSize(total.swappedcount * pagesize)))
+
+    # mappings that were just added have nothing to compare with
+    for key in sorted(set(rescanned) - set(added)):
+        history = watcher.mappings[key]
+        pc = history.getLatest().pagecounts
+        if len(history.samples) > 1:
+            delta = pc.presentcount - history.samples[-2].pagecounts.presentcount
+        else:
+            delta = pc.presentcount
+        print("  %x-%x %-40s %10s present (%+d pages)" % (key[0], key[1], "'%s'" % history.mapentry.name,
+                                                         getHumanReadableSize(pc.presentcount * pagesize), delta))
+
+
+
+def showWorkingSet(ws, result):
+    '''
+        print the working set of one interval
+    '''
+    pagesize = pagemap.PAGESIZE
+    for mws in result:
+        if not mws.presentcount and not mws.writtencount:
+            continue
+        if mws.touchedcount is None:
+            touched = "-"
+        else:
+            touched = getHumanReadableSize(mws.touchedcount * pagesize)
+        print("  %x-%x %-40s %10s present %10s written %10s touched" % (mws.key[0], mws.key[1], "'%s'" % mws.name,
+                                                                       getHumanReadableSize(mws.presentcount * pagesize),
+                                                                       getHumanReadableSize(mws.writtencount * pagesize),
+                                                                       touched))
+
+    present = sum(mws.presentcount for mws in result)
+    written = sum(mws.writtencount for mws in result)
+    if ws.idletracking:
+        touched = getHumanReadableSize(sum(mws.touchedcount for mws in result) * pagesize)
     else:
-        pid = os.getpid()
+        touched = "-"
+    print("%s: %s present, %s written, %s touched" % (time.strftime("%H:%M:%S"), getHumanReadableSize(present * pagesize),
+                                                      getHumanReadableSize(written * pagesize), touched))
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "show the page state of the mappings of a process")
+    parser.add_argument("pid", nargs = '?', type = int, default = os.getpid(), help = "process id (default: own process)")
+    parser.add_argument("-a", "--all", action = "store_true", help = "scan all mappings instead of only [heap]")
+    parser.add_argument("-j", "--jobs", type = int, default = pagemap.PAGEMAP_SCAN_WORKERS, help = "number of threads reading the pagemap with --all")
+    parser.add_argument("-w", "--watch", type = float, metavar = "SECONDS", help = "sample all mappings every SECONDS and show the changes")
+    parser.add_argument("-c", "--count", type = int, default = None, help = "number of samples with --watch or intervals with --workingset (default: endless)")
+    parser.add_argument("--history", type = int, default = 60, help = "number of samples kept per mapping with --watch")
+    parser.add_argument("--workingset", type = float, metavar = "SECONDS", help = "show the pages written to and touched every SECONDS")
+    parser.add_argument("-f", "--flags", action = "store_true", help = "show page flag statistics (THP, KSM, dirty, ...) instead of the draw map")
+    parser.add_argument("--frag", action = "store_true", help = "show the fragmentation of [heap] and the anonymous mappings")
+    parser.add_argument("--sample", type = float, metavar = "ERROR", help = "with --all estimate the page counts from a pagemap sample, "
+                                                                           "ERROR is the wanted error of the present fraction (e.g. 0.01)")
+    parser.add_argument("--budget", type = float, metavar = "SECONDS", help = "time budget of --sample for all mappings together")
+    parser.add_argument("-r", "--rows", type = int, default = None, help = "downsample the [heap] draw map to at most ROWS lines")
+    parser.add_argument("-s", "--save", metavar = "FILE", help = "save a snapshot of all mappings to FILE")
+    parser.add_argument("--stats", metavar = "FILE", help = "write the time, I/O and pages of each stage as JSON to FILE ('-' for stdout)")
+    args = parser.parse_args()
+
+    if args.stats:
+        instrument.enable()
+    try:
+        with instrument.stage("memview.main"):
+            runCommand(args)
+    finally:
+        if args.stats:
+            if args.stats == '-':
+                instrument.writeSummary(sys.stdout)
+            else:
+                with open(args.stats, 'wb') as fh:
+                    instrument.writeSummary(fh)
+
 
-    # retrieve all process mapping information
-    s = smaps.SMaps(pid)
+
+def runCommand(args):
+    '''
+        runs the command selected by the parsed arguments of main
+    '''
+    pid = args.pid
+
+    if args.watch:
+        w = watch.Watcher(pid, args.history, args.jobs)
+        w.run(args.watch, args.count, showWatchSample)
+        return
+
+    if args.workingset:
+        ws = workingset.WorkingSet(pid)
+        ws.run(args.workingset, args.count, showWorkingSet)
+        return
+
+    # the mapping headers are all that is needed, so avoid the page table
+    # walk of the full smaps
+    with instrument.stage("memview.smaps"):
+        s = smaps.Maps(pid)
+
+    if args.save:
+        count = snapshot.saveSnapshot(args.save, pid, s.maplist)
+        print("saved %d mappings of process %d to '%s'" % (count, pid, args.save))
+        return
+
+    if args.frag:
+        showFragmentation(pid, s.maplist)
+        return
+
+    if args.flags:
+        if args.all:
+            showFlagStats(pid, s.maplist)
+        else:
+            showFlagStats(pid, [me for me in s.maplist if me.name == "[heap]"])
+        return
+
+    if args.all:
+        if args.sample or args.budget:
+            showSampledProcess(pid, s.maplist, args.sample, args.budget)
+        else:
+            showProcess(pid, s.maplist, args.jobs)
+        return
 
     # look for the [heap] mapping
     for me in s.maplist:
@@ -68,10 +332,9 @@ def main():
         if me.name != "[heap]":
             continue
 
-        print "mapping %x-%x '%s' %s:" % (me.startaddress, me.stopaddress, me.name, getHumanReadableSize(me.size))
+        print "mapping %x-%x '%s' %s:" % (me.startaddress, me.stopaddress, me.name, getHumanReadableSize(me.stopaddress - me.startaddress))
         
-        # hm, how does this relate to mmupagesize...
-        pagesize = me.kernelpagesize
+        pagesize = pagemap.PAGESIZE
         
         # there me.size but I've seen it differ from the actual address range
         totalcnt   = 0
@@ -79,48 +342,55 @@ def main():
         swapcnt    = 0
 
         pm = pagemap.PageMap(pid)
-        
-        pageinfolist = pm.getPageInfo(me.startaddress, me.stopaddress, pagesize)
-        totalcnt = len(pageinfolist)
 
-        drawmap = [] # '.' = not mapped 'x' = active 's' = swapped
+        def printLines(lines):
+            for pageindex, mapstr, repeat in lines:
+                print("0x%08x: %s" % (me.startaddress + pageindex * pagesize, mapstr))
+                if repeat > 1:
+                    print("%10s  ... %d identical lines" % ("", repeat - 1))
 
-        for pi in pageinfolist:
-            if pi.present:
-                presentcnt += 1
-                if pi.swapped:
-                    swapcnt += 1
-                    drawmap.append('s')
+        # draw map, the page states are collected run-length encoded
+        width = 80
+        if args.rows:
+            # the cell size depends on the whole mapping, so it is collected
+            # completely before drawing
+            drawmap = render.DrawMap()
+        else:
+            # '.' = not mapped 'x' = active 's' = swapped, finished lines are
+            # printed while the mapping is read
+            linestream = render.LineStream(width)
+        for pia in pm.iterPageInfoArrays(me.startaddress, me.stopaddress, pagesize, kpageinfo = False):
+            totalcnt   += len(pia)
+            presentcnt += pia.getPresentCount()
+            swapcnt    += pia.getSwappedCount()
+            with instrument.stage("memview.render") as st:
+                if args.rows:
+                    drawmap.add(render.getPageStates(pia))
                 else:
-                    drawmap.append('x')
+                    printLines(linestream.add(render.getPageStates(pia)))
+                st.add(pages = len(pia))
+
+        with instrument.stage("memview.render"):
+            if args.rows:
+                # '.' = not mapped 'X' = present 'S' = swapped, mixed: 'x'/'s' mostly present/swapped ':' sparse
+                print("  %d pages per character" % drawmap.getPagesPerCell(width, args.rows))
+                printLines(drawmap.iterCells(width, args.rows))
             else:
-                drawmap.append('.')
-               
+                printLines(linestream.finish())
             
-        #print "present:%s swapped:%s pfn:%s swaptype:%s swapoffset:%s pgshift:%s reserved:%s" % (pi.present, pi.swapped, pi.pfn, pi.swaptype, pi.swapoffset, pi.pgshift, pi.reserved)
+        #print "present:%s swapped:%s pfn:%s swaptype:%s swapoffset:%s softdirty:%s file:%s" % (pi.present, pi.swapped, pi.pfn, pi.swaptype, pi.swapoffset, pi.softdirty, pi.file)
             
         totalsize     = totalcnt * pagesize
         presentsize   = presentcnt * pagesize
-        notmappedsize = (totalcnt - presentcnt) * pagesize
+        notmappedcnt  = totalcnt - presentcnt - swapcnt
+        notmappedsize = notmappedcnt * pagesize
         swapsize      = swapcnt * pagesize
 
         print ("  %d pages (%s), %d present (%s), %d not mapped (%s), %d swapped (%s)" % (totalcnt, getHumanReadableSize(totalsize),
                                                                                         presentcnt, getHumanReadableSize(presentsize),
-                                                                                        totalcnt - presentcnt, getHumanReadableSize(notmappedsize),
+                                                                                        notmappedcnt, getHumanReadableSize(notmappedsize),
                                                                                         swapcnt, getHumanReadableSize(swapsize)
                                                                                         ))
-        # draw map
-        width = 80
-        pg    = len(drawmap) / width
-        pgrem = len(drawmap) % width
-        
-        for idx in range(pg):
-            mapstr = ''.join(drawmap[idx*width:(idx+1)*width])
-            print("0x%08x: %s" % (me.startaddress + (idx*width*pagesize), mapstr))
-        
-        if pgrem > 0:
-            mapstr = ''.join(drawmap[pg*width:])
-            print("0x%08x: %s" % (me.startaddress + (pg*width*pagesize), mapstr))
         
         #for pi in pageinfolist:
         #    print pi
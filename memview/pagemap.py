@@ -20,9 +20,23 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import ctypes
 import errno
+import fcntl
+import instrument
 import logging
+import math
+import os
+import smaps
 import struct
+import time
+
+from multiprocessing.pool import ThreadPool
+
+try:
+    import numpy
+except ImportError:
+    numpy = None # only needed for PageInfoArray
 
 lh = logging.getLogger(__name__)
 info    = lh.info
@@ -42,8 +56,10 @@ class PageInfo:
     pfn         = None
     swaptype    = None
     swapoffset  = None
-    pgshift     = None
-    reserved    = None
+    softdirty   = None
+    exclusive   = None
+    uffdwp      = None
+    file        = None
 
     # extra info that requires root permissions
     mapcount    = None
@@ -73,6 +89,38 @@ class PageInfo:
     KPF_NOPAGE        = 20
     KPF_KSM           = 21
     KPF_THP           = 22
+    KPF_OFFLINE       = 23
+    KPF_ZERO_PAGE     = 24
+    KPF_IDLE          = 25
+    KPF_PGTABLE       = 26
+
+    KPF_NAMES = ((KPF_LOCKED,        "LOCKED"),
+                 (KPF_ERROR,         "ERROR"),
+                 (KPF_REFERENCED,    "REFERENCED"),
+                 (KPF_UPTODATE,      "UPTODATE"),
+                 (KPF_DIRTY,         "DIRTY"),
+                 (KPF_LRU,           "LRU"),
+                 (KPF_ACTIVE,        "ACTIVE"),
+                 (KPF_SLAB,          "SLAB"),
+                 (KPF_WRITEBACK,     "WRITEBACK"),
+                 (KPF_RECLAIM,       "RECLAIM"),
+                 (KPF_BUDDY,         "BUDDY"),
+                 (KPF_MMAP,          "MMAP"),
+                 (KPF_ANON,          "ANON"),
+                 (KPF_SWAPCACHE,     "SWAPCACHE"),
+                 (KPF_SWAPBACKED,    "SWAPBACKED"),
+                 (KPF_COMPOUND_HEAD, "COMPOUND_HEAD"),
+                 (KPF_COMPOUND_TAIL, "COMPOUND_TAIL"),
+                 (KPF_HUGE,          "HUGE"),
+                 (KPF_UNEVICTABLE,   "UNEVICTABLE"),
+                 (KPF_HWPOISON,      "HWPOISON"),
+                 (KPF_NOPAGE,        "NOPAGE"),
+                 (KPF_KSM,           "KSM"),
+                 (KPF_THP,           "THP"),
+                 (KPF_OFFLINE,       "OFFLINE"),
+                 (KPF_ZERO_PAGE,     "ZERO_PAGE"),
+                 (KPF_IDLE,          "IDLE"),
+                 (KPF_PGTABLE,       "PGTABLE"))
     
     def __repr__(self):
         '''
@@ -80,14 +128,21 @@ class PageInfo:
         '''
         s = "<PageInfo virtualaddress:0x%x" % self.virtualaddress
         if self.present:
-            s+= " present shift:%d reserved %d" % (self.pgshift, self.reserved)
-            if self.swapped == 0:
-                s+= " pfn:%d" % (self.pfn)
-            else:
-                s+= " swapped type:%d offset:%d" % (self.swaptype, self.swapoffset)
+            s+= " present pfn:%d" % (self.pfn)
+        elif self.swapped:
+            s+= " swapped type:%d offset:%d" % (self.swaptype, self.swapoffset)
         else:
             s += " not present"
 
+        if self.softdirty:
+            s += " softdirty"
+        if self.exclusive:
+            s += " exclusive"
+        if self.uffdwp:
+            s += " uffdwp"
+        if self.file:
+            s += " file"
+
         if self.mapcount:
             s += " mapcount:%d" % self.mapcount
 
@@ -115,139 +170,1228 @@ class PageInfo:
         #    * Bits 0-54  page frame number (PFN) if present
         #    * Bits 0-4   swap type if swapped
         #    * Bits 5-54  swap offset if swapped
-        #    * Bits 55-60 page shift (page size = 1<<page shift)
-        #    * Bit  61    reserved for future use
+        #    * Bit  55    pte is soft-dirty
+        #    * Bit  56    page exclusively mapped
+        #    * Bit  57    pte is uffd-wp write-protected
+        #    * Bits 58-60 zero (or unused here)
+        #    * Bit  61    page is file-page or shared-anon
         #    * Bit  62    page swapped
         #    * Bit  63    page present
+        # (bits 55-60 used to be the page shift before linux 3.11)
         
-        self.swapped    = None
         self.pfn        = None
         self.swaptype   = None
         self.swapoffset = None
-        self.pgshift    = None
-        self.reserved   = None
 
         self.present            = (val & 0x8000000000000000) >> 63
+        self.swapped            = (val & 0x4000000000000000) >> 62
         if self.present:
-            self.swapped        = (val & 0x4000000000000000) >> 62
-            if self.swapped == 0:
-                self.pfn        = (val & 0x007fffffffffffff) >>  0
-            else:
-                self.swaptype   = (val & 0x000000000000001f) >>  0
-                self.swapoffset = (val & 0x007fffffffffffe0) >>  5
-            self.pgshift        = (val & 0x1f80000000000000) >> 55
-            self.reserved       = (val & 0x2000000000000000) >> 61
+            self.pfn            = (val & 0x007fffffffffffff) >>  0
+        elif self.swapped:
+            self.swaptype       = (val & 0x000000000000001f) >>  0
+            self.swapoffset     = (val & 0x007fffffffffffe0) >>  5
+        self.softdirty          = (val & 0x0080000000000000) >> 55
+        self.exclusive          = (val & 0x0100000000000000) >> 56
+        self.uffdwp             = (val & 0x0200000000000000) >> 57
+        self.file               = (val & 0x2000000000000000) >> 61
     
       
     def getFlagString(self):
         '''
             return human readable string for flags
         '''
-        flags = []
-        if self.pageflags & (1 << self.KPF_LOCKED):
-            flags.append("LOCKED")
-        if self.pageflags & (1 << self.KPF_ERROR):
-            flags.append("ERROR")            
-        if self.pageflags & (1 << self.KPF_REFERENCED):
-            flags.append("REFERENCED")            
-        if self.pageflags & (1 << self.KPF_UPTODATE):
-            flags.append("UPTODATE")            
-        if self.pageflags & (1 << self.KPF_DIRTY):
-            flags.append("DIRTY")            
-        if self.pageflags & (1 << self.KPF_LRU):
-            flags.append("LRU")            
-        if self.pageflags & (1 << self.KPF_ACTIVE):
-            flags.append("ACTIVE")            
-        if self.pageflags & (1 << self.KPF_SLAB):
-            flags.append("SLAB")            
-        if self.pageflags & (1 << self.KPF_WRITEBACK):
-            flags.append("WRITEBACK")            
-        if self.pageflags & (1 << self.KPF_RECLAIM):
-            flags.append("RECLAIM")            
-        if self.pageflags & (1 << self.KPF_BUDDY):
-            flags.append("BUDDY")            
-        if self.pageflags & (1 << self.KPF_MMAP):
-            flags.append("MMAP")            
-        if self.pageflags & (1 << self.KPF_ANON):
-            flags.append("ANON")            
-        if self.pageflags & (1 << self.KPF_SWAPCACHE):
-            flags.append("SWAPCACHE")            
-        if self.pageflags & (1 << self.KPF_SWAPBACKED):
-            flags.append("SWAPBACKED")            
-        if self.pageflags & (1 << self.KPF_COMPOUND_HEAD):
-            flags.append("COMPOUND_HEAD")            
-        if self.pageflags & (1 << self.KPF_COMPOUND_TAIL):
-            flags.append("COMPOUND_TAIL")            
-        if self.pageflags & (1 << self.KPF_HUGE):
-            flags.append("HUGE")            
-        if self.pageflags & (1 << self.KPF_UNEVICTABLE):
-            flags.append("UNEVICTABLE")            
-        if self.pageflags & (1 << self.KPF_HWPOISON):
-            flags.append("HWPOISON")            
-        if self.pageflags & (1 << self.KPF_NOPAGE):
-            flags.append("NOPAGE")            
-        if self.pageflags & (1 << self.KPF_KSM):
-            flags.append("KSM")            
-        if self.pageflags & (1 << self.KPF_THP):
-            flags.append("THP")
+        flags = [name for bit, name in self.KPF_NAMES if self.pageflags & (1 << bit)]
         return ','.join(flags)
 
-    
+
+
+class PageInfoArray:
+    '''
+        holds info about a contiguous range of pages
+
+        the raw values from the procfs pagemap file are kept in a numpy uint64
+        array and decoded as whole columns, this avoids creating one PageInfo
+        instance per page. Indexing or iterating returns PageInfo instances
+        created on demand.
+    '''
+    startaddress = None # virtual address of the first page
+    pagesize     = None # distance between two pages
+    values       = None # raw pagemap values (numpy uint64 array)
+
+    # decoded columns, pfn/swaptype/swapoffset are 0 where they do not apply
+    present     = None # bool
+    swapped     = None # bool
+    pfn         = None
+    swaptype    = None
+    swapoffset  = None
+    softdirty   = None # bool
+    exclusive   = None # bool
+    uffdwp      = None # bool
+    file        = None # bool
+
+    # extra info that requires root permissions, 0 for pages without pfn
+    mapcount    = None
+    pageflags   = None
+
+    def __init__(self, startaddress, pagesize, values):
+        '''
+            initialises PageInfoArray
+            startaddress -- virtual address of the first page
+            pagesize     -- distance between two pages
+            values       -- numpy uint64 array as retrieved from the procfs pagemap
+        '''
+        self.startaddress = startaddress
+        self.pagesize     = pagesize
+        self.setInfo(values)
+
+
+    def __len__(self):
+        return len(self.values)
+
+
+    def __getitem__(self, idx):
+        '''
+            return a PageInfo instance for the page at index idx
+        '''
+        if idx < 0:
+            idx += len(self.values)
+        if idx < 0 or idx >= len(self.values):
+            raise IndexError, "PageInfoArray index out of range"
+        pi = PageInfo(self.startaddress + (idx * self.pagesize), int(self.values[idx]))
+        if pi.pfn != None:
+            if self.mapcount is not None:
+                pi.mapcount = int(self.mapcount[idx])
+            if self.pageflags is not None:
+                pi.pageflags = int(self.pageflags[idx])
+        return pi
+
+
+    def __iter__(self):
+        for idx in xrange(len(self.values)):
+            yield self[idx]
+
+
+    def setInfo(self, values):
+        '''
+            set info columns from values taken from the procfs pagemap file,
+            see PageInfo.setInfo for the bit layout
+        '''
+        self.values = values
+
+        self.present    = (values & _PM_PRESENT) != 0
+        self.swapped    = (values & _PM_SWAPPED) != 0
+        self.pfn        = numpy.where(self.present, values & _PM_PFN, 0).astype(numpy.uint64)
+        self.swaptype   = numpy.where(self.swapped, values & _PM_SWAPTYPE, 0).astype(numpy.uint8)
+        self.swapoffset = numpy.where(self.swapped, (values & _PM_SWAPOFFSET) >> numpy.uint64(5), 0).astype(numpy.uint64)
+        self.softdirty  = (values & _PM_SOFTDIRTY) != 0
+        self.exclusive  = (values & _PM_EXCLUSIVE) != 0
+        self.uffdwp     = (values & _PM_UFFDWP) != 0
+        self.file       = (values & _PM_FILE) != 0
+
+        self.mapcount   = None
+        self.pageflags  = None
+
+
+    def getPFNIndices(self):
+        '''
+            return the indices of all pages that have a page frame number
+        '''
+        return numpy.flatnonzero(self.present)
+
+
+    def getPresentCount(self):
+        return int(numpy.count_nonzero(self.present))
+
+
+    def getSwappedCount(self):
+        return int(numpy.count_nonzero(self.swapped))
+
+
+
+class CompoundPageArray(PageInfoArray):
+    '''
+        holds info about a range of pages where each transparent or hugetlb
+        huge page is collapsed into one record, the columns hold the values
+        of the first base page of each record
+    '''
+    addresses  = None # virtual address of each record (numpy uint64 array)
+    pagecounts = None # number of base pages of each record (1 or the huge page size)
+
+    def __init__(self, addresses, pagecounts, values):
+        '''
+            addresses  -- virtual address of each record
+            pagecounts -- number of base pages of each record
+            values     -- numpy uint64 array with the pagemap entry of each record
+        '''
+        PageInfoArray.__init__(self, int(addresses[0]) if len(addresses) else 0, PAGESIZE, values)
+        self.addresses  = addresses
+        self.pagecounts = pagecounts
+
+
+    def __getitem__(self, idx):
+        '''
+            return a PageInfo instance for the record at index idx
+        '''
+        pi = PageInfoArray.__getitem__(self, idx)
+        pi.virtualaddress = int(self.addresses[idx])
+        return pi
+
+
+    def getHugeIndices(self):
+        '''
+            return the indices of the records that are huge pages
+        '''
+        return numpy.flatnonzero(self.pagecounts > 1)
+
+
+    def getPresentPageCount(self):
+        '''
+            return the number of present base pages
+        '''
+        return int(self.pagecounts[self.present].sum())
+
+
+if numpy:
+    # column masks for PageInfoArray.setInfo
+    _PM_PRESENT    = numpy.uint64(0x8000000000000000)
+    _PM_SWAPPED    = numpy.uint64(0x4000000000000000)
+    _PM_FILE       = numpy.uint64(0x2000000000000000)
+    _PM_UFFDWP     = numpy.uint64(0x0200000000000000)
+    _PM_EXCLUSIVE  = numpy.uint64(0x0100000000000000)
+    _PM_SOFTDIRTY  = numpy.uint64(0x0080000000000000)
+    _PM_PFN        = numpy.uint64(0x007fffffffffffff)
+    _PM_SWAPTYPE   = numpy.uint64(0x000000000000001f)
+    _PM_SWAPOFFSET = numpy.uint64(0x007fffffffffffe0)
+
+# page categories of the PAGEMAP_SCAN ioctl (linux >= 6.7)
+PAGE_IS_WPALLOWED  = 1 << 0
+PAGE_IS_WRITTEN    = 1 << 1
+PAGE_IS_FILE       = 1 << 2
+PAGE_IS_PRESENT    = 1 << 3
+PAGE_IS_SWAPPED    = 1 << 4
+PAGE_IS_PFNZERO    = 1 << 5
+PAGE_IS_HUGE       = 1 << 6
+PAGE_IS_SOFT_DIRTY = 1 << 7
+
+PAGE_CATEGORY_NAMES = (
+    (PAGE_IS_WPALLOWED,  "WPALLOWED"),
+    (PAGE_IS_WRITTEN,    "WRITTEN"),
+    (PAGE_IS_FILE,       "FILE"),
+    (PAGE_IS_PRESENT,    "PRESENT"),
+    (PAGE_IS_SWAPPED,    "SWAPPED"),
+    (PAGE_IS_PFNZERO,    "PFNZERO"),
+    (PAGE_IS_HUGE,       "HUGE"),
+    (PAGE_IS_SOFT_DIRTY, "SOFT_DIRTY"),
+)
+
+
+class PageRange:
+    '''
+        holds a range of pages that share the same categories
+    '''
+    startaddress = None # starting address of the range
+    stopaddress  = None # final address of the range (exclusive)
+    categories   = None # PAGE_IS_* bits
+
+    def __init__(self, startaddress, stopaddress, categories):
+        self.startaddress = startaddress
+        self.stopaddress  = stopaddress
+        self.categories   = categories
+
+
+    def __repr__(self):
+        return "<PageRange start:%08x stop:%08x categories:%s>" % (
+                self.startaddress, self.stopaddress, self.getCategoryString())
+
+
+    def getPageCount(self, pagesize):
+        return (self.stopaddress - self.startaddress) / pagesize
+
+
+    def getCategoryString(self):
+        '''
+            return human readable string for categories
+        '''
+        return ','.join(name for bit, name in PAGE_CATEGORY_NAMES if self.categories & bit)
+
+
+
+class _PageRegion(ctypes.Structure):
+    # struct page_region from linux/fs.h
+    _fields_ = [("start",      ctypes.c_uint64),
+                ("end",        ctypes.c_uint64),
+                ("categories", ctypes.c_uint64)]
+
+
+class _PMScanArg(ctypes.Structure):
+    # struct pm_scan_arg from linux/fs.h
+    _fields_ = [("size",                ctypes.c_uint64),
+                ("flags",               ctypes.c_uint64),
+                ("start",               ctypes.c_uint64),
+                ("end",                 ctypes.c_uint64),
+                ("walk_end",            ctypes.c_uint64),
+                ("vec",                 ctypes.c_uint64),
+                ("vec_len",             ctypes.c_uint64),
+                ("max_pages",           ctypes.c_uint64),
+                ("category_inverted",   ctypes.c_uint64),
+                ("category_mask",       ctypes.c_uint64),
+                ("category_anyof_mask", ctypes.c_uint64),
+                ("return_mask",         ctypes.c_uint64)]
+
+# _IOWR('f', 16, struct pm_scan_arg)
+PAGEMAP_SCAN = (3 << 30) | (ctypes.sizeof(_PMScanArg) << 16) | (ord('f') << 8) | 16
+
+# number of regions fetched per PAGEMAP_SCAN call
+PAGEMAP_SCAN_REGIONS = 1024
+
+
+# base page size, the unit in which pagemap entries are indexed
+PAGESIZE = os.sysconf("SC_PAGE_SIZE")
+
+# size of transparent huge pages
+try:
+    with open("/sys/kernel/mm/transparent_hugepage/hpage_pmd_size") as fh:
+        HPAGE_PMD_SIZE = int(fh.read())
+except (IOError, ValueError):
+    HPAGE_PMD_SIZE = 2 * 1024 * 1024
+
+# readWords/writeWords merge word indices that are at most KPAGE_MAXGAP apart
+# into one read or write and transfer at most KPAGE_MAXREAD words at once
+KPAGE_MAXGAP  = 64
+KPAGE_MAXREAD = 1 << 16
+
+# default batch size of PageMap.iterPageInfoArrays
+PAGEMAP_CHUNKPAGES = 1 << 16
+
+# default number of threads of PageMap.scanMappings
+PAGEMAP_SCAN_WORKERS = 4
+
+# PageMap.samplePages reads blocks of PAGEMAP_SAMPLE_BLOCKPAGES entries
+# (one pread each), starting with PAGEMAP_SAMPLE_MINBLOCKS blocks and
+# doubling the sample until the error bound or the time budget is reached
+PAGEMAP_SAMPLE_BLOCKPAGES = 8
+PAGEMAP_SAMPLE_MINBLOCKS  = 64
+
+# a scattered read costs about as much as a sequential read of this many
+# entries, samples that would cover more than 1 / PAGEMAP_SAMPLE_FULLREAD of
+# the range are replaced by reading the whole range
+PAGEMAP_SAMPLE_FULLREAD = 64
+
+
+_libc = ctypes.CDLL(None, use_errno=True)
+_libc.pread.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int64]
+_libc.pread.restype  = ctypes.c_ssize_t
+
+def _preadinto(fd, buf, offset):
+    '''
+        read from fd at offset into the numpy array buf without touching the
+        file position, so several threads can share fd (the GIL is released
+        during the call)
+
+        returns the number of bytes read
+    '''
+    readsize = 0
+    while readsize < buf.nbytes:
+        ret = _libc.pread(fd, buf.ctypes.data + readsize, buf.nbytes - readsize, offset + readsize)
+        if ret < 0:
+            err = ctypes.get_errno()
+            raise IOError, (err, os.strerror(err))
+        if ret == 0:
+            break
+        readsize += ret
+    return readsize
+
+
+
+def _getWordRuns(indices):
+    '''
+        private helper to merge word indices into runs for readWords and
+        writeWords, small gaps are transferred along
+
+        returns a tuple (uindices, inverse, runstarts, runstops) where
+        uindices are the sorted unique indices, inverse maps them back to
+        the given order and each run is uindices[runstarts[n]:runstops[n]]
+    '''
+    uindices, inverse = numpy.unique(indices, return_inverse=True)
+    uindices = uindices.astype(numpy.uint64)
+
+    # indices into uindices where a new run starts
+    breaks    = numpy.flatnonzero(numpy.diff(uindices) > KPAGE_MAXGAP) + 1
+    runstarts = numpy.concatenate(([0], breaks))
+    runstops  = numpy.concatenate((breaks, [len(uindices)]))
+    return uindices, inverse, runstarts, runstops
+
+
+def _iterRunPieces(uindices, runstarts, runstops, buflen):
+    '''
+        private helper splitting the runs of _getWordRuns into pieces of at
+        most buflen words
+
+        yields tuples (baseindex, count, first, stop, rel) where the piece
+        covers words baseindex to baseindex + count - 1, which hold
+        uindices[first:stop] at the buffer offsets rel
+    '''
+    for first, last in zip(runstarts, runstops):
+        # runs longer than the buffer are transferred in several pieces
+        idx = first
+        while idx < last:
+            baseindex = uindices[idx]
+            count     = min(int(uindices[last - 1] - baseindex) + 1, buflen)
+            stop = idx + numpy.searchsorted(uindices[idx:last], baseindex + numpy.uint64(count))
+            rel  = (uindices[idx:stop] - baseindex).astype(numpy.intp)
+            yield baseindex, count, idx, stop, rel
+            idx = stop
+
+
+def _getRunBuffer(uindices, runstarts, runstops):
+    '''
+        private helper allocating the transfer buffer for the longest run
+    '''
+    longestrun = int((uindices[runstops - 1] - uindices[runstarts]).max()) + 1
+    return numpy.zeros(min(longestrun, KPAGE_MAXREAD), dtype=numpy.uint64)
+
+
+def readWords(fh, indices):
+    '''
+        reads the 64 bit words at the given word indices from a file like
+        /proc/kpagecount, /proc/kpageflags or the page_idle bitmap
+
+        the indices are sorted and merged into runs, each run is fetched
+        with a single readinto into a preallocated buffer and scattered back
+        to the requesting entries
+        fh      -- unbuffered file handle
+        indices -- numpy array of word indices (e.g. page frame numbers)
+
+        returns a numpy uint64 array with one value per index, words that
+        could not be read are 0
+    '''
+    if numpy is None:
+        raise ImportError, "readWords: needs numpy (available on PyPi)"
+    if len(indices) == 0:
+        return numpy.zeros(0, dtype=numpy.uint64)
+
+    with instrument.stage("kpage.read") as st:
+        uindices, inverse, runstarts, runstops = _getWordRuns(indices)
+        uvals = numpy.zeros(len(uindices), dtype=numpy.uint64)
+        buf = _getRunBuffer(uindices, runstarts, runstops)
+
+        pieces = 0
+        nbytes = 0
+        for baseindex, count, first, stop, rel in _iterRunPieces(uindices, runstarts, runstops, len(buf)):
+            fh.seek(int(baseindex) * 8)
+            readcount = fh.readinto(buf[:count]) / 8
+            pieces += 1
+            nbytes += readcount * 8
+            if readcount < count:
+                warning("unable to read '%s' for words %d-%d" % (fh.name, baseindex + numpy.uint64(readcount), uindices[stop - 1]))
+                valid = rel < readcount
+                uvals[first:stop][valid] = buf[rel[valid]]
+            else:
+                uvals[first:stop] = buf[rel]
+
+        # a seek and a read per piece
+        st.add(bytes = nbytes, syscalls = 2 * pieces, pages = len(indices))
+        return uvals[inverse]
+
+
+def writeWords(fh, indices, values):
+    '''
+        writes 64 bit words at the given word indices, meant for bitmaps
+        like the page_idle bitmap where writing 0 bits has no effect: the
+        words in the gaps of a run are written as 0 and the values of
+        duplicate indices are or-ed together
+        fh      -- unbuffered file handle opened for writing
+        indices -- numpy array of word indices
+        values  -- numpy uint64 array with one value per index
+    '''
+    if numpy is None:
+        raise ImportError, "writeWords: needs numpy (available on PyPi)"
+    if len(indices) == 0:
+        return
+
+    uindices, inverse, runstarts, runstops = _getWordRuns(indices)
+    uvals = numpy.zeros(len(uindices), dtype=numpy.uint64)
+    numpy.bitwise_or.at(uvals, inverse, values.astype(numpy.uint64))
+    buf = _getRunBuffer(uindices, runstarts, runstops)
+
+    for baseindex, count, first, stop, rel in _iterRunPieces(uindices, runstarts, runstops, len(buf)):
+        buf[:count] = 0
+        buf[rel] = uvals[first:stop]
+        fh.seek(int(baseindex) * 8)
+        fh.write(buffer(buf[:count]))
+
+
+
+class PageCounts:
+    '''
+        holds page statistics of an address range
+    '''
+    pagecount    = 0
+    presentcount = 0
+    swappedcount = 0
+
+    def __repr__(self):
+        return "<PageCounts pages:%d present:%d swapped:%d>" % (self.pagecount, self.presentcount, self.swappedcount)
+
+
+    def add(self, other):
+        '''
+            add the counts of another PageCounts instance
+        '''
+        self.pagecount    += other.pagecount
+        self.presentcount += other.presentcount
+        self.swappedcount += other.swappedcount
+
+
+
+
+def _getZValue(confidence):
+    '''
+        private helper returning z with P(-z < X < z) = confidence for a
+        standard normal X
+    '''
+    low, high = 0.0, 10.0
+    for i in range(60):
+        mid = (low + high) / 2
+        if math.erf(mid / math.sqrt(2)) < confidence:
+            low = mid
+        else:
+            high = mid
+    return (low + high) / 2
+
+
+
+class PageSample:
+    '''
+        holds a sample of the pagemap entries of an address range and
+        estimates the fraction of pages in a category with a confidence
+        interval
+
+        the sample consists of blocks of consecutive entries, the fractions
+        are ratio estimates over the blocks and their standard error is
+        computed from the spread of the block ratios (for stratified samples
+        this overestimates the error a little)
+    '''
+    startaddress = None
+    stopaddress  = None
+    pagesize     = None
+    pagecount    = 0    # pages in the address range
+    samplecount  = 0    # sampled pages
+    blockcount   = 0    # sampled blocks
+    exact        = False # True if every page was read
+    confidence   = None
+    seconds      = None # time spent sampling
+
+    # categories of PageSample.getEstimate
+    CATEGORIES = ("present", "swapped", "file", "exclusive", "softdirty")
+
+    def __init__(self, startaddress, stopaddress, pagesize, confidence):
+        self.startaddress = startaddress
+        self.stopaddress  = stopaddress
+        self.pagesize     = pagesize
+        self.pagecount    = (stopaddress - startaddress) / pagesize
+        self.confidence   = confidence
+        self._z           = _getZValue(confidence)
+        self._blocksizes  = []
+        self._counts      = dict((category, []) for category in self.CATEGORIES)
+        self._flagwords   = [] # kpageflags of the sampled present pages
+        self._flagblocks  = [] # block number of each of them
+
+
+    def addBlocks(self, values, blockids, pageflags = None):
+        '''
+            adds sampled blocks
+            values    -- numpy uint64 array of pagemap entries
+            blockids  -- numpy array, number of the block (0...) of each
+                         entry within this call
+            pageflags -- numpy uint64 array of the kpageflags of the present
+                         entries or None
+        '''
+        if len(values) == 0:
+            return
+        nblocks = int(blockids[-1]) + 1
+        self._blocksizes.append(numpy.bincount(blockids, minlength=nblocks))
+        masks = {"present"   : _PM_PRESENT,
+                 "swapped"   : _PM_SWAPPED,
+                 "file"      : _PM_FILE,
+                 "exclusive" : _PM_EXCLUSIVE,
+                 "softdirty" : _PM_SOFTDIRTY}
+        for category, mask in masks.iteritems():
+            self._counts[category].append(numpy.bincount(blockids[(values & mask) != 0], minlength=nblocks))
+        if pageflags is not None:
+            self._flagwords.append(pageflags)
+            self._flagblocks.append(blockids[(values & _PM_PRESENT) != 0] + self.blockcount)
+        self.samplecount += len(values)
+        self.blockcount  += nblocks
+
+
+    def _getRatio(self, counts):
+        '''
+            private helper returning the ratio estimate and the half width of
+            its confidence interval for the given per block counts
+        '''
+        sizes = numpy.concatenate(self._blocksizes).astype(numpy.float64)
+        counts = counts.astype(numpy.float64)
+        if self.samplecount == 0:
+            return 0.0, 1.0
+        ratio = counts.sum() / sizes.sum()
+        if self.exact:
+            return ratio, 0.0
+        m = len(sizes)
+        if m < 2:
+            return ratio, 1.0
+        variance = ((counts - ratio * sizes) ** 2).sum() / (m * (m - 1)) / sizes.mean() ** 2
+        # rare categories are often not seen at all, so the variance is at
+        # least the one of an Agresti-Coull interval counting whole blocks
+        adjusted = (ratio * m + self._z ** 2 / 2) / (m + self._z ** 2)
+        variance = max(variance, adjusted * (1 - adjusted) / (m + self._z ** 2))
+        return ratio, self._z * math.sqrt(variance)
+
+
+    def getEstimate(self, category = "present"):
+        '''
+            estimates the fraction of the pages in a category
+            category -- one of CATEGORIES
+
+            returns a tuple (fraction, halfwidth), the true fraction lies in
+            fraction +- halfwidth with the given confidence
+        '''
+        if not self._blocksizes:
+            return 0.0, 1.0
+        return self._getRatio(numpy.concatenate(self._counts[category]))
+
+
+    def getPageEstimate(self, category = "present"):
+        '''
+            like getEstimate but returns the number of pages
+        '''
+        fraction, halfwidth = self.getEstimate(category)
+        return fraction * self.pagecount, halfwidth * self.pagecount
+
+
+    def getFlagEstimate(self, bit):
+        '''
+            estimates the fraction of all pages that are present and have the
+            given KPF_* bit set, returns (fraction, halfwidth) or None if the
+            page flags were not sampled
+        '''
+        if not self._flagwords:
+            return None
+        words  = numpy.concatenate(self._flagwords)
+        blocks = numpy.concatenate(self._flagblocks)
+        hasbit = ((words >> numpy.uint64(bit)) & numpy.uint64(1)) != 0
+        return self._getRatio(numpy.bincount(blocks[hasbit], minlength=self.blockcount))
+
+
+    def __repr__(self):
+        fraction, halfwidth = self.getEstimate("present")
+        return "<PageSample %x-%x pages:%d sampled:%d present:%.4f+-%.4f>" % (self.startaddress, self.stopaddress,
+                                                                             self.pagecount, self.samplecount,
+                                                                             fraction, halfwidth)
+
+
 
 class PageMap:
     '''
         accessor class for the linux procfs pagemap file
     '''
     pid          = None # pid for which the information is retrieved
+    procroot     = None # directory holding <pid>/pagemap, kpagecount and kpageflags
     
     _pagemapfile = None
+    _pagemapscan = None # PAGEMAP_SCAN support, None until tried
 
-    def __init__(self, pid):
+    def __init__(self, pid, procroot = smaps.PROCROOT):
         '''
             create PageMap instance
+            pid      -- pid as a decimal number
+            procroot -- mount point of the procfs, or a directory with the
+                        same layout (e.g. generated test data)
         '''
         self.pid = pid
-        self._pagemapfile = "/proc/%d/pagemap" % self.pid
-    
+        self.procroot = procroot
+        self._pagemapfile = "%s/%d/pagemap" % (procroot, self.pid)
 
-    def getPageInfo(self, startaddress, stopaddress, pagesize):
+
+    def _getEntryRange(self, startaddress, stopaddress, pagesize):
         '''
-            queries info about the given range
-            
-            startaddress -- start address
-            stopaddress  -- stop address
+            private helper converting an address range to pagemap entries,
+            the pagemap is indexed in base pages (PAGESIZE) whatever the page
+            size of the mapping, so for bigger page sizes only every stride-th
+            entry is reported (the first base page of each page)
 
-            returns a list of PageInfo instances
+            returns a tuple (startindex, stopindex, stride)
         '''
-        ret = []
+        if pagesize % PAGESIZE:
+            raise ValueError, "page size %d is not a multiple of the base page size %d" % (pagesize, PAGESIZE)
+        return startaddress / PAGESIZE, stopaddress / PAGESIZE, pagesize / PAGESIZE
 
-        mapsize  = stopaddress - startaddress
-        startpfn = startaddress / pagesize
-        stoppfn  = stopaddress / pagesize
 
+    def _openKPageFiles(self):
+        '''
+            private helper to open kpagecount and kpageflags in the procfs
+            returns a tuple of both file handles, None if not accessible
+        '''
         fhpgcnt   = None
         fhpgflags = None
 
         # get access to both count and flags files if possible
         try:
-            fhpgcnt   = open("/proc/kpagecount", 'rb')
-            fhpgflags = open("/proc/kpageflags", 'rb')
+            fhpgcnt   = open("%s/kpagecount" % self.procroot, 'rb', 0)
+            fhpgflags = open("%s/kpageflags" % self.procroot, 'rb', 0)
         except IOError, exc:
             if exc.errno == errno.EACCES:
                 warning("getPageInfo: no permission to get extra page info from kernel, start with elevated privileges if you want that type of info")
-       
-        startoffset = startpfn * 8 # size of each entry
+        return fhpgcnt, fhpgflags
+
+
+    def getPageInfoArray(self, startaddress, stopaddress, pagesize, kpageinfo = True):
+        '''
+            queries info about the given range, like getPageInfo but keeps the
+            result in numpy columns
+
+            startaddress -- start address
+            stopaddress  -- stop address
+            kpageinfo    -- also read the mapcount and pageflags columns from
+                            /proc/kpagecount and /proc/kpageflags, else they
+                            stay None
+
+            returns a PageInfoArray instance
+        '''
+        if numpy is None:
+            raise ImportError, "getPageInfoArray: needs numpy (available on PyPi)"
+
+        startidx, stopidx, stride = self._getEntryRange(startaddress, stopaddress, pagesize)
+
+        values = numpy.zeros(stopidx - startidx, dtype=numpy.uint64)
+
+        try:
+            with instrument.stage("pagemap.read") as st:
+                with open(self._pagemapfile, 'rb') as fh:
+                    fh.seek(startidx * 8) # size of each entry
+                    readsize = fh.readinto(values)
+                    st.add(bytes = readsize, syscalls = 3, pages = readsize / 8)
+                    if readsize != values.nbytes:
+                        # the kernel did not give us what we want, e.g. the vsyscall page does not return valid info
+                        error("only read %d bytes from pagemap '%s', expected %d" % (readsize, self._pagemapfile, values.nbytes))
+                        values = values[:0]
+        except BaseException, exc:
+            error("getPageInfoArray: error opening  pagemap file '%s': %s %s" % (self._pagemapfile, type(exc), str(exc)))
+            raise
+
+        with instrument.stage("pagemap.decode") as st:
+            if stride > 1:
+                values = values[::stride].copy()
+            pia = PageInfoArray(startaddress, pagesize, values)
+            st.add(pages = len(values))
+
+        if kpageinfo:
+            fhpgcnt, fhpgflags = self._openKPageFiles()
+            self._setKPageInfo(pia, fhpgcnt, fhpgflags)
+            if fhpgcnt:
+                fhpgcnt.close()
+            if fhpgflags:
+                fhpgflags.close()
+
+        return pia
+
+
+    def iterPageInfoArrays(self, startaddress, stopaddress, pagesize, chunkpages = PAGEMAP_CHUNKPAGES, kpageinfo = True):
+        '''
+            queries info about the given range in batches of at most chunkpages
+            pages, the pagemap is read into one reusable buffer so memory
+            usage does not depend on the size of the range
+
+            startaddress -- start address
+            stopaddress  -- stop address
+            chunkpages   -- maximum number of pages per batch
+            kpageinfo    -- also read the mapcount and pageflags columns, see
+                            getPageInfoArray
+
+            yields PageInfoArray instances in address order, their values
+            array is only valid until the next batch is requested
+        '''
+        if numpy is None:
+            raise ImportError, "iterPageInfoArrays: needs numpy (available on PyPi)"
+
+        startidx, stopidx, stride = self._getEntryRange(startaddress, stopaddress, pagesize)
+
+        buf = numpy.empty(min(stopidx - startidx, chunkpages * stride), dtype=numpy.uint64)
+
+        fhpgcnt, fhpgflags = self._openKPageFiles() if kpageinfo else (None, None)
+        try:
+            with open(self._pagemapfile, 'rb', 0) as fh:
+                fh.seek(startidx * 8) # size of each entry
+                idx = startidx
+                while idx < stopidx:
+                    count = min(stopidx - idx, chunkpages * stride)
+                    with instrument.stage("pagemap.read") as st:
+                        readsize = fh.readinto(buf[:count])
+                        st.add(bytes = readsize, syscalls = 1, pages = readsize / 8)
+                    complete = readsize == count * 8
+                    if not complete:
+                        # the kernel did not give us what we want, e.g. the vsyscall page does not return valid info
+                        error("only read %d bytes from pagemap '%s', expected %d" % (readsize, self._pagemapfile, count * 8))
+                        count = readsize / 8
+
+                    if count > 0:
+                        with instrument.stage("pagemap.decode") as st:
+                            values = buf[:count]
+                            if stride > 1:
+                                values = values[::stride].copy()
+                            pia = PageInfoArray(startaddress + (idx - startidx) * PAGESIZE, pagesize, values)
+                            st.add(pages = len(values))
+                        self._setKPageInfo(pia, fhpgcnt, fhpgflags)
+                        yield pia
+
+                    if not complete:
+                        break
+                    idx += count
+        finally:
+            if fhpgcnt:
+                fhpgcnt.close()
+            if fhpgflags:
+                fhpgflags.close()
+
+
+    def iterCompoundPageArrays(self, startaddress, stopaddress, hugepagesize = HPAGE_PMD_SIZE, chunkpages = PAGEMAP_CHUNKPAGES):
+        '''
+            queries info about the given range like iterPageInfoArrays, but
+            collapses every huge page into one record
+
+            aligned groups of present pages on physically contiguous and
+            aligned page frames are huge page candidates, only the
+            kpageflags of their first page frame are read and the group is
+            collapsed if it is a compound head with KPF_THP or KPF_HUGE set.
+            The other present pages get their kpagecount/kpageflags one by
+            one.
+            startaddress -- start address
+            stopaddress  -- stop address
+            hugepagesize -- size of the huge pages (HPAGE_PMD_SIZE for
+                            transparent huge pages, the kernel page size for
+                            hugetlb mappings)
+            chunkpages   -- maximum number of base pages per batch, batches
+                            end at huge page boundaries
+
+            yields CompoundPageArray instances in address order
+        '''
+        if numpy is None:
+            raise ImportError, "iterCompoundPageArrays: needs numpy (available on PyPi)"
+
+        startidx, stopidx = startaddress / PAGESIZE, stopaddress / PAGESIZE
+        hugepages = hugepagesize / PAGESIZE
+        chunkpages = max(hugepages, chunkpages - chunkpages % hugepages)
+        buf = numpy.empty(min(stopidx - startidx, chunkpages), dtype=numpy.uint64)
+
+        fhpgcnt, fhpgflags = self._openKPageFiles()
+        try:
+            with open(self._pagemapfile, 'rb', 0) as fh:
+                fh.seek(startidx * 8) # size of each entry
+                idx = startidx
+                while idx < stopidx:
+                    # batches end at huge page boundaries, so no huge page
+                    # is split
+                    count = min(stopidx, (idx / hugepages) * hugepages + chunkpages) - idx
+                    readsize = fh.readinto(buf[:count])
+                    complete = readsize == count * 8
+                    if not complete:
+                        # the kernel did not give us what we want, e.g. the vsyscall page does not return valid info
+                        error("only read %d bytes from pagemap '%s', expected %d" % (readsize, self._pagemapfile, count * 8))
+                        count = readsize / 8
+
+                    if count > 0:
+                        yield self._collapseCompoundPages(idx, buf[:count], hugepages, fhpgcnt, fhpgflags)
+
+                    if not complete:
+                        break
+                    idx += count
+        finally:
+            if fhpgcnt:
+                fhpgcnt.close()
+            if fhpgflags:
+                fhpgflags.close()
+
+
+    def _collapseCompoundPages(self, startidx, values, hugepages, fhpgcnt, fhpgflags):
+        '''
+            private helper for iterCompoundPageArrays
+            startidx  -- pagemap index (base page number) of values[0]
+            values    -- pagemap entries of the batch
+            hugepages -- base pages per huge page
+
+            returns a CompoundPageArray instance
+        '''
+        count = len(values)
+        pia = PageInfoArray(startidx * PAGESIZE, PAGESIZE, values)
+
+        # aligned groups of hugepages entries inside the batch
+        first  = (-startidx) % hugepages
+        ngroup = max(0, (count - first) / hugepages)
+        ishuge    = numpy.zeros(ngroup, dtype=bool)
+        hugeflags = numpy.zeros(ngroup, dtype=numpy.uint64)
+        if ngroup and fhpgflags:
+            pfns    = pia.pfn[first:first + ngroup * hugepages].reshape(ngroup, hugepages)
+            present = pia.present[first:first + ngroup * hugepages].reshape(ngroup, hugepages)
+            headpfn = pfns[:, 0]
+            candidates = (present.all(axis=1) &
+                          (headpfn % numpy.uint64(hugepages) == 0) &
+                          ((pfns - headpfn[:, None]) == numpy.arange(hugepages, dtype=numpy.uint64)).all(axis=1))
+            candidx = numpy.flatnonzero(candidates)
+            if len(candidx):
+                headflags = readWords(fhpgflags, headpfn[candidx])
+                compound  = (headflags >> numpy.uint64(PageInfo.KPF_COMPOUND_HEAD)) & numpy.uint64(1)
+                huge      = (headflags >> numpy.uint64(PageInfo.KPF_THP)) | (headflags >> numpy.uint64(PageInfo.KPF_HUGE))
+                ishuge[candidx]    = (compound & huge & numpy.uint64(1)) != 0
+                hugeflags[candidx] = headflags
+
+        # one record per huge page and per remaining base page
+        hugegroups = numpy.flatnonzero(ishuge)
+        hugestarts = first + hugegroups * hugepages
+        keep = numpy.ones(count, dtype=bool)
+        keep[(hugestarts[:, None] + numpy.arange(1, hugepages)).ravel()] = False
+        records = numpy.flatnonzero(keep)
+        hugerecords = numpy.searchsorted(records, hugestarts)
+
+        pagecounts = numpy.ones(len(records), dtype=numpy.int64)
+        pagecounts[hugerecords] = hugepages
+        cpa = CompoundPageArray(numpy.uint64(startidx * PAGESIZE) + records.astype(numpy.uint64) * numpy.uint64(PAGESIZE),
+                                pagecounts, values[records])
+
+        # the page flags of the huge pages are known already
+        self._setKPageInfo(cpa, fhpgcnt, None)
+        if fhpgflags:
+            cpa.pageflags = numpy.zeros(len(cpa), dtype=numpy.uint64)
+            cpa.pageflags[hugerecords] = hugeflags[hugegroups]
+            single = numpy.flatnonzero(cpa.present & (pagecounts == 1))
+            cpa.pageflags[single] = readWords(fhpgflags, cpa.pfn[single])
+        return cpa
+
+
+    def _setKPageInfo(self, pia, fhpgcnt, fhpgflags):
+        '''
+            private helper to fill the mapcount and pageflags columns of a
+            PageInfoArray, either file handle can be None
+        '''
+        if fhpgcnt or fhpgflags:
+            pfnindices = pia.getPFNIndices()
+            pfns = pia.pfn[pfnindices]
+            if fhpgcnt:
+                pia.mapcount = numpy.zeros(len(pia), dtype=numpy.uint64)
+                pia.mapcount[pfnindices] = readWords(fhpgcnt, pfns)
+            if fhpgflags:
+                pia.pageflags = numpy.zeros(len(pia), dtype=numpy.uint64)
+                pia.pageflags[pfnindices] = readWords(fhpgflags, pfns)
+
+
+    def scanMappings(self, ranges, workers = PAGEMAP_SCAN_WORKERS):
+        '''
+            counts the pages of several address ranges in parallel
+
+            the ranges are split into batches that are read by a pool of
+            threads, all of them use os.pread-like positional reads on one
+            shared pagemap file descriptor
+
+            ranges  -- list of (startaddress, stopaddress, pagesize) tuples
+            workers -- number of threads
+
+            returns a list of PageCounts instances, one per range
+        '''
+        if numpy is None:
+            raise ImportError, "scanMappings: needs numpy (available on PyPi)"
+
+        ret = [PageCounts() for r in ranges]
+
+        tasks = []
+        for idx, (startaddress, stopaddress, pagesize) in enumerate(ranges):
+            startidx, stopidx, stride = self._getEntryRange(startaddress, stopaddress, pagesize)
+            for first in xrange(startidx, stopidx, PAGEMAP_CHUNKPAGES * stride):
+                tasks.append((idx, first, min(first + PAGEMAP_CHUNKPAGES * stride, stopidx), stride))
+
+        with instrument.stage("pagemap.scan") as st:
+            fd = os.open(self._pagemapfile, os.O_RDONLY)
+            pool = ThreadPool(workers)
+            try:
+                def countPages(task):
+                    idx, startidx, stopidx, stride = task
+                    pc = PageCounts()
+                    values = numpy.empty(stopidx - startidx, dtype=numpy.uint64)
+                    readsize = _preadinto(fd, values, startidx * 8)
+                    if readsize != values.nbytes:
+                        # e.g. the vsyscall page does not return valid info,
+                        # the entries that were read still count
+                        warning("only read %d bytes from pagemap '%s', expected %d" % (readsize, self._pagemapfile, values.nbytes))
+                        values = values[:readsize / 8]
+                    values = values[::stride]
+                    pc.pagecount    = len(values)
+                    pc.presentcount = int(numpy.count_nonzero(values & _PM_PRESENT))
+                    pc.swappedcount = int(numpy.count_nonzero(values & _PM_SWAPPED))
+                    return idx, pc
+
+                for idx, pc in pool.imap_unordered(countPages, tasks):
+                    ret[idx].add(pc)
+            finally:
+                pool.close()
+                pool.join()
+                os.close(fd)
+
+            # open, a pread per task and close
+            entries = sum(task[2] - task[1] for task in tasks)
+            st.add(bytes = entries * 8, syscalls = len(tasks) + 2, pages = entries)
+
+        return ret
+
+
+    def samplePages(self, startaddress, stopaddress, pagesize, errorbound = 0.01, timebudget = None,
+                    confidence = 0.95, stratified = True, flags = False, blockpages = PAGEMAP_SAMPLE_BLOCKPAGES):
+        '''
+            estimates the page state of a range from a sample of the pagemap
+
+            blocks of blockpages entries are read with positional reads at
+            scattered offsets, the sample size is doubled until the present
+            fraction is known to +- errorbound or the time budget is used up.
+            If the sample would grow beyond 1 / PAGEMAP_SAMPLE_FULLREAD of
+            the range it is read completely instead, with a time budget only
+            if the full read (estimated from the sample so far) fits into
+            the rest of it, otherwise the current estimate is returned.
+            Ranges below PAGEMAP_SAMPLE_FULLREAD * PAGEMAP_SAMPLE_MINBLOCKS
+            blocks are always read completely. The range is always
+            sampled in base pages (PAGESIZE), the fractions do not depend on
+            the page size of the mapping.
+            errorbound -- wanted half width of the confidence interval of the
+                          present fraction, None to only stop on the budget
+            timebudget -- maximum seconds to spend, None for no limit
+            confidence -- confidence level of the intervals
+            stratified -- take one block from each of equally sized strata
+                          of the range, else the blocks are uniformly random
+            flags      -- also sample the kpageflags of the present pages
+
+            returns a PageSample instance
+        '''
+        if numpy is None:
+            raise ImportError, "samplePages: needs numpy (available on PyPi)"
+        if errorbound is None and timebudget is None:
+            raise ValueError, "samplePages: needs an error bound or a time budget"
+
+        starttime = time.time()
+        ps = PageSample(startaddress, stopaddress, PAGESIZE, confidence)
+        startpfn = startaddress / PAGESIZE
+        nblocks  = (ps.pagecount + blockpages - 1) / blockpages
+        if nblocks == 0:
+            ps.exact = True
+            return ps
+
+        fhpgflags = None
+        if flags:
+            fhpgcnt, fhpgflags = self._openKPageFiles()
+            if fhpgcnt:
+                fhpgcnt.close()
+
+        def addSample(ps, blocks, values):
+            # the last block of the range may be shorter
+            lengths  = numpy.minimum(blockpages, ps.pagecount - blocks * blockpages)
+            blockids = numpy.repeat(numpy.arange(len(blocks)), lengths)
+            pageflags = None
+            if fhpgflags:
+                present = (values & _PM_PRESENT) != 0
+                pageflags = readWords(fhpgflags, values[present] & _PM_PFN)
+            ps.addBlocks(values, blockids, pageflags)
+
+        fd = os.open(self._pagemapfile, os.O_RDONLY)
+        try:
+            roundblocks = PAGEMAP_SAMPLE_MINBLOCKS
+            elapsed     = 0.0
+            fullread    = False
+            while True:
+                if roundblocks * PAGEMAP_SAMPLE_FULLREAD >= nblocks:
+                    # small range or big sample, sequential reads are cheaper
+                    # if they fit into the budget
+                    fullread = (ps.blockcount == 0 or timebudget is None or
+                                elapsed * nblocks / ps.blockcount <= timebudget - elapsed)
+                    break
+                if stratified:
+                    edges  = numpy.linspace(0, nblocks, roundblocks + 1).astype(numpy.int64)
+                    blocks = edges[:-1] + (numpy.random.random_sample(roundblocks) * (edges[1:] - edges[:-1])).astype(numpy.int64)
+                else:
+                    blocks = numpy.random.randint(0, nblocks, size=roundblocks)
+
+                lengths = numpy.minimum(blockpages, ps.pagecount - blocks * blockpages)
+                offsets = numpy.concatenate(([0], numpy.cumsum(lengths)))
+                values  = numpy.zeros(offsets[-1], dtype=numpy.uint64)
+                for idx, block in enumerate(blocks):
+                    _preadinto(fd, values[offsets[idx]:offsets[idx + 1]], (startpfn + int(block) * blockpages) * 8)
+                addSample(ps, blocks, values)
+
+                fraction, halfwidth = ps.getEstimate("present")
+                elapsed = time.time() - starttime
+                if errorbound is not None and halfwidth <= errorbound:
+                    break
+                if timebudget is not None and elapsed >= timebudget:
+                    break
+                # double the sample, but not beyond what fits into the budget
+                roundblocks = ps.blockcount
+                if timebudget is not None:
+                    roundblocks = min(roundblocks, int((timebudget - elapsed) * ps.blockcount / max(elapsed, 1e-6)) + 1)
+
+            if fullread:
+                ps = PageSample(startaddress, stopaddress, PAGESIZE, confidence)
+                ps.exact = True
+                chunkblocks = max(1, PAGEMAP_CHUNKPAGES / blockpages)
+                for first in xrange(0, nblocks, chunkblocks):
+                    blocks = numpy.arange(first, min(first + chunkblocks, nblocks))
+                    values = numpy.zeros(min(len(blocks) * blockpages, ps.pagecount - first * blockpages), dtype=numpy.uint64)
+                    _preadinto(fd, values, (startpfn + first * blockpages) * 8)
+                    addSample(ps, blocks, values)
+        finally:
+            os.close(fd)
+            if fhpgflags:
+                fhpgflags.close()
+
+        ps.seconds = time.time() - starttime
+        return ps
+
+
+    def scanPageRanges(self, startaddress, stopaddress, pagesize, categories = PAGE_IS_PRESENT | PAGE_IS_SWAPPED):
+        '''
+            queries the ranges of pages in the given range that are in any of
+            the given categories, pages in none of them are skipped
+
+            uses the PAGEMAP_SCAN ioctl which only returns populated ranges,
+            on older kernels the pagemap is read entry by entry instead (only
+            PAGE_IS_PRESENT, PAGE_IS_SWAPPED, PAGE_IS_FILE and
+            PAGE_IS_SOFT_DIRTY are supported then)
+
+            startaddress -- start address
+            stopaddress  -- stop address
+            categories   -- PAGE_IS_* bits of interest
+
+            returns a list of PageRange instances in address order
+        '''
+        if self._pagemapscan != False:
+            try:
+                ret = self._scanPageRangesIoctl(startaddress, stopaddress, categories)
+                self._pagemapscan = True
+                return ret
+            except IOError, exc:
+                if self._pagemapscan or exc.errno not in (errno.ENOTTY, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+                info("scanPageRanges: PAGEMAP_SCAN not supported by kernel (%s), reading pagemap instead" % exc)
+                self._pagemapscan = False
+        return self._scanPageRangesPagemap(startaddress, stopaddress, pagesize, categories)
+
+
+    def _scanPageRangesIoctl(self, startaddress, stopaddress, categories):
+        '''
+            private helper for scanPageRanges using the PAGEMAP_SCAN ioctl
+        '''
+        ret = []
+
+        regions = (_PageRegion * PAGEMAP_SCAN_REGIONS)()
+
+        arg = _PMScanArg()
+        arg.size                = ctypes.sizeof(_PMScanArg)
+        arg.end                 = stopaddress
+        arg.vec                 = ctypes.addressof(regions)
+        arg.vec_len             = PAGEMAP_SCAN_REGIONS
+        arg.category_anyof_mask = categories
+        arg.return_mask         = categories
+
+        fd = os.open(self._pagemapfile, os.O_RDONLY)
+        try:
+            start = startaddress
+            while start < stopaddress:
+                arg.start = start
+                count = fcntl.ioctl(fd, PAGEMAP_SCAN, arg, True)
+                for idx in xrange(count):
+                    region = regions[idx]
+                    ret.append(PageRange(region.start, region.end, region.categories))
+                # the walk stops early once the region vector is full
+                start = arg.walk_end
+        finally:
+            os.close(fd)
+
+        return ret
+
+
+    def _scanPageRangesPagemap(self, startaddress, stopaddress, pagesize, categories):
+        '''
+            private helper for scanPageRanges reading the pagemap
+        '''
+        ret = []
+
+        for pia in self.iterPageInfoArrays(startaddress, stopaddress, pagesize, kpageinfo = False):
+            pagecategories = numpy.zeros(len(pia), dtype=numpy.uint8)
+            pagecategories[pia.present]   |= PAGE_IS_PRESENT
+            pagecategories[pia.swapped]   |= PAGE_IS_SWAPPED
+            pagecategories[pia.file]      |= PAGE_IS_FILE
+            pagecategories[pia.softdirty] |= PAGE_IS_SOFT_DIRTY
+            pagecategories &= categories
+
+            # indices where the categories change
+            changes = numpy.flatnonzero(numpy.diff(pagecategories)) + 1
+            runstarts = numpy.concatenate(([0], changes))
+            runstops  = numpy.concatenate((changes, [len(pia)]))
+            for first, last in zip(runstarts, runstops):
+                cat = int(pagecategories[first])
+                if cat == 0:
+                    continue
+                rangestart = pia.startaddress + int(first) * pagesize
+                rangestop  = pia.startaddress + int(last) * pagesize
+                if ret and ret[-1].stopaddress == rangestart and ret[-1].categories == cat:
+                    # continues a range from the previous batch
+                    ret[-1].stopaddress = rangestop
+                else:
+                    ret.append(PageRange(rangestart, rangestop, cat))
+
+        return ret
+
+
+    def getPageInfo(self, startaddress, stopaddress, pagesize):
+        '''
+            queries info about the given range
+            
+            startaddress -- start address
+            stopaddress  -- stop address
+
+            returns a list of PageInfo instances
+        '''
+        with instrument.stage("pagemap.getPageInfo") as st:
+            if numpy:
+                # batched kpagecount/kpageflags lookups
+                pia = self.getPageInfoArray(startaddress, stopaddress, pagesize)
+                with instrument.stage("pagemap.pageinfo") as pist:
+                    ret = list(pia)
+                    pist.add(pages = len(ret))
+            else:
+                ret = self._getPageInfoList(startaddress, stopaddress, pagesize, st)
+            st.add(pages = len(ret))
+        return ret
+
+
+    def _getPageInfoList(self, startaddress, stopaddress, pagesize, st):
+        '''
+            private helper for getPageInfo without numpy, reads the kpagecount
+            and kpageflags words one by one
+            st -- instrument stage counting the I/O
+        '''
+        ret = []
+
+        startidx, stopidx, stride = self._getEntryRange(startaddress, stopaddress, pagesize)
+
+        fhpgcnt, fhpgflags = self._openKPageFiles()
+
+        startoffset = startidx * 8 # size of each entry
         try:
             with open(self._pagemapfile, 'rb') as fh:
                 fh.seek(startoffset)
-                readsize = (stoppfn-startpfn) * 8
+                readsize = (stopidx-startidx) * 8
                 
                 pagemapinfo = fh.read(readsize)
+                st.add(bytes = len(pagemapinfo), syscalls = 3)
                 if len(pagemapinfo) != readsize:
                     # the kernel did not give us what we want, e.g. the vsyscall page does not return valid info
                     error("only read %d bytes from pagemap '%s', expected %d" % (len(pagemapinfo), self._pagemapfile, readsize))
                 else:
-                    pagemapvals = struct.unpack("=%dQ" % (stoppfn-startpfn), pagemapinfo)
+                    pagemapvals = struct.unpack("=%dQ" % (stopidx-startidx), pagemapinfo)[::stride]
 
                     for idx, val in enumerate(pagemapvals):
                         vaddr = startaddress + (idx * pagesize)
@@ -257,6 +1401,7 @@ class PageMap:
                             if fhpgcnt:
                                 fhpgcnt.seek(pi.pfn * 8)
                                 pgcnt = fhpgcnt.read(8)
+                                st.add(bytes = len(pgcnt), syscalls = 2)
                                 if len(pgcnt):
                                     pgcnt, = struct.unpack('=Q', pgcnt)
                                     pi.mapcount = pgcnt
@@ -265,6 +1410,7 @@ class PageMap:
                             if fhpgflags:
                                 fhpgflags.seek(pi.pfn * 8)
                                 pgflags = fhpgflags.read(8)
+                                st.add(bytes = len(pgflags), syscalls = 2)
                                 if len(pgflags):
                                     pgflags, = struct.unpack('=Q', pgflags)
                                     pi.pageflags = pgflags
@@ -276,6 +1422,11 @@ class PageMap:
         except BaseException, exc:
             error("getPageInfo: error opening  pagemap file '%s': %s %s" % (self._pagemapfile, type(exc), str(exc)))
             raise
+        finally:
+            if fhpgcnt:
+                fhpgcnt.close()
+            if fhpgflags:
+                fhpgflags.close()
 
         return ret
 
@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2013, Carsten Juttner <carjay@gmx.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Text rendering of page states. The states are kept run-length encoded, so
+# the rendering cost depends on the number of runs and output lines and not
+# on the number of pages.
+
+import sys
+
+try:
+    import numpy
+except ImportError:
+    print("needs numpy (available on PyPi)")
+    sys.exit(1)
+
+
+# page states
+STATE_ABSENT  = 0
+STATE_PRESENT = 1
+STATE_SWAPPED = 2
+
+# one character per page indexed by the state
+DRAWCHARS = numpy.array(['.', 'x', 's'], dtype='S1')
+
+# downsampled cells
+CELL_ABSENT         = '.' # no page of the cell is present or swapped
+CELL_PRESENT        = 'X' # all pages present
+CELL_SWAPPED        = 'S' # all pages swapped
+CELL_MOSTLYPRESENT  = 'x' # at least half of the pages present or swapped, more present
+CELL_MOSTLYSWAPPED  = 's' # at least half of the pages present or swapped, more swapped
+CELL_SPARSE         = ':' # less than half of the pages present or swapped
+
+
+def getPageStates(pia):
+    '''
+        returns the STATE_* values of the pages of a PageInfoArray as numpy
+        uint8 array
+    '''
+    return pia.present.astype(numpy.uint8) + STATE_SWAPPED * pia.swapped.astype(numpy.uint8)
+
+
+
+def _getRuns(values):
+    '''
+        private helper run-length encoding an array
+        returns a tuple (runvalues, runlengths)
+    '''
+    if len(values) == 0:
+        return values[:0], numpy.zeros(0, dtype=numpy.int64)
+    starts = numpy.concatenate(([0], numpy.flatnonzero(values[1:] != values[:-1]) + 1))
+    return values[starts], numpy.diff(numpy.concatenate((starts, [len(values)])))
+
+
+
+class DrawMap:
+    '''
+        collects page states batch by batch and renders them as lines of
+        text, consecutive identical lines are collapsed
+    '''
+    pagecount = 0
+
+    def __init__(self):
+        self._chunks = []   # list of (runvalues, runlengths) per add()
+        self._runs   = None # merged (runvalues, runlengths, runends)
+
+
+    def add(self, states):
+        '''
+            appends the states of the next pages
+            states -- numpy array of STATE_* values
+        '''
+        if len(states):
+            self._chunks.append(_getRuns(numpy.asarray(states, dtype=numpy.uint8)))
+            self.pagecount += len(states)
+            self._runs = None
+
+
+    def getRuns(self):
+        '''
+            returns a tuple of numpy arrays (runvalues, runlengths, runends)
+            of all pages added so far, runends holds the index behind every
+            run
+        '''
+        if self._runs is None:
+            if self._chunks:
+                values  = numpy.concatenate([chunk[0] for chunk in self._chunks])
+                lengths = numpy.concatenate([chunk[1] for chunk in self._chunks])
+            else:
+                values  = numpy.zeros(0, dtype=numpy.uint8)
+                lengths = numpy.zeros(0, dtype=numpy.int64)
+            # runs of neighbouring chunks can continue each other
+            values, counts = _getRuns(values)
+            groupstarts = numpy.concatenate(([0], numpy.cumsum(counts)[:-1])).astype(numpy.intp)
+            if len(lengths):
+                lengths = numpy.add.reduceat(lengths, groupstarts)
+            self._chunks = [(values, lengths)]
+            self._runs = (values, lengths, numpy.cumsum(lengths))
+        return self._runs
+
+
+    def _getStateCounts(self, positions):
+        '''
+            private helper counting the pages of every state before the given
+            page indices
+            positions -- sorted numpy array of page indices
+
+            returns a numpy array of shape (len(positions), 3)
+        '''
+        values, lengths, ends = self.getRuns()
+        # run containing each position and the pages of all runs before it
+        runidx  = numpy.searchsorted(ends, positions, side='right')
+        before  = numpy.concatenate(([0], ends))[runidx]
+        partial = positions - before
+
+        counts = numpy.zeros((len(positions), 3), dtype=numpy.int64)
+        for state in (STATE_ABSENT, STATE_PRESENT, STATE_SWAPPED):
+            statecum = numpy.concatenate(([0], numpy.cumsum(numpy.where(values == state, lengths, 0))))
+            counts[:, state] = statecum[runidx]
+            inrun = numpy.concatenate((values == state, [False]))[runidx]
+            counts[:, state] += numpy.where(inrun, partial, 0)
+        return counts
+
+
+    def _collapseLines(self, lines):
+        '''
+            private helper merging consecutive identical lines
+            lines -- iterable of (pageindex, line, repeat)
+
+            yields (pageindex, line, repeat)
+        '''
+        last = None
+        for pageindex, line, repeat in lines:
+            if last is not None and last[1] == line:
+                last[2] += repeat
+                continue
+            if last is not None:
+                yield tuple(last)
+            last = [pageindex, line, repeat]
+        if last is not None:
+            yield tuple(last)
+
+
+    def iterLines(self, width):
+        '''
+            renders one character per page (see DRAWCHARS)
+            width -- pages per line
+
+            yields tuples (pageindex, line, repeat), line is shown for the
+            pages starting at pageindex and repeats for repeat lines
+        '''
+        return self._collapseLines(self._iterFullLines(width))
+
+
+    def _iterFullLines(self, width):
+        '''
+            private helper for iterLines, a line inside a single run is built
+            without looking at the single pages and all following lines
+            inside that run are reported as repeats
+        '''
+        values, lengths, ends = self.getRuns()
+        starts = ends - lengths
+        pos = 0
+        run = 0
+        while pos < self.pagecount:
+            while ends[run] <= pos:
+                run += 1
+            stop = min(pos + width, self.pagecount)
+            if ends[run] >= stop:
+                repeat = max(1, (min(ends[run], self.pagecount) - pos) / width)
+                yield pos, str(DRAWCHARS[values[run]]) * (stop - pos), repeat
+                pos += repeat * width
+                continue
+
+            lastrun = run + numpy.searchsorted(ends[run:], stop)
+            seglengths = numpy.minimum(ends[run:lastrun + 1], stop) - numpy.maximum(starts[run:lastrun + 1], pos)
+            yield pos, DRAWCHARS[numpy.repeat(values[run:lastrun + 1], seglengths)].tostring(), 1
+            pos = stop
+
+
+    def iterCells(self, width, rows):
+        '''
+            renders the pages downsampled to at most width * rows cells, each
+            cell shows the mix of its pages (see CELL_*)
+            width -- cells per line
+            rows  -- maximum number of lines
+
+            yields tuples (pageindex, line, repeat) like iterLines, the pages
+            per cell are returned by getPagesPerCell
+        '''
+        if self.pagecount == 0:
+            return
+        pagespercell = self.getPagesPerCell(width, rows)
+        bounds = numpy.concatenate((numpy.arange(0, self.pagecount, pagespercell), [self.pagecount]))
+        counts = numpy.diff(self._getStateCounts(bounds), axis=0)
+
+        total   = counts.sum(axis=1)
+        present = counts[:, STATE_PRESENT]
+        swapped = counts[:, STATE_SWAPPED]
+        mapped  = present + swapped
+        cells = numpy.select([mapped == 0,
+                              present == total,
+                              swapped == total,
+                              2 * mapped < total,
+                              present >= swapped],
+                             [CELL_ABSENT, CELL_PRESENT, CELL_SWAPPED, CELL_SPARSE, CELL_MOSTLYPRESENT],
+                             CELL_MOSTLYSWAPPED).astype('S1')
+
+        lines = ((idx * pagespercell, cells[idx:idx + width].tostring(), 1) for idx in xrange(0, len(cells), width))
+        for pageindex, line, repeat in self._collapseLines(lines):
+            yield pageindex, line, repeat
+
+
+    def getPagesPerCell(self, width, rows):
+        '''
+            returns the number of pages in one cell of iterCells
+        '''
+        cells = width * rows
+        return max(1, (self.pagecount + cells - 1) / cells)
+
+
+
+class LineStream:
+    '''
+        renders page states like DrawMap.iterLines while they are added, only
+        the unfinished line and the last line (it may still repeat) are kept
+    '''
+    pagecount = 0
+
+    def __init__(self, width):
+        '''
+            width -- pages per line
+        '''
+        self.width  = width
+        self._carry = numpy.zeros(0, dtype=numpy.uint8) # states of the unfinished line
+        self._last  = None                              # [pageindex, line, repeat] not returned yet
+
+
+    def _push(self, lines):
+        '''
+            private helper merging lines into the held back last line
+            lines -- iterable of (pageindex, line, repeat)
+
+            returns the list of lines that can not change anymore
+        '''
+        ret = []
+        for pageindex, line, repeat in lines:
+            if self._last is not None and self._last[1] == line:
+                self._last[2] += repeat
+                continue
+            if self._last is not None:
+                ret.append(tuple(self._last))
+            self._last = [pageindex, line, repeat]
+        return ret
+
+
+    def add(self, states):
+        '''
+            appends the states of the next pages
+            states -- numpy array of STATE_* values
+
+            returns a list of finished (pageindex, line, repeat) tuples
+        '''
+        start  = self.pagecount - len(self._carry)
+        states = numpy.concatenate((self._carry, numpy.asarray(states, dtype=numpy.uint8)))
+        self.pagecount = start + len(states)
+        full = len(states) / self.width * self.width
+        self._carry = states[full:].copy()
+        if full == 0:
+            return []
+        dm = DrawMap()
+        dm.add(states[:full])
+        return self._push((start + pageindex, line, repeat) for pageindex, line, repeat in dm._iterFullLines(self.width))
+
+
+    def finish(self):
+        '''
+            returns the remaining (pageindex, line, repeat) tuples after the
+            last add()
+        '''
+        lines = []
+        if len(self._carry):
+            lines.append((self.pagecount - len(self._carry), DRAWCHARS[self._carry].tostring(), 1))
+            self._carry = self._carry[:0]
+        ret = self._push(lines)
+        if self._last is not None:
+            ret.append(tuple(self._last))
+            self._last = None
+        return ret
@@ -22,11 +22,20 @@
 
 # Parser for /proc/smaps information
 
+import bisect
+import instrument
 import os
-import re
 import sys
 import logging
 
+from itertools import compress, count, groupby, imap
+from operator import itemgetter, sub
+
+try:
+    import numpy
+except ImportError:
+    numpy = None # only needed for MapIndex.lookupArray
+
 lh = logging.getLogger(__name__)
 info    = lh.info
 debug   = lh.debug
@@ -34,36 +43,102 @@ error   = lh.error
 warning = lh.warning
 
 
-class MapEntry:
+# smaps field name -> MapEntry attribute, values in kB are stored in bytes
+_KBFIELDS = {
+    'Size'            : 'size',
+    'KernelPageSize'  : 'kernelpagesize',
+    'MMUPageSize'     : 'mmupagesize',
+    'Rss'             : 'rss',
+    'Pss'             : 'pss',
+    'Pss_Dirty'       : 'pss_dirty',
+    'Pss_Anon'        : 'pss_anon',
+    'Pss_File'        : 'pss_file',
+    'Pss_Shmem'       : 'pss_shmem',
+    'Shared_Clean'    : 'shared_clean',
+    'Shared_Dirty'    : 'shared_dirty',
+    'Private_Clean'   : 'private_clean',
+    'Private_Dirty'   : 'private_dirty',
+    'Referenced'      : 'referenced',
+    'Anonymous'       : 'anonymous',
+    'KSM'             : 'ksm',
+    'LazyFree'        : 'lazyfree',
+    'AnonHugePages'   : 'anonhugepages',
+    'ShmemPmdMapped'  : 'shmempmdmapped',
+    'FilePmdMapped'   : 'filepmdmapped',
+    'Shared_Hugetlb'  : 'shared_hugetlb',
+    'Private_Hugetlb' : 'private_hugetlb',
+    'Swap'            : 'swap',
+    'SwapPss'         : 'swappss',
+    'Locked'          : 'locked',
+}
+
+# smaps fields that are plain numbers
+_NUMFIELDS = {
+    'THPeligible'     : 'thpeligible',
+    'ProtectionKey'   : 'protectionkey',
+}
+
+# order in which MapEntry.__repr__ prints the fields
+_FIELDORDER = ("size", "rss", "pss", "pss_dirty", "pss_anon", "pss_file", "pss_shmem",
+               "shared_clean", "shared_dirty", "private_clean", "private_dirty", "referenced",
+               "anonymous", "ksm", "lazyfree", "anonhugepages", "shmempmdmapped", "filepmdmapped",
+               "shared_hugetlb", "private_hugetlb", "swap", "swappss", "kernelpagesize", "mmupagesize",
+               "locked", "thpeligible", "protectionkey")
+
+
+class MapEntry(object):
     VM_READ     = 1
     VM_WRITE    = 2
     VM_EXEC     = 4
     VM_MAYSHARE = 8
 
-    startaddress = None # starting address of mapping
-    stopaddress  = None # final address of mapping (exclusive)
-    access       = None # one of the VM-flags
-    offset       = None # offset into file (if it's a mapped file)
-    devicemajor  = None # device major
-    deviceminor  = None # device minor
-    inode        = None # inode (of mapped file or of device file (not the device itself!))
-    
-    name         = None # name of mapping, can also be an empty string if not stated
-
-    size           = None # total size
-    rss            = None # resident set size
-    pss            = None # proportional set size (estimate)
-    shared_clean   = None
-    shared_dirty   = None
-    private_clean  = None
-    private_dirty  = None
-    referenced     = None
-    anonymous      = None
-    anonhugepages  = None
-    swap           = None
-    kernelpagesize = None
-    mmupagesize    = None
-    locked         = None
+    # there are tens of thousands of entries for big processes
+    __slots__ = ("startaddress", "stopaddress", "access", "offset", "devicemajor", "deviceminor", "inode", "name",
+                 "vmflags", "extrafields") + _FIELDORDER
+
+    def __init__(self):
+        self.startaddress = None # starting address of mapping
+        self.stopaddress  = None # final address of mapping (exclusive)
+        self.access       = None # one of the VM-flags
+        self.offset       = None # offset into file (if it's a mapped file)
+        self.devicemajor  = None # device major
+        self.deviceminor  = None # device minor
+        self.inode        = None # inode (of mapped file or of device file (not the device itself!))
+
+        self.name         = None # name of mapping, can also be an empty string if not stated
+
+        # sizes in bytes, see _KBFIELDS
+        self.size            = None # total size
+        self.rss             = None # resident set size
+        self.pss             = None # proportional set size (estimate)
+        self.pss_dirty       = None
+        self.pss_anon        = None
+        self.pss_file        = None
+        self.pss_shmem       = None
+        self.shared_clean    = None
+        self.shared_dirty    = None
+        self.private_clean   = None
+        self.private_dirty   = None
+        self.referenced      = None
+        self.anonymous       = None
+        self.ksm             = None
+        self.lazyfree        = None
+        self.anonhugepages   = None
+        self.shmempmdmapped  = None
+        self.filepmdmapped   = None
+        self.shared_hugetlb  = None
+        self.private_hugetlb = None
+        self.swap            = None
+        self.swappss         = None
+        self.kernelpagesize  = None
+        self.mmupagesize     = None
+        self.locked          = None
+
+        self.thpeligible     = None
+        self.protectionkey   = None
+
+        self.vmflags      = None # list of two letter VmFlags mnemonics
+        self.extrafields  = None # dict of fields unknown to MapEntry, values as string
 
     
     def __repr__(self):
@@ -71,15 +146,17 @@ class MapEntry:
             dumps all information
         '''
         s = "<MapEntry start:%08x stop:%08x access:%s offset:%d dev:%d:%d inode:%d name:'%s'" % (
-                self.startaddress, self.stopaddress, ','.join(self.getAccessString()),
+                self.startaddress, self.stopaddress, self.getAccessString(),
                 self.offset, self.devicemajor, self.deviceminor, self.inode, self.name)
         
-        s += " size:%d rss:%d pss:%d shared_clean:%d shared_dirty:%d private_clean:%d private_dirty:%d referenced:%d" % (
-                self.size, self.rss, self.pss, self.shared_clean, self.shared_dirty,
-                self.private_clean, self.private_dirty, self.referenced)
-
-        s += " anonymous:%d anonhugepages:%d swap:%d kernelpagesize:%d mmupagesize:%d locked:%d>" % (
-                self.anonymous, self.anonhugepages, self.swap, self.kernelpagesize, self.mmupagesize, self.locked)
+        # only fields that were reported, e.g. /proc/<pid>/maps has none of them
+        for field in _FIELDORDER:
+            value = getattr(self, field)
+            if value is not None:
+                s += " %s:%d" % (field, value)
+        if self.vmflags is not None:
+            s += " vmflags:%s" % ','.join(self.vmflags)
+        s += ">"
         return s
 
 
@@ -88,55 +165,44 @@ class MapEntry:
             helper to parse textual access information to flags
             accesstr -- string as extracted from the procfs smaps line
         '''
-        self.access = 0
-        for letter in accessstr:
-            if letter == 'r':
-                self.access |= self.VM_READ
-            elif letter == 'w':
-                self.access |= self.VM_WRITE
-            elif letter == 'x':
-                self.access |= self.VM_EXEC
-            elif letter == 's':
-                self.access |= self.VM_MAYSHARE
+        access = _ACCESSCACHE.get(accessstr)
+        if access is None:
+            access = 0
+            for letter in accessstr:
+                if letter == 'r':
+                    access |= self.VM_READ
+                elif letter == 'w':
+                    access |= self.VM_WRITE
+                elif letter == 'x':
+                    access |= self.VM_EXEC
+                elif letter == 's':
+                    access |= self.VM_MAYSHARE
+            _ACCESSCACHE[accessstr] = access
+        self.access = access
 
 
     def setField(self, prop, value):
         '''
             helper to assign the texual field name to its property
             prop  -- property as extracted from the procfs smaps line
-            value -- values in bytes(!) as extracted from the procfs smaps line
-        '''
-        bytecount = int(value) * (1<<10)
-        if prop == 'Rss':
-            self.rss = bytecount
-        elif prop == 'Pss':
-            self.pss = bytecount
-        elif prop == 'Size':
-            self.size = bytecount
-        elif prop == 'Shared_Clean':
-            self.shared_clean = bytecount
-        elif prop == 'Shared_Dirty':
-            self.shared_dirty = bytecount
-        elif prop == 'Private_Clean':
-            self.private_clean = bytecount
-        elif prop == 'Private_Dirty':
-            self.private_dirty = bytecount
-        elif prop == 'Referenced':
-            self.referenced = bytecount
-        elif prop == 'Anonymous':
-            self.anonymous = bytecount
-        elif prop == 'AnonHugePages':
-            self.anonhugepages = bytecount
-        elif prop == 'Swap':
-            self.swap = bytecount
-        elif prop == 'KernelPageSize':
-            self.kernelpagesize = bytecount
-        elif prop == 'MMUPageSize':
-            self.mmupagesize = bytecount
-        elif prop == 'Locked':
-            self.locked = bytecount
+            value -- value as extracted from the procfs smaps line (without
+                     the kB unit), sizes are stored in bytes(!)
+        '''
+        field = _KBFIELDS.get(prop)
+        if field is not None:
+            setattr(self, field, int(value) << 10)
+            return
+
+        field = _NUMFIELDS.get(prop)
+        if field is not None:
+            setattr(self, field, int(value))
+        elif prop == 'VmFlags':
+            self.vmflags = value.split()
         else:
-            warning("MapEntry.setField: unknown property '%s', ignored" % prop)
+            # keep whatever new fields the kernel reports
+            if self.extrafields is None:
+                self.extrafields = {}
+            self.extrafields[prop] = value.strip()
 
 
     def getAccessString(self):
@@ -150,6 +216,29 @@ class MapEntry:
         if self.access & self.VM_MAYSHARE:
             accesslist.append("VM_MAYSHARE")
         return ','.join(accesslist)
+
+
+# access string -> flags, there are only a handful of different ones
+_ACCESSCACHE = {}
+
+class _KBValues(dict):
+    '''
+        maps a textual kB value to its byte count, most values of a smaps
+        file repeat (0 kB, 4 kB, ...) and are converted only once
+    '''
+    def __missing__(self, value):
+        bytecount = self[value] = int(value) << 10
+        return bytecount
+
+
+# first characters of a mapping header line, field lines start with a letter
+_HEXDIGITS = frozenset("0123456789abcdef")
+
+# runs of fewer equally laid out mappings are not worth a columnar pass
+_MINCOLUMNRUN = 8
+
+# mount point of the procfs, can be pointed at a copy or a generated tree
+PROCROOT = "/proc"
         
 
 
@@ -161,23 +250,35 @@ class SMaps:
     
     #
     _filename      = None
+    _smapsfilename = None
     
-    def __init__(self, pid):
+    def __init__(self, pid, procroot = PROCROOT):
         '''
             parse information from /proc filesystem for given pid
             result is written to self.maplist
-            pid -- pid as a decimal number, can be a string or a number
+            pid      -- pid as a decimal number, can be a string or a number
+            procroot -- directory to read <pid>/smaps from
+        '''
+        self._filename = "%s/%d/smaps" % (procroot, int(pid))
+        self._readFile()
+
+
+    def _readFile(self):
+        '''
+            private helper to read and parse self._filename
         '''
-        self._filename = "/proc/%d/smaps" % int(pid)
         if not os.path.exists(self._filename):
             errmsg = "SMaps: smaps file '%s' does not exist" % self._filename
             error(errmsg)
             raise IOError, errmsg
 
         try:
-            with open(self._filename, 'rb') as fh:
-                smapsbuffer = fh.read()
-                self._parseFile(smapsbuffer)
+            with instrument.stage("smaps.read") as st:
+                with open(self._filename, 'rb') as fh:
+                    smapsbuffer = fh.read()
+                # open and read, the kernel may hand out the file in pieces
+                st.add(bytes = len(smapsbuffer), syscalls = 2)
+            self._parseFile(smapsbuffer)
             if len(self.maplist) == 0:
                 error("SMaps: no mapping found in '%s'" % self._filename)
         except BaseException, exc:
@@ -186,45 +287,355 @@ class SMaps:
             raise
 
 
+    def _parseHeader(self, l):
+        '''
+            private helper function to parse a mapping header line
+            l -- line from the smaps or maps file
+
+            returns a new MapEntry or None if l is not a header line
+        '''
+        # start-stop access offset devmajor:devminor inode [name]
+        parts = l.split(None, 5)
+        if len(parts) < 5:
+            return None
+        addresses, access, offset, device, inode = parts[:5]
+        start, sep1, stop   = addresses.partition('-')
+        devmaj, sep2, devmin = device.partition(':')
+        if not sep1 or not sep2:
+            return None
+
+        me = MapEntry()
+        try:
+            me.startaddress = int(start,16)
+            me.stopaddress  = int(stop,16)
+            me.offset       = int(offset,16)
+            me.devicemajor  = int(devmaj,16)
+            me.deviceminor  = int(devmin,16)
+            me.inode        = int(inode)
+        except ValueError:
+            return None
+        me.setAccess(access)
+        if len(parts) > 5:
+            me.name = parts[5].strip()
+        else:
+            me.name = ''
+        return me
+
+
+    def _parseField(self, me, l):
+        '''
+            private helper function to parse a field line into a MapEntry
+            me -- MapEntry the field belongs to
+            l  -- line from the smaps file
+
+            returns False if l is not a field line
+        '''
+        prop, sep, value = l.partition(':')
+        if not sep:
+            return False
+
+        value = value.strip()
+        if value.endswith(' kB'):
+            value = value[:-3]
+        try:
+            me.setField(prop, value)
+        except ValueError:
+            return False
+        return True
+
+
     def _parseFile(self, smapsbuffer):
         '''
             private helper function to parse the smaps buffer to the class fields
             buffer -- buffer containing the smaps file
         '''
-        self.maplist = []
+        with instrument.stage("smaps.parse") as st:
+            lines = smapsbuffer.splitlines()
+            self.maplist = self._parseColumns(lines)
+            if self.maplist is None:
+                self.maplist = self._parseRuns(lines)
+            st.add(bytes = len(smapsbuffer))
+
+
+    def _parseColumns(self, lines):
+        '''
+            private helper function for the common case that every mapping
+            has the same fields in the same order. Each field is then a column
+            of every n-th line which is converted and assigned as a whole.
+            lines -- lines of the smaps file
+
+            returns the list of MapEntries or None if the layout is irregular
+        '''
+        if not lines or lines[0][:1] not in _HEXDIGITS:
+            return None
+
+        # distance between two header lines
+        blocklen = 1
+        while blocklen < len(lines) and lines[blocklen][:1] not in _HEXDIGITS:
+            blocklen += 1
+        if len(lines) % blocklen:
+            return None
+
+        maplist = map(self._parseHeader, lines[::blocklen])
+        if None in maplist:
+            return None
+
+        kbvalues = _KBValues()
+
+        for idx in range(1, blocklen):
+            prop, sep, value = lines[idx].partition(':')
+            if not sep:
+                return None
+            prefix = prop + ':'
+            column = lines[idx::blocklen]
+            if map(itemgetter(slice(None, len(prefix))), column).count(prefix) != len(column):
+                return None
+
+            values = imap(itemgetter(slice(len(prefix), None)), column)
+            try:
+                # slicing, conversion and assignment all run as builtins
+                if prop in _KBFIELDS and value.endswith(' kB'):
+                    values = map(kbvalues.__getitem__, imap(itemgetter(slice(len(prefix), -3)), column))
+                    map(getattr(MapEntry, _KBFIELDS[prop]).__set__, maplist, values)
+                elif prop in _NUMFIELDS:
+                    map(getattr(MapEntry, _NUMFIELDS[prop]).__set__, maplist, map(int, values))
+                elif prop == 'VmFlags':
+                    map(MapEntry.vmflags.__set__, maplist, map(str.split, values))
+                else:
+                    for me, l in zip(maplist, column):
+                        me.setField(prop, l[len(prefix):])
+            except ValueError:
+                return None
+
+        return maplist
+
+
+    def _parseRuns(self, lines):
+        '''
+            private helper function for an irregular layout, usually only a
+            few mappings differ (a field missing or added by the kernel). The
+            file is cut into runs of mappings with the same number of lines,
+            each of them is parsed column-wise if its fields line up and line
+            by line otherwise.
+            lines -- lines of the smaps file
+
+            returns the list of MapEntries
+        '''
+        headers = list(compress(count(), imap(_HEXDIGITS.__contains__, imap(itemgetter(slice(None, 1)), lines))))
+        headers.append(len(lines))
+
+        maplist = []
+        if headers[0]:
+            # stray lines before the first mapping, reported by _parseLines
+            self._parseLines(lines[:headers[0]], maplist)
+
+        # consecutive mappings with the same distance between their headers
+        start = 0
+        for blocklen, run in groupby(map(sub, headers[1:], headers[:-1])):
+            stop = start + len(list(run))
+            runlines = lines[headers[start]:headers[stop]]
+            entries = None
+            if stop - start >= _MINCOLUMNRUN:
+                entries = self._parseColumns(runlines)
+            if entries is None:
+                self._parseLines(runlines, maplist)
+            else:
+                maplist.extend(entries)
+            start = stop
+
+        return maplist
+
+
+    def _parseLines(self, lines, maplist):
+        '''
+            private helper function to parse the smaps lines one by one
+            lines   -- lines of the smaps file
+            maplist -- list the parsed MapEntries are appended to
+        '''
         currententry = None
-        for l in smapsbuffer.splitlines():
-            m = re.match(r'''([0-9a-f]+)-([0-9a-f]+)\s+([rwxsp-]+)\s+([0-9a-f]+)\s+([0-9a-f]+):([0-9a-f]+)\s+(\d+)(.+)''', l)
-            if m != None:
+        kbvalues     = _KBValues()
+
+        for l in lines:
+            # most lines are size fields following the mapping header
+            prop, sep, value = l.partition(':')
+            field = _KBFIELDS.get(prop)
+            if field is not None and currententry is not None and value.endswith(' kB'):
+                setattr(currententry, field, kbvalues[value[:-3]])
+                continue
+
+            if l[:1] in _HEXDIGITS:
                 # mapping header, create a new MapEntry
-                start, stop, access, offset, devmaj, devmin, inode, name = m.groups()
-                
-                currententry = MapEntry()
-                currententry.name         = name.strip()
-                currententry.startaddress = int(start,16)
-                currententry.stopaddress  = int(stop,16)
-                currententry.setAccess(access)
-                currententry.offset       = int(offset,16)
-                currententry.devicemajor  = int(devmaj,16)
-                currententry.deviceminor  = int(devmin,16)
-                currententry.inode        = int(inode)
-                
-                self.maplist.append(currententry)
-            else:
-                # see if it's a field line following MapEntry
-                m = re.match(r'''(.+?):\s+(\d+)\s+kB''', l)
-                if m != None:
-                    if currententry:
-                        prop, value = m.groups()
-                        currententry.setField(prop, value)
-                    else:
-                        warning("_parseFile: missing mapping header line before field line '%s'" % l.strip())
-                else:
-                    warning("_parseFile: unable to parse line: %s" % l.strip())
-                    continue # nothing found, shouldn't happen
+                me = self._parseHeader(l)
+                if me is not None:
+                    currententry = me
+                    maplist.append(currententry)
+                    continue
+            elif currententry is not None:
+                if self._parseField(currententry, l):
+                    continue
+            elif l.strip():
+                warning("_parseFile: missing mapping header line before field line '%s'" % l.strip())
+                continue
+
+            if l.strip():
+                warning("_parseFile: unable to parse line: %s" % l.strip())
    
 
 
+class Maps(SMaps):
+    '''
+        like SMaps but reads only the mapping headers from /proc/<pid>/maps,
+        this is much cheaper since the kernel does not have to walk the page
+        tables. The MapEntry fields (rss, kernelpagesize, ...) stay None
+        but can be fetched on demand with getDetails.
+    '''
+    def __init__(self, pid, procroot = PROCROOT):
+        '''
+            parse information from /proc filesystem for given pid
+            result is written to self.maplist
+            pid      -- pid as a decimal number, can be a string or a number
+            procroot -- directory to read <pid>/maps and <pid>/smaps from
+        '''
+        self._filename      = "%s/%d/maps" % (procroot, int(pid))
+        self._smapsfilename = "%s/%d/smaps" % (procroot, int(pid))
+        self._readFile()
+
+
+    def getDetails(self, me):
+        '''
+            fills in the smaps fields of a single mapping, the smaps file is
+            only read up to that mapping
+            me -- MapEntry from self.maplist
+
+            returns me, raises KeyError if the mapping does not exist anymore
+        '''
+        found = False
+        with open(self._smapsfilename, 'rb') as fh:
+            for l in fh:
+                header = self._parseHeader(l)
+                if header != None:
+                    if found:
+                        break
+                    if header.startaddress > me.startaddress:
+                        # smaps is sorted by address
+                        break
+                    found = (header.startaddress == me.startaddress and header.stopaddress == me.stopaddress)
+                elif found:
+                    if not self._parseField(me, l):
+                        warning("getDetails: unable to parse line: %s" % l.strip())
+
+        if not found:
+            raise KeyError, "getDetails: mapping %x-%x not found in '%s'" % (me.startaddress, me.stopaddress, self._smapsfilename)
+        return me
+
+
+
+class SMapsRollup(SMaps):
+    '''
+        like SMaps but reads the accumulated fields of all mappings from
+        /proc/<pid>/smaps_rollup
+    '''
+    rollup = None # MapEntry covering the whole address space with the totals
+
+    def __init__(self, pid, procroot = PROCROOT):
+        '''
+            parse information from /proc filesystem for given pid
+            result is written to self.rollup
+            pid      -- pid as a decimal number, can be a string or a number
+            procroot -- directory to read <pid>/smaps_rollup from
+        '''
+        self._filename = "%s/%d/smaps_rollup" % (procroot, int(pid))
+        self._readFile()
+        if self.maplist:
+            self.rollup = self.maplist[0]
+
+
+
+class MapIndex:
+    '''
+        sorted index over the address ranges of MapEntries (they never
+        overlap) to resolve addresses to their mapping
+    '''
+    maplist = None # MapEntries sorted by address
+
+    _starts     = None # start addresses of maplist
+    _stops      = None # stop addresses of maplist
+    _startarray = None # numpy copies of _starts/_stops, built on demand
+    _stoparray  = None
+
+    def __init__(self, maplist):
+        '''
+            maplist -- list of MapEntries, e.g. SMaps.maplist
+        '''
+        self.maplist = sorted(maplist, key = lambda me: me.startaddress)
+        self._starts = [me.startaddress for me in self.maplist]
+        self._stops  = [me.stopaddress for me in self.maplist]
+
+
+    def __len__(self):
+        return len(self.maplist)
+
+
+    def lookup(self, address):
+        '''
+            returns the MapEntry containing address or None
+        '''
+        idx = bisect.bisect_right(self._starts, address) - 1
+        if idx >= 0 and address < self._stops[idx]:
+            return self.maplist[idx]
+        return None
+
+
+    def lookupArray(self, addresses):
+        '''
+            resolves many addresses at once
+            addresses -- numpy uint64 array (or sequence) of addresses
+
+            returns a numpy array with the index into self.maplist for every
+            address, -1 for addresses outside of all mappings
+        '''
+        if numpy is None:
+            raise ImportError, "lookupArray: needs numpy (available on PyPi)"
+        if self._startarray is None:
+            self._startarray = numpy.array(self._starts, dtype=numpy.uint64)
+            self._stoparray  = numpy.array(self._stops, dtype=numpy.uint64)
+
+        addresses = numpy.asarray(addresses, dtype=numpy.uint64)
+        ret = numpy.searchsorted(self._startarray, addresses, side='right').astype(numpy.intp) - 1
+        inside = ret >= 0
+        inside[inside] = addresses[inside] < self._stoparray[ret[inside]]
+        ret[~inside] = -1
+        return ret
+
+
+    def update(self, removed, added):
+        '''
+            changes the index without rebuilding it, for refreshes where only
+            a few mappings change
+            removed -- MapEntries (or entries with the same address range) to drop
+            added   -- MapEntries to insert
+        '''
+        for me in removed:
+            idx = bisect.bisect_left(self._starts, me.startaddress)
+            if idx < len(self._starts) and self._starts[idx] == me.startaddress and self._stops[idx] == me.stopaddress:
+                del self.maplist[idx]
+                del self._starts[idx]
+                del self._stops[idx]
+            else:
+                warning("MapIndex.update: mapping %x-%x not in index" % (me.startaddress, me.stopaddress))
+
+        for me in added:
+            idx = bisect.bisect_left(self._starts, me.startaddress)
+            self.maplist.insert(idx, me)
+            self._starts.insert(idx, me.startaddress)
+            self._stops.insert(idx, me.stopaddress)
+
+        if removed or added:
+            self._startarray = None
+            self._stoparray  = None
+
+
+
 
 if __name__ == '__main__':
     # enable logging
@@ -245,3 +656,43 @@ if __name__ == '__main__':
         raise
         sys.exit(1)
 
+    try:
+        m = Maps(os.getpid())
+        if (m.maplist[0].startaddress, m.maplist[0].stopaddress) != (s.maplist[0].startaddress, s.maplist[0].stopaddress):
+            raise ValueError, "Error: maps and smaps mappings differ"
+        me = m.getDetails(m.maplist[0])
+        if me.rss != s.maplist[0].rss:
+            raise ValueError, "Error: getDetails rss %s differs from smaps rss %s" % (me.rss, s.maplist[0].rss)
+        print("SUCCESS: 'Maps' test")
+    except BaseException, exc:
+        print("unexpected exception: %s %s" % (exc, type(exc)))
+        raise
+
+    try:
+        r = SMapsRollup(os.getpid())
+        if r.rollup.rss is None:
+            raise ValueError, "Error: no rss in smaps_rollup"
+        print("SUCCESS: 'SMapsRollup' test")
+    except BaseException, exc:
+        print("unexpected exception: %s %s" % (exc, type(exc)))
+        raise
+
+    try:
+        idx = MapIndex(s.maplist)
+        me = s.maplist[len(s.maplist) / 2]
+        if idx.lookup(me.startaddress) is not me or idx.lookup(me.stopaddress - 1) is not me:
+            raise ValueError, "Error: lookup did not return the mapping"
+        if idx.lookup(0) is not None:
+            raise ValueError, "Error: lookup of address 0 returned a mapping"
+        if numpy and list(idx.lookupArray([0, me.startaddress])) != [-1, idx.maplist.index(me)]:
+            raise ValueError, "Error: lookupArray did not return the mappings"
+        idx.update([me], [])
+        if idx.lookup(me.startaddress) is not None:
+            raise ValueError, "Error: lookup returned a removed mapping"
+        idx.update([], [me])
+        if idx.lookup(me.startaddress) is not me:
+            raise ValueError, "Error: lookup did not return the readded mapping"
+        print("SUCCESS: 'MapIndex' test")
+    except BaseException, exc:
+        print("unexpected exception: %s %s" % (exc, type(exc)))
+        raise
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2013, Carsten Juttner <carjay@gmx.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Compares two snapshots of a process page by page, the mappings are matched
+# by start, stop and inode and their pagemap columns compared as a whole
+
+import argparse
+import logging
+import pagemap
+import snapshot
+import sys
+
+try:
+    import numpy
+except ImportError:
+    print("needs numpy (available on PyPi)")
+    sys.exit(1)
+
+lh = logging.getLogger(__name__)
+info    = lh.info
+debug   = lh.debug
+error   = lh.error
+warning = lh.warning
+
+
+# kinds of page changes
+DIFF_APPEARED    = "appeared"    # not present before, present after
+DIFF_DISAPPEARED = "disappeared" # present before, not present after
+DIFF_SWAPPEDOUT  = "swappedout"  # not swapped before, swapped after
+DIFF_SWAPPEDIN   = "swappedin"   # swapped before, not swapped after
+DIFF_PFNCHANGED  = "pfnchanged"  # present before and after on another page frame
+
+DIFF_KINDS = (DIFF_APPEARED, DIFF_DISAPPEARED, DIFF_SWAPPEDOUT, DIFF_SWAPPEDIN, DIFF_PFNCHANGED)
+
+def getMaskRanges(mask):
+    '''
+        finds the runs of True in a boolean array
+        mask -- numpy bool array
+
+        returns a tuple (starts, stops) of numpy arrays with the index of
+        the first and behind the last element of every run
+    '''
+    edges  = numpy.diff(numpy.concatenate(([False], mask, [False])).view(numpy.int8))
+    starts = numpy.flatnonzero(edges == 1)
+    stops  = numpy.flatnonzero(edges == -1)
+    return starts, stops
+
+
+
+class MappingDiff:
+    '''
+        holds the page changes of one mapping present in both snapshots
+    '''
+    key      = None # (startaddress, stopaddress, inode)
+    name     = None
+    pagesize = None
+    counts   = None # dict of DIFF_* -> number of pages
+    changed  = 0    # number of pages with any change, the kinds overlap
+    ranges   = None # dict of DIFF_* -> (starts, stops), numpy arrays of
+                    # virtual addresses (stop exclusive)
+
+    def getChangedCount(self):
+        '''
+            returns the number of pages with any change
+        '''
+        return self.changed
+
+
+    def __repr__(self):
+        return "<MappingDiff %x-%x '%s' %s>" % (self.key[0], self.key[1], self.name,
+                                                " ".join("%s:%d" % (kind, self.counts[kind]) for kind in DIFF_KINDS))
+
+
+
+class SnapshotDiff:
+    '''
+        compares two snapshots of the same process
+    '''
+    added    = None # list of MapEntry instances only in the second snapshot
+    removed  = None # list of MapEntry instances only in the first snapshot
+    mappings = None # list of MappingDiff instances in address order
+
+    def __init__(self, before, after):
+        '''
+            before -- Snapshot instance of the earlier state
+            after  -- Snapshot instance of the later state
+        '''
+        if before.pagesize != after.pagesize:
+            raise ValueError, "SnapshotDiff: page sizes differ (%d, %d)" % (before.pagesize, after.pagesize)
+
+        beforeidx = self._getKeyIndex(before)
+        afteridx  = self._getKeyIndex(after)
+
+        self.removed  = [before.getMapEntry(idx) for key, idx in sorted(beforeidx.iteritems()) if key not in afteridx]
+        self.added    = [after.getMapEntry(idx) for key, idx in sorted(afteridx.iteritems()) if key not in beforeidx]
+        self.mappings = []
+        for key in sorted(set(beforeidx) & set(afteridx)):
+            self.mappings.append(self._compareMapping(key, before.pagesize, after.getName(afteridx[key]),
+                                                      before.getPageMap(beforeidx[key]), after.getPageMap(afteridx[key])))
+
+
+    def _getKeyIndex(self, snap):
+        '''
+            private helper returning a dict of (startaddress, stopaddress,
+            inode) -> index into the mapping table of snap
+        '''
+        table = snap.maptable
+        keys = zip(table["startaddress"].tolist(), table["stopaddress"].tolist(), table["inode"].tolist())
+        return dict((key, idx) for idx, key in enumerate(keys))
+
+
+    def _compareMapping(self, key, pagesize, name, before, after):
+        '''
+            private helper comparing the pagemap words of one mapping
+            before -- numpy uint64 array of the earlier state
+            after  -- numpy uint64 array of the later state
+
+            returns a MappingDiff instance
+        '''
+        md = MappingDiff()
+        md.key      = key
+        md.name     = name
+        md.pagesize = pagesize
+        md.counts   = {}
+        md.ranges   = {}
+
+        presentbefore = (before & pagemap._PM_PRESENT) != 0
+        presentafter  = (after & pagemap._PM_PRESENT) != 0
+        swappedbefore = (before & pagemap._PM_SWAPPED) != 0
+        swappedafter  = (after & pagemap._PM_SWAPPED) != 0
+
+        masks = {}
+        masks[DIFF_APPEARED]    = ~presentbefore & presentafter
+        masks[DIFF_DISAPPEARED] = presentbefore & ~presentafter
+        masks[DIFF_SWAPPEDOUT]  = ~swappedbefore & swappedafter
+        masks[DIFF_SWAPPEDIN]   = swappedbefore & ~swappedafter
+        masks[DIFF_PFNCHANGED]  = presentbefore & presentafter & ((before & pagemap._PM_PFN) != (after & pagemap._PM_PFN))
+
+        changed = numpy.zeros(len(before), dtype=bool)
+        for kind, mask in masks.iteritems():
+            changed |= mask
+            md.counts[kind] = int(numpy.count_nonzero(mask))
+            starts, stops = getMaskRanges(mask)
+            md.ranges[kind] = (numpy.uint64(key[0]) + starts.astype(numpy.uint64) * numpy.uint64(pagesize),
+                               numpy.uint64(key[0]) + stops.astype(numpy.uint64) * numpy.uint64(pagesize))
+        md.changed = int(numpy.count_nonzero(changed))
+        return md
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "compare two memview snapshots of a process")
+    parser.add_argument("before", help = "snapshot of the earlier state")
+    parser.add_argument("after", help = "snapshot of the later state")
+    parser.add_argument("-r", "--ranges", action = "store_true", help = "list the changed address ranges")
+    args = parser.parse_args()
+
+    logging.basicConfig(level = logging.INFO)
+
+    before = snapshot.Snapshot(args.before)
+    after  = snapshot.Snapshot(args.after)
+    d = SnapshotDiff(before, after)
+
+    for me in d.removed:
+        print("- %x-%x '%s'" % (me.startaddress, me.stopaddress, me.name))
+    for me in d.added:
+        print("+ %x-%x '%s'" % (me.startaddress, me.stopaddress, me.name))
+
+    for md in d.mappings:
+        if not md.getChangedCount():
+            continue
+        print("  %x-%x %-40s %s" % (md.key[0], md.key[1], "'%s'" % md.name,
+                                    " ".join("%s:%d" % (kind, md.counts[kind]) for kind in DIFF_KINDS if md.counts[kind])))
+        if args.ranges:
+            for kind in DIFF_KINDS:
+                starts, stops = md.ranges[kind]
+                for start, stop in zip(starts, stops):
+                    print("    %-12s %x-%x" % (kind, start, stop))
+
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2013, Carsten Juttner <carjay@gmx.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Snapshots of the page state of a process, written once and memory mapped
+# for analysis (possibly on another machine)
+#
+# File format, all values little endian:
+#
+#   header (72 bytes)
+#     8s  magic "MEMVSNAP"
+#     u32 version (1)
+#     u32 pagesize of the pagemap entries
+#     u32 columns, bitmask of SNAPSHOT_PAGEMAP, SNAPSHOT_KPAGECOUNT and
+#         SNAPSHOT_KPAGEFLAGS
+#     u32 reserved (0)
+#     u64 pid
+#     f64 timestamp (seconds since the epoch)
+#     u64 number of mappings
+#     u64 file offset of the mapping table
+#     u64 file offset of the string table
+#     u64 size of the string table
+#
+#   page data
+#     for every mapping the columns in the order pagemap, kpagecount,
+#     kpageflags (only the ones in the columns bitmask), each is an array of
+#     pagecount u64 words starting at an 8 byte aligned offset. The words are
+#     stored exactly as read from /proc/<pid>/pagemap, /proc/kpagecount and
+#     /proc/kpageflags, pages that could not be read are 0.
+#
+#   mapping table, one 80 byte record per mapping in address order, see
+#   _MAPTABLE_DTYPE
+#
+#   string table, the mapping names (utf-8) one after the other
+
+import logging
+import mmap
+import os
+import pagemap
+import smaps
+import struct
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+lh = logging.getLogger(__name__)
+info    = lh.info
+debug   = lh.debug
+error   = lh.error
+warning = lh.warning
+
+
+SNAPSHOT_MAGIC   = "MEMVSNAP"
+SNAPSHOT_VERSION = 1
+
+# column bits
+SNAPSHOT_PAGEMAP    = 1 << 0
+SNAPSHOT_KPAGECOUNT = 1 << 1
+SNAPSHOT_KPAGEFLAGS = 1 << 2
+
+_HEADER = struct.Struct("<8sIIIIQdQQQQ")
+
+if numpy:
+    _MAPTABLE_DTYPE = numpy.dtype([("startaddress", "<u8"),
+                                   ("stopaddress",  "<u8"),
+                                   ("offset",       "<u8"),
+                                   ("inode",        "<u8"),
+                                   ("devicemajor",  "<u4"),
+                                   ("deviceminor",  "<u4"),
+                                   ("access",       "<u4"), # MapEntry.VM_* flags
+                                   ("reserved",     "<u4"),
+                                   ("nameoffset",   "<u8"), # into the string table
+                                   ("namelength",   "<u8"),
+                                   ("pagecount",    "<u8"),
+                                   ("dataoffset",   "<u8")]) # of the first column
+
+
+def _getColumnCount(columns):
+    '''
+        private helper returning the number of column bits set in columns
+    '''
+    return bin(columns).count('1')
+
+
+
+def saveSnapshot(filename, pid, maplist = None):
+    '''
+        scans the mappings of a process and writes them to a snapshot file
+        filename -- name of the snapshot file
+        pid      -- pid as a decimal number
+        maplist  -- list of MapEntry instances to save, default is all
+                    mappings of the process
+
+        returns the number of saved mappings
+    '''
+    if numpy is None:
+        raise ImportError, "saveSnapshot: needs numpy (available on PyPi)"
+
+    timestamp = time.time()
+    if maplist is None:
+        maplist = smaps.Maps(pid).maplist
+    # vsyscall is above the task virtual address space so pagemap
+    # does not return anything for it
+    maplist = [me for me in maplist if me.name != "[vsyscall]"]
+
+    columns = SNAPSHOT_PAGEMAP
+    if os.access("/proc/kpagecount", os.R_OK) and os.access("/proc/kpageflags", os.R_OK):
+        columns |= SNAPSHOT_KPAGECOUNT | SNAPSHOT_KPAGEFLAGS
+    ncolumns = _getColumnCount(columns)
+
+    pagesize = pagemap.PAGESIZE
+    pm       = pagemap.PageMap(pid)
+    table    = numpy.zeros(len(maplist), dtype=_MAPTABLE_DTYPE)
+    names    = []
+    namesize = 0
+
+    with open(filename, 'wb') as fh:
+        dataoffset = _HEADER.size
+        for idx, me in enumerate(maplist):
+            name = me.name.encode("utf-8") if isinstance(me.name, unicode) else me.name
+            pagecount = (me.stopaddress - me.startaddress) / pagesize
+            table[idx] = (me.startaddress, me.stopaddress, me.offset, me.inode, me.devicemajor, me.deviceminor,
+                          me.access, 0, namesize, len(name), pagecount, dataoffset)
+            names.append(name)
+            namesize += len(name)
+
+            # the columns are written batch by batch at their final place,
+            # whatever could not be read stays 0
+            pos = 0
+            for pia in pm.iterPageInfoArrays(me.startaddress, me.stopaddress, pagesize):
+                colvalues = [pia.values]
+                if columns & SNAPSHOT_KPAGECOUNT:
+                    colvalues.append(pia.mapcount)
+                    colvalues.append(pia.pageflags)
+                for col, values in enumerate(colvalues):
+                    if values is None:
+                        continue
+                    fh.seek(dataoffset + (col * pagecount + pos) * 8)
+                    fh.write(buffer(values.astype("<u8", copy=False)))
+                pos += len(pia)
+
+            dataoffset += ncolumns * pagecount * 8
+
+        # the page data may end with a hole, so place the tables explicitly
+        maptableoffset = dataoffset
+        fh.seek(maptableoffset)
+        fh.write(buffer(table))
+        stringsoffset = maptableoffset + table.nbytes
+        fh.write("".join(names))
+
+        fh.seek(0)
+        fh.write(_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, pagesize, columns, 0, pid, timestamp,
+                              len(maplist), maptableoffset, stringsoffset, namesize))
+
+    debug("saveSnapshot: saved %d mappings of pid %d to '%s'" % (len(maplist), pid, filename))
+    return len(maplist)
+
+
+
+class Snapshot:
+    '''
+        read access to a snapshot file, the file is memory mapped and all
+        columns are numpy arrays directly on top of the mapping, so nothing
+        is read before it is accessed
+    '''
+    filename  = None
+    pid       = None
+    pagesize  = None
+    timestamp = None
+    columns   = None # bitmask of the SNAPSHOT_* column bits
+    maptable  = None # numpy structured array with _MAPTABLE_DTYPE
+
+    def __init__(self, filename):
+        '''
+            filename -- name of the snapshot file
+        '''
+        if numpy is None:
+            raise ImportError, "Snapshot: needs numpy (available on PyPi)"
+        self.filename = filename
+
+        with open(filename, 'rb') as fh:
+            self._mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._mmap) < _HEADER.size:
+            self.close()
+            raise IOError, "Snapshot: '%s' is too short for a snapshot" % filename
+        (magic, version, self.pagesize, self.columns, reserved, self.pid, self.timestamp,
+         mapcount, maptableoffset, stringsoffset, stringssize) = _HEADER.unpack_from(self._mmap)
+        if magic != SNAPSHOT_MAGIC:
+            self.close()
+            raise IOError, "Snapshot: '%s' is not a snapshot" % filename
+        if version != SNAPSHOT_VERSION:
+            self.close()
+            raise IOError, "Snapshot: '%s' has unsupported version %d" % (filename, version)
+
+        self.maptable = numpy.frombuffer(self._mmap, dtype=_MAPTABLE_DTYPE, count=mapcount, offset=maptableoffset)
+        self._stringsoffset = stringsoffset
+        self._ncolumns      = _getColumnCount(self.columns)
+
+
+    def close(self):
+        '''
+            unmaps the file, arrays returned before must not be used anymore
+        '''
+        self.maptable = None
+        self._mmap.close()
+
+
+    def __len__(self):
+        return len(self.maptable)
+
+
+    def getName(self, idx):
+        '''
+            returns the name of mapping idx
+        '''
+        row   = self.maptable[idx]
+        start = self._stringsoffset + int(row["nameoffset"])
+        return self._mmap[start:start + int(row["namelength"])]
+
+
+    def getMapEntry(self, idx):
+        '''
+            returns a MapEntry with the header fields of mapping idx
+        '''
+        row = self.maptable[idx]
+        me = smaps.MapEntry()
+        me.startaddress = int(row["startaddress"])
+        me.stopaddress  = int(row["stopaddress"])
+        me.offset       = int(row["offset"])
+        me.devicemajor  = int(row["devicemajor"])
+        me.deviceminor  = int(row["deviceminor"])
+        me.inode        = int(row["inode"])
+        me.access       = int(row["access"])
+        me.name         = self.getName(idx)
+        return me
+
+
+    def getMapList(self):
+        '''
+            returns a list of MapEntry instances for all mappings
+        '''
+        return [self.getMapEntry(idx) for idx in range(len(self.maptable))]
+
+
+    def _getColumn(self, idx, column):
+        '''
+            private helper returning a column of mapping idx as a read-only
+            numpy view of the file or None if the column was not saved
+        '''
+        if not self.columns & column:
+            return None
+        # position among the saved columns
+        col = _getColumnCount(self.columns & (column - 1))
+        row = self.maptable[idx]
+        pagecount = int(row["pagecount"])
+        return numpy.frombuffer(self._mmap, dtype="<u8", count=pagecount,
+                                offset=int(row["dataoffset"]) + col * pagecount * 8)
+
+
+    def getPageMap(self, idx):
+        '''
+            returns the raw pagemap words of mapping idx
+        '''
+        return self._getColumn(idx, SNAPSHOT_PAGEMAP)
+
+
+    def getKPageCount(self, idx):
+        '''
+            returns the kpagecount words of mapping idx or None
+        '''
+        return self._getColumn(idx, SNAPSHOT_KPAGECOUNT)
+
+
+    def getKPageFlags(self, idx):
+        '''
+            returns the kpageflags words of mapping idx or None
+        '''
+        return self._getColumn(idx, SNAPSHOT_KPAGEFLAGS)
+
+
+    def getPageInfoArray(self, idx):
+        '''
+            returns the decoded pagemap of mapping idx as PageInfoArray
+        '''
+        pia = pagemap.PageInfoArray(int(self.maptable[idx]["startaddress"]), self.pagesize, self.getPageMap(idx))
+        pia.mapcount  = self.getKPageCount(idx)
+        pia.pageflags = self.getKPageFlags(idx)
+        return pia
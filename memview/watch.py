@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2013, Carsten Juttner <carjay@gmx.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Periodic sampling of one process, the pagemap is only read again for
+# mappings whose smaps counters changed since the previous sample
+
+import collections
+import logging
+import pagemap
+import smaps
+import time
+
+lh = logging.getLogger(__name__)
+info    = lh.info
+debug   = lh.debug
+error   = lh.error
+warning = lh.warning
+
+
+class MappingSample:
+    '''
+        holds the state of one mapping at one point in time
+    '''
+    timestamp     = None
+    rss           = None # from smaps, in bytes
+    swap          = None
+    private_dirty = None
+    pagecounts    = None # PageCounts from the pagemap
+    rescanned     = None # True if pagecounts was read for this sample
+
+
+
+class MappingHistory:
+    '''
+        holds the most recent samples of one mapping
+    '''
+    key      = None # (startaddress, stopaddress, inode)
+    mapentry = None # MapEntry of the latest sample
+    samples  = None # deque of MappingSample, oldest first
+
+    def __init__(self, key, historylen):
+        self.key     = key
+        self.samples = collections.deque(maxlen = historylen)
+
+
+    def getLatest(self):
+        return self.samples[-1]
+
+
+
+class Watcher:
+    '''
+        samples the mappings of a process, call sample() periodically or use
+        run()
+    '''
+    pid        = None
+    historylen = None # number of samples kept per mapping
+    mappings   = None # dict of key -> MappingHistory for the current mappings
+    index      = None # MapIndex over the current mappings
+
+    def __init__(self, pid, historylen = 60, workers = pagemap.PAGEMAP_SCAN_WORKERS):
+        '''
+            pid        -- pid as a decimal number
+            historylen -- number of samples kept per mapping
+            workers    -- number of threads reading the pagemap
+        '''
+        self.pid        = pid
+        self.historylen = historylen
+        self.mappings   = {}
+        self.index      = smaps.MapIndex([])
+        self._workers   = workers
+        self._pagemap   = pagemap.PageMap(pid)
+
+
+    def sample(self):
+        '''
+            takes one sample of all mappings
+
+            returns a tuple of lists of keys (added, removed, rescanned)
+        '''
+        timestamp = time.time()
+        s = smaps.SMaps(self.pid)
+
+        current = {}
+        for me in s.maplist:
+            # vsyscall is above the task virtual address space so pagemap
+            # does not return anything for it
+            if me.name == "[vsyscall]":
+                continue
+            current[(me.startaddress, me.stopaddress, me.inode)] = me
+
+        removed = [key for key in self.mappings if key not in current]
+        added   = [key for key in current if key not in self.mappings]
+        self.index.update([self.mappings[key].mapentry for key in removed], [current[key] for key in added])
+        for key in removed:
+            del self.mappings[key]
+        for key in added:
+            self.mappings[key] = MappingHistory(key, self.historylen)
+
+        # only mappings with changed counters need a pagemap scan
+        rescan = []
+        for key, me in current.iteritems():
+            history = self.mappings[key]
+            history.mapentry = me
+            if history.samples:
+                latest = history.getLatest()
+                if (latest.rss, latest.swap, latest.private_dirty) == (me.rss, me.swap, me.private_dirty):
+                    continue
+            rescan.append(key)
+
+        ranges = [(key[0], key[1], pagemap.PAGESIZE) for key in rescan]
+        pagecounts = dict(zip(rescan, self._pagemap.scanMappings(ranges, self._workers)))
+
+        for key, me in current.iteritems():
+            history = self.mappings[key]
+            ms = MappingSample()
+            ms.timestamp     = timestamp
+            ms.rss           = me.rss
+            ms.swap          = me.swap
+            ms.private_dirty = me.private_dirty
+            ms.rescanned     = key in pagecounts
+            if ms.rescanned:
+                ms.pagecounts = pagecounts[key]
+            else:
+                ms.pagecounts = history.getLatest().pagecounts
+            history.samples.append(ms)
+
+        debug("sample: %d mappings, %d added, %d removed, %d rescanned" % (len(current), len(added), len(removed), len(rescan)))
+        return added, removed, rescan
+
+
+    def lookup(self, address):
+        '''
+            returns the MappingHistory of the mapping containing address or
+            None
+        '''
+        me = self.index.lookup(address)
+        if me is None:
+            return None
+        return self.mappings[(me.startaddress, me.stopaddress, me.inode)]
+
+
+    def run(self, interval, count = None, callback = None):
+        '''
+            samples every interval seconds
+            interval -- seconds between the start of two samples
+            count    -- number of samples, None for endless
+            callback -- called as callback(watcher, added, removed, rescanned)
+                        after each sample
+        '''
+        nextsample = time.time()
+        while count is None or count > 0:
+            added, removed, rescanned = self.sample()
+            if callback:
+                callback(self, added, removed, rescanned)
+            if count is not None:
+                count -= 1
+                if count == 0:
+                    break
+            nextsample += interval
+            time.sleep(max(0, nextsample - time.time()))
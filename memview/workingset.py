@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2013, Carsten Juttner <carjay@gmx.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Working set estimation of one process. The soft-dirty bits of the page table
+# entries tell which pages were written since the last reset, the page_idle
+# bitmap (linux 4.3+, CONFIG_IDLE_PAGE_TRACKING) tells which page frames were
+# accessed at all.
+
+import errno
+import logging
+import pagemap
+import smaps
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+lh = logging.getLogger(__name__)
+info    = lh.info
+debug   = lh.debug
+error   = lh.error
+warning = lh.warning
+
+
+PAGE_IDLE_BITMAP = "/sys/kernel/mm/page_idle/bitmap"
+
+# value for /proc/<pid>/clear_refs that clears the soft-dirty bits
+CLEAR_REFS_SOFTDIRTY = "4"
+
+
+class MappingWorkingSet:
+    '''
+        holds the working set of one mapping for one interval, all counts
+        in pages
+    '''
+    key          = None # (startaddress, stopaddress, inode)
+    name         = None
+    pagecount    = 0
+    presentcount = 0
+    writtencount = 0    # pages written to since the last reset
+    touchedcount = None # present pages accessed since the last reset, None
+                        # without idle page tracking
+
+    def __repr__(self):
+        return "<MappingWorkingSet %x-%x '%s' pages:%d present:%d written:%d touched:%s>" % (
+                self.key[0], self.key[1], self.name, self.pagecount, self.presentcount,
+                self.writtencount, self.touchedcount)
+
+
+
+class WorkingSet:
+    '''
+        measures the pages a process writes to or touches per interval, call
+        reset() to start an interval and measure() to end it or use run()
+    '''
+    pid          = None
+    idletracking = None # True if the page_idle bitmap is usable
+    resettime    = None # time of the last reset()
+
+    def __init__(self, pid):
+        '''
+            pid -- pid as a decimal number
+        '''
+        if numpy is None:
+            raise ImportError, "WorkingSet: needs numpy (available on PyPi)"
+        self.pid      = pid
+        self._pagemap = pagemap.PageMap(pid)
+
+        try:
+            open(PAGE_IDLE_BITMAP, 'r+b', 0).close()
+            self.idletracking = True
+        except IOError, exc:
+            if exc.errno == errno.EACCES:
+                warning("WorkingSet: no permission to access '%s', only written pages are reported" % PAGE_IDLE_BITMAP)
+            else:
+                warning("WorkingSet: idle page tracking not available, only written pages are reported")
+            self.idletracking = False
+
+
+    def _getMappings(self):
+        '''
+            private helper returning the current mappings without [vsyscall]
+        '''
+        # vsyscall is above the task virtual address space so pagemap
+        # does not return anything for it
+        return [me for me in smaps.Maps(self.pid).maplist if me.name != "[vsyscall]"]
+
+
+    def reset(self):
+        '''
+            starts a new interval: clears the soft-dirty bits of the process
+            and marks all its present page frames idle
+        '''
+        with open("/proc/%d/clear_refs" % self.pid, 'wb') as fh:
+            fh.write(CLEAR_REFS_SOFTDIRTY)
+
+        if self.idletracking:
+            pfnlist = []
+            for me in self._getMappings():
+                for pia in self._pagemap.iterPageInfoArrays(me.startaddress, me.stopaddress, pagemap.PAGESIZE, kpageinfo = False):
+                    pfnlist.append(pia.pfn[pia.getPFNIndices()])
+            if pfnlist:
+                pfns = numpy.concatenate(pfnlist)
+                # one bit per page frame, writing 1 marks the frame idle
+                with open(PAGE_IDLE_BITMAP, 'wb', 0) as fh:
+                    pagemap.writeWords(fh, pfns >> numpy.uint64(6), numpy.uint64(1) << (pfns & numpy.uint64(63)))
+        self.resettime = time.time()
+
+
+    def measure(self):
+        '''
+            measures the working set since the last reset()
+
+            returns a list of MappingWorkingSet instances in address order
+        '''
+        fhidle = None
+        if self.idletracking:
+            fhidle = open(PAGE_IDLE_BITMAP, 'rb', 0)
+
+        try:
+            result = []
+            for me in self._getMappings():
+                mws = MappingWorkingSet()
+                mws.key  = (me.startaddress, me.stopaddress, me.inode)
+                mws.name = me.name
+                if fhidle:
+                    mws.touchedcount = 0
+                for pia in self._pagemap.iterPageInfoArrays(me.startaddress, me.stopaddress, pagemap.PAGESIZE, kpageinfo = False):
+                    presentcount = pia.getPresentCount()
+                    mws.pagecount    += len(pia)
+                    mws.presentcount += presentcount
+                    # swapped out pages keep their soft-dirty bit
+                    mws.writtencount += int(numpy.count_nonzero(pia.softdirty & (pia.present | pia.swapped)))
+                    if fhidle and presentcount:
+                        pfns  = pia.pfn[pia.getPFNIndices()]
+                        words = pagemap.readWords(fhidle, pfns >> numpy.uint64(6))
+                        idle  = (words >> (pfns & numpy.uint64(63))) & numpy.uint64(1)
+                        mws.touchedcount += presentcount - int(numpy.count_nonzero(idle))
+                result.append(mws)
+        finally:
+            if fhidle:
+                fhidle.close()
+        return result
+
+
+    def run(self, interval, count = None, callback = None):
+        '''
+            measures the working set of consecutive intervals
+            interval -- length of one interval in seconds
+            count    -- number of intervals, None for endless
+            callback -- called as callback(workingset, mappingworkingsets)
+                        after each interval
+        '''
+        self.reset()
+        while count is None or count > 0:
+            time.sleep(max(0, self.resettime + interval - time.time()))
+            result = self.measure()
+            self.reset()
+            if callback:
+                callback(self, result)
+            if count is not None:
+                count -= 1